@@ -5,6 +5,13 @@ forwarder
 
 这个包是项目的Forwarder部分。
 
+Forwarder把客户端发往/server/*的请求转发给对应的Server。
+其中Server的已知Node列表、Server配置和Node配置等GET请求的响应由forwardercache模块的ResponseCache缓存，
+对应的POST请求经过Forwarder时缓存失效。
+
+Server发来的警报通过Socket.IO推送给客户端。客户端可以订阅Server、Node、传感器的ID或server_desc路径的前缀，
+Forwarder用subscription模块的SubscriptionIndex查找订阅者，只向匹配的客户端推送。
+
 如果要……
 ==========
 
@@ -12,24 +12,33 @@ from gevent import monkey
 monkey.patch_all()
 
 # 外部模块
-from bottle import Bottle, request, redirect, static_file
-import grequests
+from bottle import Bottle, request, response, redirect, static_file
 from requests.exceptions import RequestException
 from socketio import socketio_manage
 from socketio.namespace import BaseNamespace
 from socketio.mixins import BroadcastMixin
+from socketio import packet as socketio_packet
+from socketio.server import SocketIOServer
+import gevent
 
 # 项目内的其他模块
 from pinic.forwarder.forwarderconfig import ForwarderConfig
 from pinic.forwarder.forwarderconfig import parse_from_string as parse_forwarder_config_from_string
+from pinic.forwarder.forwardercache import ResponseCache, CachedResponse
+from pinic.forwarder.subscription import SubscriptionIndex, parse_topics
+from pinic.forwarder.warningreplay import WarningReplayBuffer
 from pinic.server.serverconfig import parse_from_string as parse_server_config_from_string
 from pinic.util import generate_500
+from pinic.listener import Listener
+from pinic.httpclient import HttpClient
+from pinic.registry import ExpiryRegistry
 
 # python内置模块
 import logging
 import threading
+from collections import deque
 from time import time
-from json import dumps
+from json import dumps, loads
 
 
 # 设置日志等级
@@ -39,21 +48,59 @@ logging.basicConfig(level=logging.DEBUG)
 class WarningNamespace(BaseNamespace, BroadcastMixin):
     """
     继承Socket.IO的命名空间BaseNamespace。用于警报信息的实时推送。
+
+    警报用WarningNamespace.broadcast(event, data)广播：每份警报只编码一次，放入每个连接自己的有界队列后立即返回，
+    由每个连接的发送greenlet（send_frames）交给Socket.IO发送。一个接收缓慢的浏览器不会拖慢其他连接和Server的请求。
+    队列已满时，按queue_policy丢弃最旧的帧（"drop_oldest"），或断开这个连接（"disconnect"）。
+
+    客户端可以发送"subscribe"和"unsubscribe"事件，订阅或退订Server、Node、传感器的ID或server_desc路径的前缀，
+    参数为{"servers": [...], "nodes": [...], "sensors": [...], "paths": [...]}（可以只给出其中几项）。
+    警报只被推送给订阅了匹配主题的客户端，以及没有订阅任何主题的客户端。参见subscription模块。
+
+    客户端连接时，会先收到一个"warnings"事件，参数为{"data": [最近的警报数据, ...]}，即最近replay_seconds秒内、
+    最多replay_count份警报，用于恢复页面的状态。订阅主题后，客户端可以发送"replay"事件，
+    参数为{"count": 份数, "seconds": 秒数}（均可省略），再次获取与当前订阅匹配的最近的警报。参见warningreplay模块。
     """
 
     # 当前已知的所有连接:
     connections = {}
     """ :type: dict[int, WarningNamespace] """
 
+    # 连接的订阅索引，键为id(连接)
+    subscriptions = SubscriptionIndex()
+
+    queue_size = 64  # 每个连接的队列最多缓存的帧数，由Forwarder按配置设置
+    queue_policy = "drop_oldest"  # 队列已满时的处理方式，"drop_oldest"或"disconnect"，由Forwarder按配置设置
+    transport_window = 8  # 每个连接已交给Socket.IO、但尚未发出的帧数上限。超过时帧留在有界队列中
+    transport_wait = 0.1  # 秒，已交给Socket.IO的帧数超过上限时，再次检查前的等待时间
+
+    replay = WarningReplayBuffer(256)  # 最近的警报，容量由Forwarder按配置设置
+    replay_count = 20  # 连接时最多发送的最近警报数，由Forwarder按配置设置
+    replay_seconds = 300.0  # 连接时只发送最近多少秒内的警报，由Forwarder按配置设置
+
+    # 统计信息
+    broadcasts = 0  # 广播的帧数
+    delivered = 0  # 放入各连接队列的帧数
+    dropped = 0  # 因队列已满而丢弃的帧数
+    disconnected = 0  # 因队列已满而断开的连接数
+
     def initialize(self):
         """
         初始化本命名空间。
         初始化后，命名空间即可用于SocketIO连接。
         """
 
+        self.frames = deque()  # 类型：deque of str，等待发送的已编码的帧
+        self.frame_event = threading.Event()  # 有新的帧时被设置。已经被gevent monkey_patch
+        self.dropped_frames = 0  # 本连接因队列已满而丢弃的帧数
+
         WarningNamespace.connections[id(self)] = self
+        WarningNamespace.subscriptions.add(id(self))
         print "Socket.io - Init WarningNamespace, current %d alive" % len(WarningNamespace.connections)
         super(WarningNamespace, self).initialize()  # 调用父类的initialize方法
+        self.spawn(self.send_frames)  # 连接断开时，发送greenlet被Socket.IO结束
+        if WarningNamespace.replay_count > 0:
+            self.send_replay(WarningNamespace.replay_count, WarningNamespace.replay_seconds)
 
     def disconnect(self, silent=False):
         """
@@ -62,16 +109,167 @@ class WarningNamespace(BaseNamespace, BroadcastMixin):
         :param silent: 是否对客户端静默，不对客户端返回任何断开确认信息。默认值为False（不静默）。
         """
 
-        del WarningNamespace.connections[id(self)]
+        WarningNamespace.connections.pop(id(self), None)
+        WarningNamespace.subscriptions.remove(id(self))
         print "Socket.io - Disconnect WarningNamespace, current %d alive" % len(WarningNamespace.connections)
         super(WarningNamespace, self).disconnect(silent)  # 调用父类的disconnect方法
 
+    def on_subscribe(self, topics):
+        """
+        处理客户端的"subscribe"事件，增加订阅的主题。返回（确认）当前订阅的所有主题。
+
+        :param dict topics: 要订阅的主题
+        """
+        try:
+            WarningNamespace.subscriptions.subscribe(id(self), parse_topics(topics))
+        except ValueError as e:
+            self.error("invalid_topics", str(e))
+            return
+        # 返回值是客户端回调函数的参数列表
+        return [WarningNamespace.subscriptions.get_topics(id(self))]
+
+    def on_unsubscribe(self, topics):
+        """
+        处理客户端的"unsubscribe"事件，删除订阅的主题。返回（确认）当前订阅的所有主题。
+
+        :param dict topics: 要退订的主题
+        """
+        try:
+            WarningNamespace.subscriptions.unsubscribe(id(self), parse_topics(topics))
+        except ValueError as e:
+            self.error("invalid_topics", str(e))
+            return
+        # 返回值是客户端回调函数的参数列表
+        return [WarningNamespace.subscriptions.get_topics(id(self))]
+
+    def on_replay(self, options=None):
+        """
+        处理客户端的"replay"事件，发送与当前订阅匹配的最近的警报。
+
+        :param dict options: {"count": 最多的份数, "seconds": 最近多少秒}，均可省略，默认为连接时使用的值
+        """
+        options = options if isinstance(options, dict) else {}
+        try:
+            count = int(options.get("count", WarningNamespace.replay_count))
+            seconds = float(options.get("seconds", WarningNamespace.replay_seconds))
+        except (TypeError, ValueError) as e:
+            self.error("invalid_replay", str(e))
+            return
+        # 不超过缓冲区的容量
+        self.send_replay(min(count, WarningNamespace.replay.capacity), seconds)
+
+    def send_replay(self, count, seconds):
+        """
+        把与当前订阅匹配的最近的警报作为一个"warnings"事件放入本连接的队列。没有匹配的警报时也发送，参数为空的list。
+
+        :param int count: 最多的份数
+        :param float seconds: 只发送最近多少秒内的警报
+        """
+        warnings = WarningNamespace.replay.query(WarningNamespace.subscriptions.topics.get(id(self)), count, seconds)
+        self.offer(socketio_packet.encode({"type": "event", "name": "warnings", "args": [{"data": warnings}],
+                                           "endpoint": self.ns_name}))
+
+    @classmethod
+    def broadcast(cls, event, data, topic=None):
+        """
+        向订阅了匹配主题的连接广播一个事件。事件对每个端点只编码一次。不会阻塞。
+
+        :param str event: 事件名
+        :param data: 事件的参数，需要可以转换为Json
+        :param tuple topic: 事件的主题，(server_id, node_id, sensor_id, server_desc)，各项可以为None。
+                            为None时向所有连接广播
+        """
+        cls.broadcasts += 1
+        if topic is None:
+            keys = cls.connections.keys()
+        else:
+            keys = cls.subscriptions.match(*topic)
+        encoded_frames = {}  # 端点 -> 已编码的帧
+        for key in keys:
+            connection = cls.connections.get(key)
+            # 再次检查类型
+            if not isinstance(connection, WarningNamespace):
+                continue
+            frame = encoded_frames.get(connection.ns_name)
+            if frame is None:
+                frame = socketio_packet.encode({"type": "event", "name": event, "args": [data],
+                                                "endpoint": connection.ns_name})
+                encoded_frames[connection.ns_name] = frame
+            cls.delivered += 1
+            connection.offer(frame)
+
+    def offer(self, frame):
+        """
+        向本连接的队列中放入一帧。队列已满时按queue_policy处理。
+
+        :param str frame: 已编码的帧
+        """
+        if len(self.frames) >= WarningNamespace.queue_size:
+            if WarningNamespace.queue_policy == "disconnect":
+                WarningNamespace.disconnected += 1
+                logging.warning("[WarningNamespace.offer] queue is full, disconnecting a slow client")
+                self.disconnect()
+                return
+            self.frames.popleft()
+            self.dropped_frames += 1
+            WarningNamespace.dropped += 1
+        self.frames.append(frame)
+        self.frame_event.set()
+
+    def send_frames(self):
+        """
+        本连接的发送greenlet。把队列中的帧交给Socket.IO发送。
+        Socket.IO中尚未发出的帧过多（客户端接收缓慢）时等待，使积压的帧留在有界的队列中。
+        """
+        while True:
+            self.frame_event.wait()
+            self.frame_event.clear()
+            while self.frames:
+                if self.socket.client_queue.qsize() >= WarningNamespace.transport_window:
+                    gevent.sleep(WarningNamespace.transport_wait)
+                    continue
+                self.socket.put_client_msg(self.frames.popleft())
+
+    @classmethod
+    def get_stats(cls):
+        """
+        以dict的形式返回广播的统计信息。
+
+        :rtype: dict
+        """
+        return {
+            "connections": len(cls.connections),
+            "queued": sum(len(x.frames) for x in cls.connections.values()),
+            "subscribed": len(cls.subscriptions.topics),
+            "broadcasts": cls.broadcasts,
+            "delivered": cls.delivered,
+            "dropped": cls.dropped,
+            "disconnected": cls.disconnected,
+            "replay_buffered": len(cls.replay)
+        }
+
 
 class Forwarder(object):
     """
     本类是项目中的Forwarder服务器。运行指导参见pinic.forwarder.__init__.py的文档。
     """
 
+    proxy_chunk_size = 64 * 1024  # 字节，转发Server的响应时每次读取和发送的块大小
+
+    listener_drain_timeout = 10.0  # 更换监听地址后，等待原地址上正在处理的请求（包括Socket.IO连接）完成的最长时间（秒）
+
+    # 转发请求时原样转发给Server的请求头
+    proxy_request_headers = ("Accept", "Accept-Encoding", "Content-Type")
+
+    # 转发响应时原样转发给客户端的响应头。其他的头（如Connection、Transfer-Encoding）只对一跳有效，不转发
+    proxy_response_headers = ("Content-Type", "Content-Encoding", "Content-Length", "Cache-Control", "Last-Modified")
+
+    # POST请求经过Forwarder时，要从响应缓存中删除的同一个Server的GET请求种类。不在其中的POST请求删除同名的请求种类
+    cache_invalidations = {
+        "serverconfig": ("serverconfig", "knownnodes"),
+        "nodeconfig": ("nodeconfig", "knownnodes")
+    }
+
     def __init__(self, forwarder_config):
         """
         :param ForwarderConfig forwarder_config: 初始化用的Forwarder配置（ForwarderConfig对象）。
@@ -81,9 +279,19 @@ class Forwarder(object):
 
         self.bottle = Bottle()  # 类型：Bottle，是本服务器内含的Bottle Web服务器
 
+        self.listener = Listener(self.create_socketio_server, self.bottle, Forwarder.listener_drain_timeout)  # 类型：Listener，运行Bottle的监听器
+
         self.server_monitor = None  # 类型：ServerMonitor，是每隔一定时间监控Server存活的线程（已经被gevent patch过）
 
-        self.known_servers = []  # 类型：list of ServerInfo，是已知的服务器信息的列表。
+        self.known_servers = ExpiryRegistry()  # 类型：ExpiryRegistry of ServerInfo，是已知的服务器信息的注册表。
+
+        self.http_client = HttpClient()  # 类型：HttpClient，向Server转发请求所用的、带连接池的HTTP客户端
+
+        self.active_proxies = 0  # 正在转发响应正文的请求数
+
+        self.proxied_bytes = 0  # 转发给客户端的响应正文的总字节数
+
+        self.response_cache = None  # 类型：ResponseCache，转发的Server GET请求的响应缓存
 
         # 应用初始化配置
         self.apply_config(forwarder_config)
@@ -97,6 +305,9 @@ class Forwarder(object):
     def apply_config(self, new_config, load_old_config=False):
         """
         为Forwarder服务器应用新的配置。
+        已知的Server列表和ServerMonitor线程始终保留，ServerMonitor每次等待前从当前配置读取间隔，修改后不需要重启。
+        警报推送的队列、响应缓存等按新的配置原地调整。
+        监听的地址或端口改变时，先在新的地址上开始监听，原来的监听在处理完正在进行的请求后关闭；新的地址无法监听时抛出异常，新配置不被应用。
 
         :param ForwarderConfig new_config: 要应用的新配置（ForwarderConfig对象）。
         :param bool load_old_config: 是否在失败时重新加载旧的配置，默认为False。
@@ -110,21 +321,32 @@ class Forwarder(object):
         # 备份旧的配置
         old_config = self.config
 
-        # 清空已知的Server列表，停止监视线程
-        if self.server_monitor is not None:
-            self.server_monitor.stop()
+        # 监听的地址或端口改变时，先在新的地址上开始监听。无法监听时抛出异常，新配置的其他部分都不会被应用
+        if (old_config is not None) and ((new_config.forwarder_host != old_config.forwarder_host) or (new_config.forwarder_port != old_config.forwarder_port)):
+            self.restart_bottle(new_config.forwarder_host, new_config.forwarder_port)
 
         # 将Forwarder的配置设置为新的配置
         self.config = new_config
 
-        # 开启新的Server监视线程
-        self.server_monitor = ServerMonitor(self)
-        self.server_monitor.start()
+        # 设置警报推送的队列
+        WarningNamespace.queue_size = new_config.warning_queue_size
+        WarningNamespace.queue_policy = new_config.warning_queue_policy
+        WarningNamespace.replay.resize(new_config.warning_replay_size)
+        WarningNamespace.replay_count = new_config.warning_replay_count
+        WarningNamespace.replay_seconds = new_config.warning_replay_seconds
+
+        # 创建或调整响应缓存。请求种类的缓存时间改变后，已缓存的条目作废
+        if self.response_cache is None:
+            self.response_cache = ResponseCache(new_config.response_cache_max_bytes)
+        else:
+            self.response_cache.resize(new_config.response_cache_max_bytes)
+            if new_config.response_cache_ttls != old_config.response_cache_ttls:
+                self.response_cache.invalidate(lambda key: True)
 
-        # 如果需要，重启整个服务器
-        # TODO 由于需求变化，不实现
-        if (old_config is not None) and ((new_config.forwarder_port != old_config.forwarder_port) or (new_config.forwarder_host != old_config.forwarder_host)):
-            self.restart_bottle()
+        # 开启Server监视线程。它从当前配置读取间隔，配置改变时不需要重启
+        if self.server_monitor is None:
+            self.server_monitor = ServerMonitor(self)
+            self.server_monitor.start()
 
     def start_bottle(self):
         """
@@ -141,6 +363,9 @@ class Forwarder(object):
         self.bottle.route("/forwarder/keepserver/<server_id>", method="GET", callback=self.get_keep_server)
         self.bottle.route("/forwarder/knownservers", method="GET", callback=self.get_known_servers)
         self.bottle.route("/forwarder/warningdata", method="POST", callback=self.post_warning_data)
+        self.bottle.route("/forwarder/stats", method="GET", callback=self.get_stats)
+        self.bottle.route("/forwarder/topology", method="GET", callback=self.get_topology)
+        self.bottle.route("/forwarder/topologychanged/<server_id>", method="POST", callback=self.post_topology_changed)
         self.bottle.route("/server/<request_method>/<server_id>", method=["GET", "POST"], callback=self.server_method)
         self.bottle.route("/server/<request_method>/<server_id>/<other_ids:path>", method=["GET", "POST"], callback=self.server_method)
 
@@ -151,16 +376,28 @@ class Forwarder(object):
         # URL路由，Socket.IO部分
         self.bottle.route("/socket.io/<path:re:.*>", method="GET", callback=self.http_socket_io)
 
-        # 开启Bottle
-        self.bottle.run(
-            host=self.config.forwarder_host,
-            port=self.config.forwarder_port,
-            server="geventSocketIO"
-        )
+        # 开启Bottle。使用Listener运行，使监听的地址和端口可以在运行中更换
+        self.listener.serve_forever(self.config.forwarder_host, self.config.forwarder_port)
+
+    def create_socketio_server(self, host, port, application):
+        """
+        创建Socket.IO服务器，与Bottle的server="geventSocketIO"相同。
+        Flash策略服务器的端口是固定的，更换地址时原来的策略服务器仍在运行，因此只在第一次监听时开启。
 
-    def restart_bottle(self):
-        logging.debug("[Forwarder.restart_bottle] restarting bottle")
-        pass
+        :rtype: SocketIOServer
+        """
+        return SocketIOServer((host, port), application, policy_server=(self.listener.server is None))
+
+    def restart_bottle(self, host, port):
+        """
+        在新的地址和端口上开始监听，原来的监听在处理完正在进行的请求后关闭（参见pinic.listener）。
+        已知的Node、Server列表，缓存和各个线程都不受影响。新的地址无法监听时抛出异常，原来的监听继续工作。
+
+        :param str host: 新的监听地址
+        :param int port: 新的监听端口
+        """
+        logging.debug("[Forwarder.restart_bottle] rebinding bottle to %s:%d" % (host, port))
+        self.listener.rebind(host, port)
 
     def find_server_by_id(self, server_id):
         """
@@ -170,9 +407,7 @@ class Forwarder(object):
 
         :rtype ServerInfo:
         """
-        for s in self.known_servers:
-            if s.id == server_id:
-                return s
+        return self.known_servers.get(server_id)
 
     def remove_known_server(self, server_id):
         """
@@ -180,14 +415,15 @@ class Forwarder(object):
 
         :param basestring server_id: 要删除的Server的ID。
         """
-        server_to_remove = self.find_server_by_id(server_id)
-        if isinstance(server_to_remove, ServerInfo):
-            logging.debug("[Forwarder.remove_known_server] removing server with server_id=%s" % server_id)
-            self.known_servers.remove(server_to_remove)
+        removed_server = self.known_servers.remove(server_id)
+        if removed_server is not None:
+            logging.debug("[Forwarder.remove_known_server] removed server with server_id=%s" % server_id)
+            self.http_client.forget_peer(removed_server.addr, removed_server.port)
+            self.response_cache.invalidate(lambda key: (key[0] == server_id) or (key[1] == "topology"))
 
     def add_known_server(self, server_addr, server_port, server_id, server_desc, server_config):
         """
-        用Server的信息添加一个Server到已知Server列表里。
+        用Server的信息添加一个Server到已知Server列表里。如果已经存在相同ID的Server，则替换它。
 
         :param basestring server_addr: 要添加的Server的地址
         :param int server_port: 要添加的Server的端口号
@@ -196,8 +432,56 @@ class Forwarder(object):
         :param ServerConfig server_config: 要添加的Server的配置（一个ServerConfig对象）
         """
         logging.debug("[Forwarder.add_known_server] adding server with server_id=%s" % server_id)
-        self.remove_known_server(server_id)
-        self.known_servers.append(ServerInfo(server_addr, server_port, server_id, server_desc, server_config))
+        self.known_servers.add(ServerInfo(server_addr, server_port, server_id, server_desc, server_config))
+        self.invalidate_topology()
+
+    def invalidate_topology(self):
+        """
+        使缓存的拓扑文档（/forwarder/topology）失效。在Server或Node注册、解除注册时调用。
+        """
+        self.response_cache.invalidate(lambda key: key[1] == "topology")
+
+    def collect_topology(self):
+        """
+        并发地向所有已知的Server请求/server/topology，合并为一个拓扑文档。
+        在配置的topology_timeout秒内没有返回的Server，"nodes"为null，"error"为"timeout"。
+
+        :rtype: dict
+        """
+        deadline = self.config.topology_timeout
+        servers = self.known_servers.values()
+        jobs = [gevent.spawn(self.fetch_server_topology, server, deadline) for server in servers]
+        gevent.joinall(jobs, timeout=deadline)
+
+        result = []
+        for (server, job) in zip(servers, jobs):
+            server_dict = server.get_dict()
+            if job.successful():
+                server_dict["nodes"] = job.value
+                server_dict["error"] = None
+            else:
+                server_dict["nodes"] = None
+                server_dict["error"] = str(job.exception) if job.ready() else "timeout"
+                job.kill(block=False)
+            result.append(server_dict)
+        return {
+            "generated_time": time(),
+            "servers": result
+        }
+
+    def fetch_server_topology(self, server, deadline):
+        """
+        向一个Server请求/server/topology，返回它的Node列表。失败时抛出异常。
+
+        :param ServerInfo server: 目标Server
+        :param float deadline: 请求的超时时间（秒）
+        :rtype: list
+        """
+        server_response = self.http_client.get(server.addr, server.port, "/server/topology/%s" % server.id,
+                                               timeout=(deadline, deadline))
+        if server_response.status_code != 200:
+            raise ValueError("server returned HTTP %d" % server_response.status_code)
+        return loads(server_response.content)["nodes"]
 
     def refresh_server_alive(self, server_id):
         """
@@ -208,10 +492,7 @@ class Forwarder(object):
         :param basestring server_id: 要刷新的Server的ID
         """
 
-        server_to_refresh = self.find_server_by_id(server_id)
-        if isinstance(server_to_refresh, ServerInfo):
-            server_to_refresh.last_active_time = time()
-        else:
+        if not self.known_servers.refresh(server_id):
             logging.warning("[Forwarder.refresh_server_alive] cannot find server with server_id=%s to refresh." % server_id)
 
     # HTTP处理方法
@@ -234,14 +515,25 @@ class Forwarder(object):
         本方法处理由Server向上发送的报警数据（HTTP POST）。
         报警数据以Json格式，在POST的正文中。
         接到数据后，将向SocketIO的WarningNamespace发送广播，将报警推送给客户端。
+        广播只把报警放入每个连接的队列，不等待发送完成，因此请求会立即返回。
+        报警只被推送给订阅了对应Server、Node、传感器或server_desc路径的客户端，参见WarningNamespace。
         """
         warning_data = request.body.read()
 
-        # 向SocketIO的WarningNamespace发送广播
-        for connection in WarningNamespace.connections.values():
-            # 再次检查类型
-            if isinstance(connection, WarningNamespace):
-                connection.emit("warning", {"data": warning_data})
+        # 从报警数据中取出用于匹配订阅的主题。无法解析时向所有客户端推送
+        topic = None
+        try:
+            warning_json_obj = loads(warning_data)
+            server_id = warning_json_obj.get("server")
+            node_id = warning_json_obj.get("node_id") or (warning_json_obj.get("node") or {}).get("id")
+            server = self.find_server_by_id(server_id) if server_id is not None else None
+            topic = (server_id, node_id, warning_json_obj.get("sensor_id"), server.desc if server is not None else None)
+        except (ValueError, AttributeError) as e:
+            logging.debug("[Forwarder.post_warning_data] cannot parse topic of warning data: " + str(e))
+
+        # 保存到最近警报的缓冲区，并向SocketIO的WarningNamespace发送广播
+        WarningNamespace.replay.append(topic, warning_data)
+        WarningNamespace.broadcast("warning", {"data": warning_data}, topic)
 
     def server_method(self, request_method, server_id, other_ids=None):
         """
@@ -255,6 +547,15 @@ class Forwarder(object):
         :param request_method: URL中的<request_method>部分，是请求的操作类型。
         :param server_id: URL中的<server_id>部分，是请求的目标Server的ID。
         :param other_ids: URL中的<other_ids:path>部分，即URL结尾的其他所有部分。将原样转发给目标Server。
+
+        请求的URL（路径和查询参数）原样转发给Server。
+        请求和响应的正文都按块流式转发，不在Forwarder中缓存完整的正文，也不解码。
+        请求的Accept、Accept-Encoding和Content-Type头被转发给Server；
+        响应的状态码和Content-Type、Content-Encoding等头被原样转发回客户端，
+        因此客户端可以用Accept头要求二进制格式的传感器数据，参见pinic.sensor.sensordata。
+
+        配置的response_cache_ttls中的GET请求种类（如knownnodes）由cached_server_get处理，响应被缓存并带有ETag。
+        POST请求转发前和Server返回响应后，都按cache_invalidations删除同一个Server的相关缓存。
         """
 
         # 1. 在自身已知的Server列表中查找URL中给出的目标Server
@@ -262,30 +563,123 @@ class Forwarder(object):
         if server is None:
             return generate_500("Can't find server with server_id=%s in this forwarder." % server_id)
 
-        # 2. 根据请求URL构造要转发的新URL
-        if other_ids is None:
-            request_url = "http://%s:%d/server/%s/%s" % (server.addr, server.port, request_method, server_id)
-        else:
-            request_url = "http://%s:%d/server/%s/%s/%s" % (server.addr, server.port, request_method, server_id, other_ids)
+        # 2. 转发给Server的URL与请求的URL相同，包括路径和查询参数
+        request_path = request.path
+        if request.query_string:
+            request_path += "?" + request.query_string
+
+        # 3. 转发新的请求给Server。请求正文以文件对象的形式交给requests，由它分块读取和发送
+        headers = {}
+        for header in Forwarder.proxy_request_headers:
+            if request.headers.get(header) is not None:
+                headers[header] = request.headers.get(header)
+        # 不转发时requests会自动要求gzip，而响应不被解码，客户端可能无法处理
+        headers.setdefault("Accept-Encoding", "identity")
+
+        if (request.method == "GET") and (self.config.response_cache_ttls.get(request_method, 0) > 0):
+            return self.cached_server_get(server, request_method, request_path, headers)
+        invalidated_methods = Forwarder.cache_invalidations.get(request_method, (request_method,))
+
+        def invalidate_cache():
+            self.response_cache.invalidate(lambda key: (key[0] == server_id) and (key[1] in invalidated_methods))
 
-        # 3. 转发新的请求给Server
+        timeout = (self.config.server_connect_timeout, self.config.server_read_timeout)
         try:
             if request.method == "POST":
-                greq = grequests.post(request_url, data=request.body.read())
+                invalidate_cache()
+                server_response = self.http_client.post(server.addr, server.port, request_path,
+                                                        data=request.body, headers=headers, stream=True, timeout=timeout)
             else:
-                greq = grequests.get(request_url)
-            response = greq.send()
+                server_response = self.http_client.get(server.addr, server.port, request_path,
+                                                       headers=headers, stream=True, timeout=timeout)
+        except RequestException as e:
+            return generate_500("Error on curling to server.", e)
+        finally:
+            # Server返回响应时已经应用了POST。在此期间开始的GET请求可能取得并缓存了修改前的数据，再删除一次
+            if request.method == "POST":
+                invalidate_cache()
+
+        # 4. 将从Server获得的响应原样转发回客户端，包括错误
+        response.status = server_response.status_code
+        for header in Forwarder.proxy_response_headers:
+            value = server_response.headers.get(header)
+            if value is not None:
+                response.set_header(header, value)
+        return self.stream_server_response(server_response)
+
+    def cached_server_get(self, server, request_method, request_path, headers):
+        """
+        转发一个可缓存的GET请求给Server，返回缓存或新获取的响应。
+        缓存的键包括Server的ID、请求种类、路径（含查询参数）和影响响应内容的请求头。
+        响应带有ETag；请求的If-None-Match与之相符时，返回空的HTTP 304。
+
+        :param ServerInfo server: 目标Server
+        :param str request_method: 请求种类，即URL中/server/之后的部分
+        :param str request_path: 转发给Server的路径，包括查询参数
+        :param dict headers: 转发给Server的请求头
+        """
+
+        def fetch():
+            server_response = self.http_client.get(server.addr, server.port, request_path, headers=headers,
+                                                   timeout=(self.config.server_connect_timeout, self.config.server_read_timeout))
+            response_headers = {}
+            for header in Forwarder.proxy_response_headers:
+                value = server_response.headers.get(header)
+                if value is not None:
+                    response_headers[header] = value
+            return CachedResponse(server_response.status_code, response_headers, server_response.content)
+
+        # 键的前两项为Server的ID和请求种类，invalidate时据此匹配
+        key = (server.id, request_method, request_path, headers.get("Accept"), headers.get("Accept-Encoding"))
+        try:
+            cached_response = self.response_cache.get(key, self.config.response_cache_ttls[request_method], fetch)
         except RequestException as e:
             return generate_500("Error on curling to server.", e)
 
-        # 4. 将从Server获得的响应转发回客户端，包括错误
-        http_code = response.status_code
-        if http_code == 500:
-            return generate_500("Curling to server get 500. Response: %s", response.text)
-        elif http_code == 200:
-            return response.text
-        else:
-            return generate_500("Got unknown HTTP code: %d response: %s" % (http_code, response.text))
+        return self.send_cached_response(cached_response)
+
+    def send_cached_response(self, cached_response):
+        """
+        把缓存的响应返回给客户端。状态码为200的响应带有ETag；请求的If-None-Match与之相符时，返回空的HTTP 304。
+
+        :param CachedResponse cached_response: 缓存的响应
+        """
+        if cached_response.status != 200:
+            response.status = cached_response.status
+            for (header, value) in cached_response.headers.items():
+                response.set_header(header, value)
+            return cached_response.body
+
+        # 浏览器可以缓存响应，但每次使用前需要用If-None-Match向Forwarder确认
+        response.set_header("ETag", cached_response.etag)
+        response.set_header("Cache-Control", "no-cache")
+        if cached_response.matches(request.headers.get("If-None-Match")):
+            response.status = 304
+            return ""
+        for (header, value) in cached_response.headers.items():
+            if header != "Cache-Control":
+                response.set_header(header, value)
+        return cached_response.body
+
+    def stream_server_response(self, server_response):
+        """
+        按块读取Server的响应正文并逐块返回，不解码Content-Encoding。
+        正文读完或客户端断开（生成器被关闭）时关闭响应。读完的连接回到连接池，中途关闭的连接被丢弃。
+
+        :param requests.Response server_response: 以stream=True发出的请求的响应
+        """
+        self.active_proxies += 1
+        try:
+            for chunk in server_response.raw.stream(Forwarder.proxy_chunk_size, decode_content=False):
+                self.proxied_bytes += len(chunk)
+                yield chunk
+        except Exception as e:
+            # 响应头已经发出，无法再返回HTTP 500，只能中断连接
+            logging.warning("[Forwarder.stream_server_response] error on streaming response from server: " + str(e))
+            raise
+        finally:
+            self.active_proxies -= 1
+            server_response.close()
 
     def post_reg_server(self):
         """
@@ -332,6 +726,34 @@ class Forwarder(object):
         self.remove_known_server(server_id)
         return
 
+    def get_topology(self):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法返回所有已知的Server、它们的Node和各Node的传感器组成的拓扑文档，以Json形式返回。
+        Forwarder并发地向每个Server请求/server/topology，最多等待配置的topology_timeout秒。
+        文档被缓存topology_cache_ttl秒，并在Server或Node注册、解除注册时失效。响应带有ETag。
+        """
+
+        def fetch():
+            return CachedResponse(200, {"Content-Type": "application/json"}, dumps(self.collect_topology()))
+
+        cached_response = self.response_cache.get((None, "topology"), self.config.topology_cache_ttl, fetch)
+        return self.send_cached_response(cached_response)
+
+    def post_topology_changed(self, server_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法处理Server发送的拓扑变化通知（HTTP POST）。Server在Node注册、解除注册或超时时发送。
+        收到后，缓存的拓扑文档失效。
+
+        :param server_id: URL中的<server_id>部分，是发送通知的Server的ID。
+        """
+        logging.debug("[Forwarder.post_topology_changed] topology of server_id=%s changed" % server_id)
+        self.invalidate_topology()
+        return
+
     def get_keep_server(self, server_id):
         """
         处理HTTP URL，参见start_bottle方法的注释。
@@ -396,18 +818,36 @@ class Forwarder(object):
 
         result = []
 
-        for s in self.known_servers:
+        for s in self.known_servers.values():
             # 调用每个ServerInfo的get_dict方法，将ServerInfo的信息转换为字典，以供返回
             result.append(s.get_dict())
 
         # dumps是json.dumps，将result列表转换为Json字符串
         return dumps(result)
 
+    def get_stats(self):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法返回Forwarder的运行统计信息，以Json形式返回。目前包括HTTP客户端各对端的连接池使用情况，以及转发响应的统计。
+        """
+
+        return dumps({
+            "http_client": self.http_client.get_stats(),
+            "response_cache": self.response_cache.get_stats(),
+            "warnings": WarningNamespace.get_stats(),
+            "listener": self.listener.get_stats(),
+            "proxy": {
+                "active": self.active_proxies,
+                "bytes": self.proxied_bytes
+            }
+        })
+
 
 class ServerMonitor(threading.Thread):
     """
     ServerMonitor线程。已经被gevent monkey_patch成为greenlet。
-    以一定间隔检查已知的Server列表，如果发现其中的Server超过一段时间（30秒）没有发送心跳请求，
+    以一定间隔检查已知的Server列表，如果发现其中的Server超过一段时间（配置中的server_live_interval）没有发送心跳请求，
     则将其从Forwarder的已知Server列表中删除。
     """
 
@@ -422,23 +862,21 @@ class ServerMonitor(threading.Thread):
 
         self.forwarder = forwarder  # 开启这个线程的Forwarder对象
 
-        self.max_live_interval = 30.0  # Server不发送心跳请求后的最大存活时间
-
-        self.check_interval = 10.0  # 执行检查的时间间隔
-
         self.stop_event = threading.Event()  # 本线程的停止事件。使用stop_event.set()可停止本线程，但更推荐使用ServerMonitor.stop()方法
 
     def run(self):
         """
         线程执行入口方法。
-        间隔check_interval秒进行一次检查，删除太久没有发送心跳请求的Server。
+        间隔配置中的server_check_interval秒进行一次检查，删除超过server_live_interval秒没有发送心跳请求的Server。
+        两个间隔在每次检查时从Forwarder的当前配置读取。
         """
 
-        while not self.stop_event.wait(self.check_interval):
+        while not self.stop_event.wait(self.forwarder.config.server_check_interval):
             logging.debug("[ServerMonitor.run] checking %d known servers." % len(self.forwarder.known_servers))
-            for s in self.forwarder.known_servers:
-                if time() - s.last_active_time > self.max_live_interval:
-                    self.forwarder.remove_known_server(s.id)
+            for s in self.forwarder.known_servers.pop_expired(self.forwarder.config.server_live_interval):
+                logging.debug("[ServerMonitor.run] server_id=%s expired" % s.id)
+                self.forwarder.http_client.forget_peer(s.addr, s.port)
+                self.forwarder.response_cache.invalidate(lambda key, server_id=s.id: (key[0] == server_id) or (key[1] == "topology"))
             logging.debug("[ServerMonitor.run] done. remain: %d known servers." % len(self.forwarder.known_servers))
 
     def stop(self):
@@ -0,0 +1,195 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Forwarder的响应缓存ResponseCache。
+
+浏览器中的监控页面会反复通过Forwarder请求Server的已知Node列表、Server配置和Node配置。
+这些请求原本每次都被转发给Server，有的还会再被Server转发给Node。
+ResponseCache在Forwarder上缓存这些GET请求的响应，在各请求种类的ttl秒内直接返回缓存的响应。
+
+* 缓存响应正文的总字节数不超过max_bytes，超出时删除最久未使用的条目（LRU）。
+
+* 单飞（single-flight）：同一个键的缓存失效时，只有第一个请求会被转发给Server，同时到达的其他请求等待这次请求的结果。
+
+* 对应的POST请求（例如修改配置）经过Forwarder时，使用ResponseCache.invalidate(match)删除受影响的条目。
+  正在进行的请求如果开始于删除之前，它的结果不会被缓存，以免缓存修改前的旧数据。
+
+* 每个缓存的响应带有根据正文计算的ETag，Forwarder用它回应浏览器的If-None-Match请求。
+
+* 要读取缓存，使用ResponseCache.get(key, ttl, fetch)。要获取命中率等统计信息，使用ResponseCache.get_stats()。
+"""
+
+__author__ = "tgmerge"
+
+
+from gevent.event import AsyncResult
+from collections import OrderedDict
+from hashlib import sha1
+from time import time
+
+
+class CachedResponse(object):
+    """
+    一份缓存的响应。
+    """
+
+    __slots__ = ("status", "headers", "body", "etag")
+
+    def __init__(self, status, headers, body):
+        """
+        :param int status: 响应的状态码
+        :param dict headers: 要转发给客户端的响应头
+        :param str body: 响应的正文
+        """
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = '"%s"' % sha1(body).hexdigest()
+
+    def matches(self, if_none_match):
+        """
+        判断请求的If-None-Match头是否与本响应的ETag相符。
+
+        :param str if_none_match: 请求的If-None-Match头，可以为None
+        :rtype: bool
+        """
+        if if_none_match is None:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if (tag == "*") or (tag == self.etag):
+                return True
+        return False
+
+
+class ResponseCache(object):
+    """
+    带有TTL、按字节数的LRU上限和单飞合并的缓存。所有方法都在一个greenlet中完成，除等待其他请求的结果外不会让出执行权。
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param int max_bytes: 缓存的响应正文的最大总字节数
+        """
+        self.max_bytes = max_bytes
+        self.total_bytes = 0  # 缓存的响应正文的总字节数
+        self.entries = OrderedDict()  # 类型：OrderedDict，键 -> (过期时间, CachedResponse)，按最近使用排序
+        self.in_flight = {}  # 类型：dict，键 -> AsyncResult，正在向Server请求的键
+        self.generation = 0  # 每次invalidate后加1，用于判断正在进行的请求是否开始于invalidate之前
+
+        # 统计信息
+        self.hits = 0  # 命中缓存的请求数
+        self.misses = 0  # 未命中、被转发的请求数
+        self.coalesced = 0  # 未命中、但与正在进行的请求合并的请求数
+        self.evictions = 0  # 因超过max_bytes而删除的条目数
+        self.invalidations = 0  # 因invalidate而删除的条目数
+
+    def get(self, key, ttl, fetch):
+        """
+        返回键key对应的CachedResponse。缓存中没有有效的响应时，调用fetch()获取。
+        fetch()返回CachedResponse，状态码为200的响应才被缓存。fetch()抛出的异常会传给所有等待的请求。
+
+        :param key: 缓存的键，需要可哈希
+        :param float ttl: 新获取的响应的有效时间（秒）
+        :param fetch: 获取响应的函数
+        :rtype: CachedResponse
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time():
+                self.hits += 1
+                # 移到末尾，表示最近使用
+                del self.entries[key]
+                self.entries[key] = entry
+                return entry[1]
+            self.remove(key)
+
+        # 已经有相同的请求正在进行，等待它的结果
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.get()
+
+        self.misses += 1
+        pending = AsyncResult()
+        self.in_flight[key] = pending
+        generation = self.generation
+        try:
+            cached_response = fetch()
+        except BaseException as e:
+            # fetch所在的greenlet被杀死（GreenletExit）时也要唤醒等待的请求，否则它们会一直等待。
+            # 等待的请求收到普通的异常，由Bottle返回HTTP 500
+            pending.set_exception(e if isinstance(e, Exception) else RuntimeError("fetch was interrupted: %r" % e))
+            raise
+        else:
+            if (cached_response.status == 200) and (generation == self.generation):
+                self.put(key, cached_response, time() + ttl)
+            pending.set(cached_response)
+            return cached_response
+        finally:
+            del self.in_flight[key]
+
+    def put(self, key, cached_response, expire_time):
+        """
+        添加一个条目。正文的总字节数超过max_bytes时删除最久未使用的条目。正文本身超过max_bytes时不缓存。
+        """
+        self.remove(key)
+        if len(cached_response.body) > self.max_bytes:
+            return
+        self.entries[key] = (expire_time, cached_response)
+        self.total_bytes += len(cached_response.body)
+        self.shrink()
+
+    def remove(self, key):
+        """
+        删除一个条目。条目不存在时什么也不做。
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1].body)
+
+    def shrink(self):
+        """
+        删除最久未使用的条目，直到正文的总字节数不超过max_bytes。
+        """
+        while self.total_bytes > self.max_bytes:
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= len(entry[1].body)
+            self.evictions += 1
+
+    def invalidate(self, match):
+        """
+        删除所有键满足match(key)的条目。此时正在进行的请求的结果也不会被缓存。
+
+        :param match: 判断键的函数
+        """
+        self.generation += 1
+        for key in [k for k in self.entries if match(k)]:
+            self.remove(key)
+            self.invalidations += 1
+
+    def resize(self, max_bytes):
+        """
+        更改正文总字节数的上限，例如在应用新配置时。
+        """
+        self.max_bytes = max_bytes
+        self.shrink()
+
+    def get_stats(self):
+        """
+        以dict的形式返回缓存的统计信息。
+
+        :rtype: dict
+        """
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
@@ -16,6 +16,24 @@ ForwarderConfig配置类用于解析和封装Forwarder的配置。
         "forwarder_port": 9005,                   # Forwarder的服务端口
         "forwarder_id": "TEST-FORWARDER-1",       # Forwarder ID
         "forwarder_desc": "Test forwarder.",      # Forwarder的描述文字
+
+        "response_cache_ttls": {                  # 可选。转发的Server GET请求的响应缓存时间（秒），键为URL中/server/之后的请求种类。
+            "knownnodes": 2.0,                    #       不在其中或为0的请求种类不缓存。默认为示例中的值
+            "serverconfig": 10.0,
+            "nodeconfig": 10.0
+        },
+        "response_cache_max_bytes": 1048576,      # 可选。缓存的响应正文的最大总字节数。默认为1048576
+        "warning_queue_size": 64,                 # 可选。推送警报时，每个客户端连接最多缓存的警报数。默认为64
+        "warning_queue_policy": "drop_oldest",    # 可选。客户端的警报缓存已满时，"drop_oldest"为丢弃最旧的警报，"disconnect"为断开连接。默认为"drop_oldest"
+        "warning_replay_size": 256,               # 可选。Forwarder保存的最近警报数。默认为256
+        "warning_replay_count": 20,               # 可选。客户端连接时，最多发送给它的最近警报数。为0时不发送。默认为20
+        "warning_replay_seconds": 300,            # 可选。客户端连接时，只发送最近多少秒内的警报。默认为300
+        "topology_timeout": 3.0,                  # 可选。生成拓扑文档时，等待各Server返回的最长时间（秒）。默认为3.0
+        "topology_cache_ttl": 5.0,                # 可选。拓扑文档的缓存时间（秒），Server或Node注册、解除注册时提前失效。默认为5.0
+        "server_check_interval": 10.0,            # 可选。检查Server是否存活的间隔（秒）。默认为10.0
+        "server_live_interval": 30.0,             # 可选。Server超过这个时间（秒）没有发送心跳请求，即被删除。默认为30.0
+        "server_connect_timeout": 3.0,            # 可选。向Server转发请求时，建立连接的超时时间（秒）。默认为3.0
+        "server_read_timeout": 10.0               # 可选。向Server转发请求时，读取响应的超时时间（秒）。默认为10.0
     }
 
 """
@@ -43,6 +61,24 @@ class ForwarderConfig(object):
         ("forwarder_desc", basestring)
     ]
 
+    # 用于在Json解析中，检查配置的第一级可选键值是否有误。
+    # 每项为(键, 类型, 默认值)，缺失的可选键将被设置为默认值。
+    first_level_optional_check = [
+        ("response_cache_ttls", dict, {"knownnodes": 2.0, "serverconfig": 10.0, "nodeconfig": 10.0}),
+        ("response_cache_max_bytes", int, 1048576),
+        ("warning_queue_size", int, 64),
+        ("warning_queue_policy", basestring, "drop_oldest"),
+        ("warning_replay_size", int, 256),
+        ("warning_replay_count", int, 20),
+        ("warning_replay_seconds", (int, float), 300.0),
+        ("topology_timeout", (int, float), 3.0),
+        ("topology_cache_ttl", (int, float), 5.0),
+        ("server_check_interval", (int, float), 10.0),
+        ("server_live_interval", (int, float), 30.0),
+        ("server_connect_timeout", (int, float), 3.0),
+        ("server_read_timeout", (int, float), 10.0)
+    ]
+
     def __init__(self, config_dict):
         """
         :param dict config_dict: 初始化用字典。用字典的对应键设置本ForwarderConfig对象的各个成员变量。
@@ -55,6 +91,32 @@ class ForwarderConfig(object):
 
         self.forwarder_desc = config_dict["forwarder_desc"]  # 配置的forwarder_desc值
 
+        self.response_cache_ttls = config_dict["response_cache_ttls"]  # 配置的response_cache_ttls值
+
+        self.response_cache_max_bytes = config_dict["response_cache_max_bytes"]  # 配置的response_cache_max_bytes值
+
+        self.warning_queue_size = config_dict["warning_queue_size"]  # 配置的warning_queue_size值
+
+        self.warning_queue_policy = config_dict["warning_queue_policy"]  # 配置的warning_queue_policy值
+
+        self.warning_replay_size = config_dict["warning_replay_size"]  # 配置的warning_replay_size值
+
+        self.warning_replay_count = config_dict["warning_replay_count"]  # 配置的warning_replay_count值
+
+        self.warning_replay_seconds = config_dict["warning_replay_seconds"]  # 配置的warning_replay_seconds值
+
+        self.topology_timeout = config_dict["topology_timeout"]  # 配置的topology_timeout值
+
+        self.topology_cache_ttl = config_dict["topology_cache_ttl"]  # 配置的topology_cache_ttl值
+
+        self.server_check_interval = config_dict["server_check_interval"]  # 配置的server_check_interval值
+
+        self.server_live_interval = config_dict["server_live_interval"]  # 配置的server_live_interval值
+
+        self.server_connect_timeout = config_dict["server_connect_timeout"]  # 配置的server_connect_timeout值
+
+        self.server_read_timeout = config_dict["server_read_timeout"]  # 配置的server_read_timeout值
+
     def get_json_string(self):
         """
         返回一个字符串，是本配置对象的Json数据。
@@ -67,7 +129,20 @@ class ForwarderConfig(object):
             "forwarder_host": self.forwarder_host,
             "forwarder_port": self.forwarder_port,
             "forwarder_id": self.forwarder_id,
-            "forwarder_desc": self.forwarder_desc
+            "forwarder_desc": self.forwarder_desc,
+            "response_cache_ttls": self.response_cache_ttls,
+            "response_cache_max_bytes": self.response_cache_max_bytes,
+            "warning_queue_size": self.warning_queue_size,
+            "warning_queue_policy": self.warning_queue_policy,
+            "warning_replay_size": self.warning_replay_size,
+            "warning_replay_count": self.warning_replay_count,
+            "warning_replay_seconds": self.warning_replay_seconds,
+            "topology_timeout": self.topology_timeout,
+            "topology_cache_ttl": self.topology_cache_ttl,
+            "server_check_interval": self.server_check_interval,
+            "server_live_interval": self.server_live_interval,
+            "server_connect_timeout": self.server_connect_timeout,
+            "server_read_timeout": self.server_read_timeout
         })
 
 
@@ -96,6 +171,37 @@ def parse_from_string(config_json):
         if not isinstance(config[key], val_type):
             raise ValueError("value of key '%s' is not a '%s' instance." % (key, str(val_type)))
 
+    # 检查第一级可选变量
+    for (key, val_type, default_val) in ForwarderConfig.first_level_optional_check:
+        if key not in config:
+            config[key] = default_val
+        elif not isinstance(config[key], val_type):
+            raise ValueError("value of key '%s' is not a '%s' instance." % (key, str(val_type)))
+
+    config["response_cache_ttls"] = dict(config["response_cache_ttls"])
+    for ttl in config["response_cache_ttls"].values():
+        if (not isinstance(ttl, (int, float))) or (ttl < 0):
+            raise ValueError("values of key 'response_cache_ttls' must be non-negative numbers.")
+    if config["response_cache_max_bytes"] <= 0:
+        raise ValueError("value of key 'response_cache_max_bytes' must be positive.")
+    if config["warning_queue_size"] <= 0:
+        raise ValueError("value of key 'warning_queue_size' must be positive.")
+    if config["warning_queue_policy"] not in ("drop_oldest", "disconnect"):
+        raise ValueError("value of key 'warning_queue_policy' must be 'drop_oldest' or 'disconnect'.")
+    if config["warning_replay_size"] <= 0:
+        raise ValueError("value of key 'warning_replay_size' must be positive.")
+    if config["warning_replay_count"] < 0:
+        raise ValueError("value of key 'warning_replay_count' must not be negative.")
+    if config["warning_replay_seconds"] <= 0:
+        raise ValueError("value of key 'warning_replay_seconds' must be positive.")
+    if config["topology_timeout"] <= 0:
+        raise ValueError("value of key 'topology_timeout' must be positive.")
+    if config["topology_cache_ttl"] < 0:
+        raise ValueError("value of key 'topology_cache_ttl' must not be negative.")
+    for key in ("server_check_interval", "server_live_interval", "server_connect_timeout", "server_read_timeout"):
+        if config[key] <= 0:
+            raise ValueError("value of key '%s' must be positive." % key)
+
     logging.debug("[parse_from_string] first level item checked")
 
     # 返回解析后的对象
@@ -0,0 +1,173 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Forwarder推送警报时所用的订阅索引SubscriptionIndex。
+
+浏览器中的客户端通常只关心一个地点（Server的server_desc路径）或少数几个传感器。
+客户端可以订阅以下四种主题，Forwarder只把匹配的警报推送给它：
+
+* "servers"：Server的ID
+
+* "nodes"：Node的ID
+
+* "sensors"：传感器的ID
+
+* "paths"：server_desc路径的前缀，例如"地区A"匹配"地区A/地点1"和"地区A/地点2"。路径按"/"分段，只匹配完整的段
+
+没有订阅任何主题的客户端接收所有警报。
+
+索引为每种主题保存“主题的值 -> 订阅者的集合”，查找一份警报的订阅者时，只需查找警报的ID和路径的各级前缀，
+不需要遍历所有的客户端。
+
+* 要订阅或退订，使用SubscriptionIndex.subscribe(key, topics)和SubscriptionIndex.unsubscribe(key, topics)。
+
+* 要查找一份警报的订阅者，使用SubscriptionIndex.match(server_id, node_id, sensor_id, server_desc)。
+"""
+
+__author__ = "tgmerge"
+
+
+topic_kinds = ("servers", "nodes", "sensors", "paths")
+
+
+def normalize_path(path):
+    """
+    规范化server_desc路径：去掉首尾和重复的"/"。
+
+    :param basestring path: 路径
+    :rtype: basestring
+    """
+    return "/".join(x for x in path.split("/") if x)
+
+
+def path_prefixes(path):
+    """
+    返回路径的各级前缀，例如"a/b/c"的前缀为"a"、"a/b"、"a/b/c"。
+
+    :param basestring path: 路径
+    :rtype: list
+    """
+    parts = [x for x in path.split("/") if x]
+    return ["/".join(parts[:n]) for n in xrange(1, len(parts) + 1)]
+
+
+def parse_topics(topics):
+    """
+    检查客户端发送的主题，返回主题种类 -> 值的set的dict。格式错误时抛出ValueError。
+
+    :param dict topics: 主题，例如{"servers": ["TEST-SERVER-1"], "paths": ["地区A"]}
+    :rtype: dict
+    """
+    if not isinstance(topics, dict):
+        raise ValueError("topics must be a dict.")
+    result = {}
+    for (kind, values) in topics.items():
+        if kind not in topic_kinds:
+            raise ValueError("unknown topic kind '%s'." % kind)
+        if (not isinstance(values, list)) or (not all(isinstance(x, basestring) for x in values)):
+            raise ValueError("topics of kind '%s' must be a list of strings." % kind)
+        if kind == "paths":
+            values = [normalize_path(x) for x in values]
+        result[kind] = set(values)
+    return result
+
+
+class SubscriptionIndex(object):
+    """
+    订阅者和主题的双向索引。订阅者用可哈希的键表示，例如连接对象的id。
+    """
+
+    def __init__(self):
+        self.index = dict((kind, {}) for kind in topic_kinds)  # 主题种类 -> (值 -> 订阅者的键的set)
+        self.topics = {}  # 订阅者的键 -> (主题种类 -> 值的set)，只含订阅了主题的订阅者
+        self.wildcard = set()  # 没有订阅任何主题、接收所有警报的订阅者的键
+
+    def __len__(self):
+        return len(self.topics) + len(self.wildcard)
+
+    def add(self, key):
+        """
+        添加一个尚未订阅任何主题的订阅者。
+        """
+        if key not in self.topics:
+            self.wildcard.add(key)
+
+    def remove(self, key):
+        """
+        删除一个订阅者和它的所有主题。订阅者不存在时什么也不做。
+        """
+        self.wildcard.discard(key)
+        for (kind, values) in self.topics.pop(key, {}).items():
+            for value in values:
+                self.remove_from_index(kind, value, key)
+
+    def remove_from_index(self, kind, value, key):
+        subscribers = self.index[kind].get(value)
+        if subscribers is not None:
+            subscribers.discard(key)
+            if not subscribers:
+                del self.index[kind][value]
+
+    def subscribe(self, key, topics):
+        """
+        为订阅者增加主题。
+
+        :param key: 订阅者的键
+        :param dict topics: parse_topics返回的主题
+        """
+        subscribed = self.topics.setdefault(key, dict((kind, set()) for kind in topic_kinds))
+        for (kind, values) in topics.items():
+            for value in values:
+                subscribed[kind].add(value)
+                self.index[kind].setdefault(value, set()).add(key)
+        if any(subscribed.values()):
+            self.wildcard.discard(key)
+        else:
+            del self.topics[key]
+            self.wildcard.add(key)
+
+    def unsubscribe(self, key, topics):
+        """
+        为订阅者删除主题。删除后不再订阅任何主题的订阅者接收所有警报。
+
+        :param key: 订阅者的键
+        :param dict topics: parse_topics返回的主题
+        """
+        subscribed = self.topics.get(key)
+        if subscribed is None:
+            return
+        for (kind, values) in topics.items():
+            for value in values & subscribed[kind]:
+                subscribed[kind].discard(value)
+                self.remove_from_index(kind, value, key)
+        if not any(subscribed.values()):
+            del self.topics[key]
+            self.wildcard.add(key)
+
+    def get_topics(self, key):
+        """
+        返回订阅者当前订阅的主题，主题种类 -> 值的list。
+
+        :rtype: dict
+        """
+        subscribed = self.topics.get(key, {})
+        return dict((kind, sorted(subscribed.get(kind, ()))) for kind in topic_kinds)
+
+    def match(self, server_id, node_id, sensor_id, server_desc):
+        """
+        返回应当接收一份警报的订阅者的键的set。参数可以为None，表示警报中没有这项信息。
+
+        :param basestring server_id: 产生警报的Server的ID
+        :param basestring node_id: 产生警报的Node的ID
+        :param basestring sensor_id: 产生警报的传感器的ID
+        :param basestring server_desc: 产生警报的Server的描述（路径）
+        :rtype: set
+        """
+        result = set(self.wildcard)
+        for (kind, value) in (("servers", server_id), ("nodes", node_id), ("sensors", sensor_id)):
+            if value is not None:
+                result.update(self.index[kind].get(value, ()))
+        if server_desc is not None:
+            for prefix in path_prefixes(server_desc):
+                result.update(self.index["paths"].get(prefix, ()))
+        return result
@@ -0,0 +1,118 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Forwarder的最近警报缓冲区WarningReplayBuffer。
+
+浏览器中的客户端连接到Socket.IO的/warning端点后，原本要等到下一份警报才能收到数据，
+只好轮询其他接口（如knownnodes、sensordata）来重建页面的状态。Forwarder重启后，大量客户端同时重连，
+这些轮询会集中到达。
+
+WarningReplayBuffer保存最近的capacity份警报，并按Server、Node、传感器的ID和server_desc路径的各级前缀索引。
+客户端连接时，Forwarder从中取出与它的订阅匹配的最近若干份警报，作为一帧一次发送。
+
+* 要添加一份警报，使用WarningReplayBuffer.append(topic, data)。
+
+* 要取出与订阅匹配的最近的警报，使用WarningReplayBuffer.query(topics, count, seconds)。
+"""
+
+__author__ = "tgmerge"
+
+
+from pinic.forwarder.subscription import path_prefixes
+
+from collections import deque
+from time import time
+
+
+class WarningReplayBuffer(object):
+    """
+    有界的最近警报缓冲区，带有按主题的索引。
+    """
+
+    def __init__(self, capacity):
+        """
+        :param int capacity: 最多保存的警报数，超出时删除最旧的警报
+        """
+        self.capacity = capacity
+        self.entries = deque()  # 类型：deque of tuple，(序号, 接收时间, 索引的(主题种类, 值)的list, 警报数据)，按序号排序
+        self.index = {}  # 类型：dict，(主题种类, 值) -> 该主题的警报的deque，按序号排序
+        self.next_seq = 0  # 下一份警报的序号
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, topic, data):
+        """
+        添加一份警报。
+
+        :param tuple topic: 警报的主题，(server_id, node_id, sensor_id, server_desc)，各项可以为None。为None时不索引
+        :param data: 警报数据
+        """
+        keys = []
+        if topic is not None:
+            server_id, node_id, sensor_id, server_desc = topic
+            for (kind, value) in (("servers", server_id), ("nodes", node_id), ("sensors", sensor_id)):
+                if value is not None:
+                    keys.append((kind, value))
+            if server_desc is not None:
+                keys.extend(("paths", prefix) for prefix in path_prefixes(server_desc))
+
+        entry = (self.next_seq, time(), keys, data)
+        self.next_seq += 1
+        self.entries.append(entry)
+        for key in keys:
+            self.index.setdefault(key, deque()).append(entry)
+
+        self.shrink()
+
+    def shrink(self):
+        """
+        删除最旧的警报，直到警报数不超过capacity。被删除的警报也是它所在的各个索引中最旧的一项。
+        """
+        while len(self.entries) > self.capacity:
+            entry = self.entries.popleft()
+            for key in entry[2]:
+                indexed = self.index[key]
+                indexed.popleft()
+                if not indexed:
+                    del self.index[key]
+
+    def resize(self, capacity):
+        """
+        更改最多保存的警报数，例如在应用新配置时。
+        """
+        self.capacity = capacity
+        self.shrink()
+
+    def query(self, topics, count, seconds):
+        """
+        返回与订阅匹配的最近的警报数据的list，按接收的顺序排列。
+        只返回最近seconds秒内的警报，且最多返回最近的count份。
+
+        :param dict topics: 订阅的主题，主题种类 -> 值的集合（参见subscription模块）。为None时匹配所有警报
+        :param int count: 最多返回的警报数
+        :param float seconds: 只返回最近多少秒内的警报
+        :rtype: list
+        """
+        if count <= 0:
+            return []
+        oldest_time = time() - seconds
+
+        if topics is None:
+            candidates = self.entries
+        else:
+            # 从各个主题的索引中收集候选的警报，按序号去重
+            matched = {}
+            for (kind, values) in topics.items():
+                for value in values:
+                    for entry in self.index.get((kind, value), ()):
+                        matched[entry[0]] = entry
+            candidates = [matched[seq] for seq in sorted(matched)]
+
+        result = []
+        for entry in reversed(candidates):
+            if (entry[1] < oldest_time) or (len(result) >= count):
+                break
+            result.append(entry[3])
+        result.reverse()
+        return result
@@ -0,0 +1,258 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含系统各部分（Node、Server、Forwarder）之间互相发送HTTP请求所用的客户端。
+
+HttpClient为每一个对端（地址和端口）保持一个requests.Session，Session内的HTTPAdapter维护一个长连接池，
+向同一个对端的请求会复用已经建立的TCP连接，不必每次重新握手。
+
+* 每个请求都带有超时，默认值在创建HttpClient时给出，也可以在调用时用timeout参数覆盖。
+
+* 连接失败时会重试。GET请求在连接或读取失败时均可重试；POST请求只在连接超时（请求尚未发出）时重试。
+  重试受重试预算限制：每个请求向预算存入retry_ratio个令牌，每次重试消耗一个令牌，
+  这样在对端故障时重试的数量不会超过正常请求的一定比例。
+
+* 要获取连接池的使用情况，使用HttpClient.get_stats()。
+"""
+
+__author__ = "tgmerge"
+
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+
+from collections import OrderedDict
+import threading
+import logging
+
+
+class RetryBudget(object):
+    """
+    重试预算。每个请求存入ratio个令牌，每次重试取出一个令牌，令牌数不超过max_tokens。
+    """
+
+    def __init__(self, ratio, max_tokens):
+        """
+        :param float ratio: 每个请求存入的令牌数，即允许的重试数占请求数的比例
+        :param float max_tokens: 令牌数的上限，也是初始的令牌数
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        """
+        为一个请求存入令牌。
+        """
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        为一次重试取出一个令牌。令牌不足时返回False，表示不允许重试。
+
+        :rtype: bool
+        """
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class PeerClient(object):
+    """
+    对一个对端（地址和端口）的HTTP客户端。内含一个requests.Session和它的连接池，以及请求的统计信息。
+    """
+
+    def __init__(self, addr, port, pool_maxsize, timeout, max_retries, retry_budget):
+        """
+        :param basestring addr: 对端的地址
+        :param int port: 对端的端口
+        :param int pool_maxsize: 连接池中保持的最大连接数
+        :param tuple timeout: 默认的超时时间，(连接超时, 读取超时)，单位为秒
+        :param int max_retries: 一个请求最多的重试次数
+        :param RetryBudget retry_budget: 重试预算
+        """
+        self.addr = addr
+        self.port = port
+        self.base_url = "http://%s:%d" % (addr, port)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session = Session()
+        self.session.mount("http://", self.adapter)
+
+        # 统计信息
+        self.requests = 0  # 发出的请求数（不含重试）
+        self.retries = 0  # 重试次数
+        self.retries_denied = 0  # 因重试预算不足而放弃的重试次数
+        self.timeouts = 0  # 最终超时的请求数
+        self.failures = 0  # 最终因其他连接错误失败的请求数
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """
+        向对端发送一个请求，返回requests.Response对象。
+        请求最终失败时，抛出requests.exceptions.RequestException。
+
+        :param str method: HTTP方法，如"GET"、"POST"
+        :param str path: 请求的路径，如"/server/regnode"
+        :param tuple timeout: 超时时间，(连接超时, 读取超时)。默认为创建时给出的值
+        :rtype: requests.Response
+        """
+        if timeout is None:
+            timeout = self.timeout
+        url = self.base_url + path
+
+        self.requests += 1
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return self.session.request(method, url, timeout=timeout, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                if not self.should_retry(method, e, attempt):
+                    if isinstance(e, Timeout):
+                        self.timeouts += 1
+                    else:
+                        self.failures += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                logging.debug("[PeerClient.request] retrying %s %s (attempt %d), err: %s" % (method, url, attempt, str(e)))
+
+    def should_retry(self, method, err, attempt):
+        """
+        判断一个失败的请求是否可以重试。
+
+        :rtype: bool
+        """
+        if attempt >= self.max_retries:
+            return False
+        # POST不是幂等的，只有在请求确定没有发出（连接超时）时才重试
+        if (method != "GET") and (not isinstance(err, ConnectTimeout)):
+            return False
+        if not self.retry_budget.withdraw():
+            self.retries_denied += 1
+            return False
+        return True
+
+    def get_stats(self):
+        """
+        以dict的形式返回本客户端的统计信息，包括连接池的使用情况。
+
+        :rtype: dict
+        """
+        connections_opened = 0
+        pool_requests = 0
+        idle_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections_opened += pool.num_connections
+            pool_requests += pool.num_requests
+            idle_connections += pool.pool.qsize() if pool.pool is not None else 0
+
+        return {
+            "peer": "%s:%d" % (self.addr, self.port),
+            "requests": self.requests,
+            "retries": self.retries,
+            "retries_denied": self.retries_denied,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "connections_opened": connections_opened,
+            "pool_requests": pool_requests,
+            "idle_connections": idle_connections
+        }
+
+    def close(self):
+        """
+        关闭Session和连接池中的所有连接。
+        """
+        self.session.close()
+
+
+class HttpClient(object):
+    """
+    系统各部分共用的HTTP客户端。为每个对端保持一个PeerClient，对端数量超过max_peers时关闭最久未使用的对端。
+    """
+
+    def __init__(self, timeout=(3.0, 10.0), pool_maxsize=10, max_retries=2, retry_ratio=0.2, max_peers=256):
+        """
+        :param tuple timeout: 默认的超时时间，(连接超时, 读取超时)，单位为秒
+        :param int pool_maxsize: 每个对端的连接池中保持的最大连接数
+        :param int max_retries: 一个请求最多的重试次数
+        :param float retry_ratio: 允许的重试数占请求数的比例，参见RetryBudget
+        :param int max_peers: 最多保持的对端数量
+        """
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.retry_ratio = retry_ratio
+        self.max_peers = max_peers
+        self.peers = OrderedDict()  # 类型：OrderedDict，(addr, port) -> PeerClient，按最近使用排序
+        self.lock = threading.RLock()  # 已经被gevent monkey_patch
+
+    def get_peer(self, addr, port):
+        """
+        返回对端(addr, port)的PeerClient，不存在时创建。
+
+        :rtype: PeerClient
+        """
+        key = (addr, port)
+        with self.lock:
+            peer = self.peers.pop(key, None)
+            if peer is None:
+                peer = PeerClient(addr, port, self.pool_maxsize, self.timeout, self.max_retries,
+                                  RetryBudget(self.retry_ratio, max(1.0, float(self.max_retries))))
+            self.peers[key] = peer
+            while len(self.peers) > self.max_peers:
+                _, evicted_peer = self.peers.popitem(last=False)
+                evicted_peer.close()
+            return peer
+
+    def request(self, method, addr, port, path, **kwargs):
+        """
+        向对端(addr, port)发送请求。参数和返回值参见PeerClient.request。
+
+        :rtype: requests.Response
+        """
+        return self.get_peer(addr, port).request(method, path, **kwargs)
+
+    def get(self, addr, port, path, **kwargs):
+        """
+        向对端(addr, port)发送GET请求。
+
+        :rtype: requests.Response
+        """
+        return self.request("GET", addr, port, path, **kwargs)
+
+    def post(self, addr, port, path, data=None, **kwargs):
+        """
+        向对端(addr, port)发送POST请求，请求正文为data。
+
+        :rtype: requests.Response
+        """
+        return self.request("POST", addr, port, path, data=data, **kwargs)
+
+    def forget_peer(self, addr, port):
+        """
+        关闭并丢弃对端(addr, port)的PeerClient，例如在对端被删除时。
+        """
+        with self.lock:
+            peer = self.peers.pop((addr, port), None)
+        if peer is not None:
+            peer.close()
+
+    def get_stats(self):
+        """
+        返回所有对端的统计信息组成的list。
+
+        :rtype: list
+        """
+        with self.lock:
+            peers = list(self.peers.values())
+        return [peer.get_stats() for peer in peers]
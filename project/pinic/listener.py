@@ -0,0 +1,142 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Listener类，是Node、Server和Forwarder的Bottle Web服务器所共用的监听器。
+
+Listener用gevent的WSGI服务器运行Bottle应用，并可以在运行中更换监听的地址和端口，不需要重启进程，
+已知的Node、Server列表和各种缓存都得以保留：
+
+* 先在新的地址上开始监听。如果新的地址无法监听（例如端口被占用），抛出异常，原来的监听不受影响。
+
+* 新的监听开始后，原来的服务器立即停止接受新的连接，在另一个greenlet中等待正在处理的请求完成，
+  最多等待drain_timeout秒，之后关闭仍然存在的连接。
+  等待期间，原来的服务器对每个响应加上"Connection: close"，处理完当前请求后即关闭长连接，使客户端改用新的地址。
+
+* 要开始监听并阻塞，使用Listener.serve_forever(host, port)。要更换地址，使用Listener.rebind(host, port)。
+"""
+
+__author__ = "tgmerge"
+
+
+from gevent.pywsgi import WSGIServer
+from gevent.event import Event
+import gevent
+import logging
+
+
+def create_wsgi_server(host, port, application):
+    """
+    创建gevent的WSGIServer，与Bottle的server="gevent"相同。Node和Server使用本函数。
+
+    :rtype: WSGIServer
+    """
+    return WSGIServer((host, port), application)
+
+
+class Listener(object):
+    """
+    可以在运行中更换监听地址的Web服务器。
+    """
+
+    def __init__(self, create_server, application, drain_timeout):
+        """
+        :param create_server: 创建服务器的函数，参数为(host, port, application)，返回尚未开始监听的gevent WSGIServer
+        :param application: 要运行的WSGI应用，如Bottle对象
+        :param float drain_timeout: 更换地址后，等待原来的服务器上正在处理的请求完成的最长时间（秒）
+        """
+        self.create_server = create_server
+        self.application = application
+        self.drain_timeout = drain_timeout
+
+        self.server = None  # 当前正在监听的服务器
+        self.stop_event = Event()  # 设置后，serve_forever返回
+
+        self.rebinds = 0  # 更换地址的次数
+        self.draining = 0  # 正在等待请求完成的原服务器数
+
+    def serve_forever(self, host, port):
+        """
+        在给定的地址上开始监听，并阻塞，直到调用stop()。更换地址不会使本方法返回。
+
+        :param str host: 监听的地址
+        :param int port: 监听的端口
+        """
+        self.server = self.start_server(host, port)
+        self.stop_event.wait()
+
+    def start_server(self, host, port):
+        """
+        创建服务器并开始监听。返回服务器。
+        """
+        draining = Event()
+        server = self.create_server(host, port, self.closing_application(draining))
+        server.start()
+        server.draining = draining
+        logging.info("[Listener.start_server] listening on %s:%d" % (host, port))
+        return server
+
+    def closing_application(self, draining):
+        """
+        返回包装后的WSGI应用。draining被设置后，它对每个响应加上"Connection: close"。
+
+        :param Event draining: 原服务器开始等待请求完成时设置的事件
+        """
+        application = self.application
+
+        def wrapped_application(environ, start_response):
+            if not draining.is_set():
+                return application(environ, start_response)
+
+            def closing_start_response(status, headers, exc_info=None):
+                headers = [(k, v) for (k, v) in headers if k.lower() != "connection"]
+                headers.append(("Connection", "close"))
+                return start_response(status, headers, exc_info)
+
+            return application(environ, closing_start_response)
+
+        return wrapped_application
+
+    def rebind(self, host, port):
+        """
+        在新的地址上开始监听，之后在另一个greenlet中停止原来的服务器。
+        新的地址无法监听时抛出异常（如socket.error），原来的服务器继续监听。
+
+        :param str host: 新的监听地址
+        :param int port: 新的监听端口
+        """
+        new_server = self.start_server(host, port)
+        old_server, self.server = self.server, new_server
+        self.rebinds += 1
+        if old_server is not None:
+            gevent.spawn(self.drain, old_server)
+
+    def drain(self, server):
+        """
+        停止原来的服务器：不再接受新的连接，等待正在处理的请求完成，最多等待drain_timeout秒。
+        """
+        self.draining += 1
+        server.draining.set()
+        try:
+            server.stop(timeout=self.drain_timeout)
+            logging.info("[Listener.drain] old listener on %s:%d closed" % (server.server_host, server.server_port))
+        except Exception as e:
+            logging.exception("[Listener.drain] error on closing old listener: %s" % e)
+        finally:
+            self.draining -= 1
+
+    def stop(self):
+        """
+        停止当前的服务器，使serve_forever返回。
+        """
+        if self.server is not None:
+            self.server.stop(timeout=self.drain_timeout)
+        self.stop_event.set()
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "rebinds": self.rebinds,
+            "draining": self.draining
+        }
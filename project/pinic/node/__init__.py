@@ -7,8 +7,9 @@ node
 
 Node在自身启动后，会向Server的/server/regnode注册。
 
-配置文件更改时，会先向Server的/server/unregnode注销，之后再次注册。
+配置文件更改时，如果Node的ID、地址或Server的地址发生变化，会先向Server的/server/unregnode注销，之后再次注册。
 期间Node的ID等等根据新旧配置的不同可能会有变化。
+其他配置的更改只影响改变的部分，例如只修改过滤规则时，传感器线程继续运行，也不会重新注册。
 
 HTTP API说明
 ============
@@ -48,7 +49,28 @@ Node具有以下HTTP API，全部供Server调用：
     请求处理过程如下：
 
     1. 在Node已知的传感器中查找sensor_id相符的SensorThread对象；
-    #. 从该传感器读取数据作为HTTP 200的内容返回。
+    #. 从该传感器的缓冲区读取最新的采样值作为HTTP 200的内容返回。
+
+    传感器由SensorThread在后台以配置中的sample_interval为间隔采样，HTTP请求不会直接读取传感器。
+
+**GET /node/sensordata/<node_id>**
+
+    一次获取Node所有传感器的当前读值。
+    成功则以Json数组形式返回每个传感器最新的SensorData。尚未采样的传感器不包含在数组中。
+    如果请求错误或出现异常，返回HTTP 500并在Payload中以Json形式给出异常细节。
+
+**GET /node/warningdata/<node_id>**
+
+    一次获取Node所有传感器中，未被过滤规则（filters）过滤的警报数据。
+    成功则以Json数组形式返回这些SensorData。没有警报时返回空数组。
+    如果请求错误或出现异常，返回HTTP 500并在Payload中以Json形式给出异常细节。
+
+**GET /node/stream/<node_id>/<sensor_id>?format=sse&max_rate=10**
+
+    保持连接，实时获取一个传感器的每一份新采样值。
+    format为sse（默认）时以Server-Sent Events的形式发送，为json时每行一份SensorData的Json。
+    max_rate为每秒最多发送的帧数，省略或为0时不限制。接收过慢时，较旧的帧被丢弃。
+    如果请求错误，返回HTTP 500并在Payload中以Json形式给出异常细节。
 
 **GET /node/heartbeat/<node_id>**
 
@@ -70,7 +92,7 @@ Node具有以下HTTP API，全部供Server调用：
 
     * node.Node是系统中的一个Node。
 
-    * node.SensorThread是用于监视一个传感器的线程。
+    * node.SensorThread是用于监视一个传感器的线程。它定期采样传感器，并把采样值保存在环形缓冲区（sensor.sensorbuffer.SensorRingBuffer）中。
 
 **nodeconfig模块**
 
@@ -78,6 +100,24 @@ Node具有以下HTTP API，全部供Server调用：
 
     * nodeconfig.NodeConfig是一份Node的配置。
 
+**nodefilter模块**
+
+    详情参看nodefilter.py的文档。
+
+    * nodefilter.FilterEngine是编译后的过滤规则，按传感器索引。
+
+**nodestream模块**
+
+    详情参看nodestream.py的文档。
+
+    * nodestream.SensorStream是一个传感器的实时数据流，向每个订阅的连接分发新的采样值。
+
+**nodeoutbox模块**
+
+    详情参看nodeoutbox.py的文档。
+
+    * nodeoutbox.Outbox是发往Server的数据的磁盘发件箱。Server无法访问时，警报和采样值保存在其中，之后由node.OutboxSender补发。
+
 如果要……
 ==========
 
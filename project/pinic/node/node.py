@@ -5,8 +5,14 @@
 
 Node在自身启动后，会向Server的/server/regnode注册。
 
-配置文件更改时，会先向Server的/server/unregnode注销，之后再次注册。
+Node在每次采样后用过滤规则检查传感器数据。传感器进入或离开警报状态时，
+Node主动向Server的/server/sensordata推送这份数据（可以在配置中用push_warnings关闭）。
+配置了发件箱（outbox_path）时，警报和定期报告的采样值先写入磁盘上的发件箱，
+再由OutboxSender分批发送给Server的/server/sensordatabatch。Server无法访问时数据不会丢失。
+
+配置文件更改时，如果Node的ID、地址或Server的地址发生变化，会先向Server的/server/unregnode注销，之后再次注册。
 期间Node的ID等等根据新旧配置的不同可能会有变化。
+其他配置的更改只影响改变的部分，例如只修改过滤规则时，传感器线程继续运行，也不会重新注册。
 """
 
 __author__ = "tgmerge"
@@ -16,18 +22,27 @@ from gevent import monkey
 monkey.patch_all()
 
 # 外部模块
-from bottle import Bottle, request
-import grequests
+from bottle import Bottle, request, response
+import gevent
 from requests.exceptions import RequestException
 
 # 项目内的其他模块
 from pinic.util import generate_500
-from pinic.sensor.sensordata import SensorData
+from pinic.httpclient import HttpClient
+from pinic.listener import Listener, create_wsgi_server
+from pinic.sensor.sensordata import SensorData, SensorBatch, encode_batch, accepts_binary, json_content_type
+from pinic.sensor.sensorbuffer import SensorRingBuffer
 from pinic.node.nodeconfig import NodeConfig
+from pinic.node.nodefilter import FilterEngine
+from pinic.node.nodestream import SensorStream
+from pinic.node.nodeoutbox import Outbox
 from pinic.node.nodeconfig import parse_from_string as parse_node_config_from_string
 
 # python内置模块
 from importlib import import_module
+from collections import deque
+from json import dumps
+from time import time
 import threading
 import logging
 
@@ -41,6 +56,17 @@ class Node(object):
     本类是项目中的Node服务器。运行指导参见pinic.node.__init__.py的文档
     """
 
+    stream_queue_size = 64  # 数据流的每个连接最多缓存的帧数
+    stream_keepalive_interval = 15.0  # 数据流没有新数据时，发送空帧的间隔（秒）
+    listener_drain_timeout = 10.0  # 更换监听地址后，等待原地址上正在处理的请求（包括数据流）完成的最长时间（秒）
+
+    # 应用新配置时，这些配置项改变才需要向Server解除注册并重新注册
+    registration_keys = ("node_id", "node_host", "node_port", "server_addr", "server_port")
+
+    # 应用新配置时，这些配置项改变才需要重启发件箱的发送线程
+    outbox_sender_keys = ("node_id", "server_addr", "server_port", "outbox_path", "outbox_batch_size",
+                          "outbox_drain_rate", "report_interval")
+
     def __init__(self, node_config):
         """
         :param NodeConfig node_config: 初始化用的Node配置（NodeConfig对象）。
@@ -50,10 +76,20 @@ class Node(object):
 
         self.bottle = Bottle()  # 类型：Bottle，是本服务器内含的Bottle Web服务器
 
+        self.listener = Listener(create_wsgi_server, self.bottle, Node.listener_drain_timeout)  # 类型：Listener，运行Bottle的监听器
+
         self.sensor_threads = []  # 类型：list of SensorThread，是传感器监视线程的列表。
 
         self.server_monitor = None  # 类型：ServerMonitor，用于定期向Server发送心跳请求。
 
+        self.filter_engine = None  # 类型：FilterEngine，由config.filters编译而成的过滤规则
+
+        self.http_client = HttpClient()  # 类型：HttpClient，向Server发送请求所用的、带连接池的HTTP客户端
+
+        self.outbox = None  # 类型：Outbox，发往Server的警报和传感器数据的发件箱。配置中outbox_path为空时为None
+
+        self.outbox_sender = None  # 类型：OutboxSender，把发件箱中的数据发送给Server
+
         # 应用初始化配置
         self.apply_config(node_config)
 
@@ -67,6 +103,7 @@ class Node(object):
         """
         使用Node的配置（Node.config）中的规则（filters）过滤传感器数据。
         如果和过滤规则匹配，则丢弃它。
+        规则在应用配置时已经被编译为FilterEngine，这里只检查适用于该传感器的过滤器。
 
         :param SensorData sensor_data: 要检查的传感器数据（SensorData对象）
 
@@ -77,39 +114,25 @@ class Node(object):
         if not isinstance(sensor_data, SensorData):
             raise TypeError("sensor_data: %s is not a SensorData instance" % str(sensor_data))
 
-        # 预设丢弃状态为False（未丢弃）
-        is_dropped = False
+        return self.filter_engine.is_dropped(sensor_data)
 
-        # 检查config.filters中的每条过滤规则
-        for data_filter in self.config.filters:
-            # 检查 "apply_on_sensor_type" 的值是否符合该传感器数据的sensor_type。
-            # 如果不符合，则直接保留该数据。"*"将匹配任意的sensor_type。
-            if (data_filter["apply_on_sensor_type"] != "*") and (data_filter["apply_on_sensor_type"] != sensor_data.sensor_type):
-                continue
+    def apply_config(self, new_config, load_old_config=False):
+        """
+        为Node服务器应用新的配置。
 
-            # 检查 "apply_on_sensor_id" 的值是否符合该传感器数据的sensor_id。
-            # 如果不符合，则直接保留该数据。"*"将匹配任意的sensor_id。
-            if (data_filter["apply_on_sensor_id"] != "*") and (data_filter["apply_on_sensor_id"] != sensor_data.sensor_id):
-                continue
+        只对改变的部分进行操作，不受影响的传感器线程继续运行：
 
-            # 检查比较方法 "comparing_method" 和比较阈值 "threshold" 。
-            # 比较方法可以是 "greater_than" 或 "less_than"，其他值无效（将保留数据）。
-            # 例如：
-            # COMPARING_METHOD  THRESHOLD
-            # greater_than      100
-            # 将丢弃大于100的数据。
-            if (data_filter["comparing_method"] == "greater_than") and (sensor_data.raw_value > data_filter["threshold"]):
-                is_dropped = True
-                break
-            if (data_filter["comparing_method"] == "less_than") and (sensor_data.raw_value < data_filter["threshold"]):
-                is_dropped = True
-                break
+        * 过滤规则或传感器改变时，重新编译过滤规则，并一次性替换。
 
-        return is_dropped
+        * 只停止被删除或配置改变的传感器的线程，只启动新增或配置改变的传感器的线程。
 
-    def apply_config(self, new_config, load_old_config=False):
-        """
-        为Node服务器应用新的配置。
+        * 只有registration_keys中的配置项（Node的ID、地址，Server的地址）改变时，才向Server解除注册并重新注册；
+          Node的描述或传感器改变时，只重新发送一次注册，更新Server上保存的Node配置。
+
+        * 只有outbox_sender_keys中的配置项改变时，才重启发件箱的发送线程。
+
+        * 监听的地址或端口改变时，先在新的地址上开始监听，原来的监听在处理完正在进行的请求后关闭。
+          新的地址无法监听时抛出异常，新配置的其他部分都不会被应用。
 
         :param NodeConfig new_config: 要应用的新配置（NodeConfig对象）。
         :param bool load_old_config: 是否在失败时重新加载旧的配置，默认为False。
@@ -120,32 +143,65 @@ class Node(object):
         if not isinstance(new_config, NodeConfig):
             raise TypeError("%s is not a NodeConfig instance" % str(new_config))
 
-        # 备份旧的配置
+        # 备份旧的配置，并找出改变的部分
         old_config = self.config
 
-        # 向Server解除注册
-        if self.server_monitor is not None:
-            self.server_monitor.stop()
-            self.server_monitor.unreg_to_server()
+        def changed(keys):
+            return (old_config is None) or any(getattr(new_config, k) != getattr(old_config, k) for k in keys)
 
-        # 停止传感器线程
-        self.stop_sensor_threads()
+        registration_changed = changed(Node.registration_keys)
+        outbox_sender_changed = changed(Node.outbox_sender_keys)
+        sensors_changed = changed(("sensors",))
+        filters_changed = changed(("filters",))
+        desc_changed = changed(("node_desc",))
 
-        # 将Node的配置设置为新的配置
-        self.config = new_config
+        # 监听的地址或端口改变时，先在新的地址上开始监听。无法监听时抛出异常，新配置的其他部分都不会被应用
+        if (old_config is not None) and changed(("node_host", "node_port")):
+            self.restart_bottle(new_config.node_host, new_config.node_port)
 
-        # 向Server重新注册
-        self.server_monitor = ServerMonitor(self)
-        self.server_monitor.reg_to_server()
-        self.server_monitor.start()
+        # 向Server解除注册。尚未推送的警报交给新的ServerMonitor
+        pending_pushes = []
+        if registration_changed and (self.server_monitor is not None):
+            self.server_monitor.stop()
+            self.server_monitor.unreg_to_server()
+            pending_pushes = list(self.server_monitor.push_queue)
+            self.server_monitor = None
 
-        # 启动新的传感器线程。如果有异常，并不视为配置应用失败
-        self.start_sensor_threads()
+        # 停止发件箱的发送线程。未发送的数据留在发件箱中
+        if outbox_sender_changed and (self.outbox_sender is not None):
+            self.outbox_sender.stop()
+            self.outbox_sender = None
 
-        # 如果需要，重启整个服务器
-        # TODO 由于需求变化，不实现
-        if (old_config is not None) and ((new_config.node_port != old_config.node_port) or (new_config.node_host != old_config.node_host)):
-            self.restart_bottle()
+        # 将Node的配置设置为新的配置。过滤规则或传感器改变时，编译新的过滤规则并替换
+        self.config = new_config
+        if filters_changed or sensors_changed:
+            self.filter_engine = FilterEngine(new_config.filters, new_config.sensors)
+
+        # 需要时重新打开发件箱，并开启发送线程
+        if changed(("outbox_path",)):
+            if self.outbox is not None:
+                self.outbox.close()
+                self.outbox = None
+            if new_config.outbox_path != "":
+                self.outbox = Outbox(new_config.outbox_path, new_config.outbox_max_bytes)
+        if self.outbox is not None:
+            self.outbox.max_bytes = new_config.outbox_max_bytes
+            if self.outbox_sender is None:
+                self.outbox_sender = OutboxSender(self)
+                self.outbox_sender.start()
+
+        # 向Server重新注册；只有描述或传感器改变时，重新发送注册以更新Server上的Node配置
+        if self.server_monitor is None:
+            self.server_monitor = ServerMonitor(self)
+            self.server_monitor.queue_pushes(pending_pushes)
+            self.server_monitor.reg_to_server()
+            self.server_monitor.start()
+        elif desc_changed or sensors_changed:
+            self.server_monitor.reg_to_server()
+
+        # 停止和启动改变的传感器线程。如果有异常，并不视为配置应用失败
+        if sensors_changed:
+            self.update_sensor_threads()
 
     def start_bottle(self):
         """
@@ -157,28 +213,58 @@ class Node(object):
         # URL路由
         self.bottle.route("/node/nodeconfig/<node_id>", method="POST", callback=self.post_node_config)
         self.bottle.route("/node/nodeconfig/<node_id>", method="GET", callback=self.get_node_config)
+        self.bottle.route("/node/sensordata/<node_id>", method="GET", callback=self.get_all_sensor_data)
         self.bottle.route("/node/sensordata/<node_id>/<sensor_id>", method="GET", callback=self.get_sensor_data)
+        self.bottle.route("/node/warningdata/<node_id>", method="GET", callback=self.get_all_warning_data)
         self.bottle.route("/node/warningdata/<node_id>/<sensor_id>", method="GET", callback=self.get_warning_data)
+        self.bottle.route("/node/stats/<node_id>", method="GET", callback=self.get_stats)
+        self.bottle.route("/node/stream/<node_id>/<sensor_id>", method="GET", callback=self.get_stream)
 
-        # 开启Bottle
-        self.bottle.run(
-            host=self.config.node_host,
-            port=self.config.node_port,
-            server="gevent"
-        )
+        # 开启Bottle。使用Listener运行，使监听的地址和端口可以在运行中更换
+        self.listener.serve_forever(self.config.node_host, self.config.node_port)
 
-    def restart_bottle(self):
-        logging.debug("[Node.restart_bottle] restarting bottle")
-        pass
+    def restart_bottle(self, host, port):
+        """
+        在新的地址和端口上开始监听，原来的监听在处理完正在进行的请求后关闭（参见pinic.listener）。
+        已知的Node、Server列表，缓存和各个线程都不受影响。新的地址无法监听时抛出异常，原来的监听继续工作。
 
-    def start_sensor_threads(self):
+        :param str host: 新的监听地址
+        :param int port: 新的监听端口
         """
-        开启Node的配置（Node.config）中所描述的所有传感器的监视线程。
+        logging.debug("[Node.restart_bottle] rebinding bottle to %s:%d" % (host, port))
+        self.listener.rebind(host, port)
+
+    def update_sensor_threads(self):
         """
+        使传感器线程与Node的配置（Node.config）中的传感器一致。
+        配置与已有线程完全相同的传感器，保留原来的线程（包括缓冲区中的采样值和数据流的连接）；
+        其余的已有线程被停止，为新增或配置改变的传感器开启新的线程。线程按配置中的顺序排列。
+        """
+        # 找出可以保留的线程，每个线程最多对应一个传感器
+        old_threads = list(self.sensor_threads)
+        kept_threads = [None] * len(self.config.sensors)
         for index, sensor in enumerate(self.config.sensors):
-            thread = SensorThread(self, index)
-            self.sensor_threads.append(thread)
-            thread.start()
+            for thread in old_threads:
+                if thread.config_item == sensor:
+                    old_threads.remove(thread)
+                    kept_threads[index] = thread
+                    break
+
+        # 先停止不再需要的线程，以免新旧两个线程同时访问同一个传感器
+        for thread in old_threads:
+            thread.stop()
+
+        new_threads = []
+        started = 0
+        for index, thread in enumerate(kept_threads):
+            if thread is None:
+                thread = SensorThread(self, index)
+                thread.start()
+                started += 1
+            new_threads.append(thread)
+        self.sensor_threads = new_threads
+        logging.debug("[Node.update_sensor_threads] kept %d, started %d, stopped %d sensor threads"
+                      % (len(new_threads) - started, started, len(old_threads)))
 
     def stop_sensor_threads(self):
         """
@@ -186,6 +272,7 @@ class Node(object):
         """
         for thread in self.sensor_threads:
             thread.stop()
+        self.sensor_threads = []
 
     # HTTP处理方法
     # ============
@@ -242,7 +329,7 @@ class Node(object):
         处理HTTP URL，参见start_bottle方法的注释。
 
         本方法处理Server发来的请求，要求返回传感器的当前传感值。
-        方法将以Json形式返回传感器数据。
+        方法将以Json形式返回传感器数据。请求的Accept头要求二进制格式时，返回二进制格式，参见pinic.sensor.sensordata。
         如果请求错误或出现异常，返回HTTP 500。
 
         :param basestring node_id: URL中的<node_id>部分。
@@ -260,15 +347,19 @@ class Node(object):
         else:
             return generate_500("Cannot find sensor with sensor_id='%s'" % sensor_id)
 
-        # 从该SensorThread对象获取传感器数据并返回
-        return sensor_thread.get_json_dumps_sensor_data()
+        # 从该SensorThread对象的缓冲区获取最新的传感器数据，按请求的格式返回
+        batch = SensorBatch()
+        sensor_thread.append_latest_to_batch(batch)
+        if len(batch) == 0:
+            return generate_500("Sensor with sensor_id='%s' has no data yet" % sensor_id)
+        return self.encode_response(batch, single=True)
 
     def get_warning_data(self, node_id, sensor_id):
         """
         处理HTTP URL，参见start_bottle方法的注释。
 
         本方法处理Server发来的请求，要求返回某个传感器被过滤列表（filters）过滤后仍保留的警报数据。
-        如果当前那个传感器的传感器值（SensorData）不符合任何filter的条件，则返回它。
+        如果当前那个传感器的传感器值（SensorData）不符合任何filter的条件，则返回它（格式同get_sensor_data）。
         否则，如果那个传感器的值被filters中的filter过滤，则返回空的HTTP 200。
         如果请求错误或出现异常，返回HTTP 500。
         """
@@ -285,20 +376,178 @@ class Node(object):
         else:
             return generate_500("Cannot find sensor with sensor_id='%s'" % node_id)
 
-        # 从该SensorThread对象读传感器数据（SensorData），并过滤
+        # 从该SensorThread对象的缓冲区读取最新的传感器数据（SensorData）。
+        # 采样时已经用过滤规则检查过这份数据，这里直接使用检查的结果
         sensor_data = sensor_thread.get_data()
-        if not self.filter_sensor_data(sensor_data):
-            return sensor_data.get_json_dumps()
+        if sensor_data is None:
+            return generate_500("Sensor with sensor_id='%s' has no data yet" % sensor_id)
+        if sensor_thread.is_warning:
+            batch = SensorBatch()
+            batch.append_data(sensor_data)
+            return self.encode_response(batch, single=True)
         else:
             return  # 空的HTTP 200
 
+    def get_all_sensor_data(self, node_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法处理Server发来的请求，要求一次返回本Node所有传感器的当前传感值。
+        方法将以Json数组的形式返回各个传感器最新的传感器数据。尚未采样的传感器不包含在数组中。
+        请求的Accept头要求二进制格式时，返回二进制格式的SensorBatch。
+        如果请求错误或出现异常，返回HTTP 500。
+
+        :param basestring node_id: URL中的<node_id>部分。
+        """
+        # 检查URL中的node_id是否和自身ID匹配
+        if node_id != self.config.node_id:
+            return generate_500("Cannot find node with node_id='%s'" % node_id)
+
+        # 收集每个SensorThread对象缓冲区中最新的传感器数据
+        batch = SensorBatch()
+        for sensor_thread in self.sensor_threads:
+            sensor_thread.append_latest_to_batch(batch)
+        return self.encode_response(batch)
+
+    def get_all_warning_data(self, node_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法处理Server发来的请求，要求一次返回本Node所有传感器中，被过滤列表（filters）过滤后仍保留的警报数据。
+        方法将以Json数组的形式返回这些传感器数据。如果没有警报，返回空数组。
+        请求的Accept头要求二进制格式时，返回二进制格式的SensorBatch。
+        如果请求错误或出现异常，返回HTTP 500。
+
+        :param basestring node_id: URL中的<node_id>部分。
+        """
+        # 检查URL中的node_id是否和自身ID匹配
+        if node_id != self.config.node_id:
+            return generate_500("Cannot find node with node_id='%s'" % node_id)
+
+        # 收集每个SensorThread对象中未被过滤的最新传感器数据
+        batch = SensorBatch()
+        for sensor_thread in self.sensor_threads:
+            if sensor_thread.is_warning:
+                sensor_thread.append_latest_to_batch(batch)
+        return self.encode_response(batch)
+
+    def encode_response(self, batch, single=False):
+        """
+        按当前请求的Accept头编码传感器数据，并设置响应的Content-Type。
+
+        :param SensorBatch batch: 要返回的传感器数据
+        :param bool single: 是否只返回一份数据。为True时，Json格式返回一个对象而不是数组
+        :rtype: str
+        """
+        accept = request.headers.get("Accept")
+        if single and (not accepts_binary(accept)):
+            body, content_type = batch[0].get_json_dumps(), json_content_type
+        else:
+            body, content_type = encode_batch(batch, accept)
+        response.content_type = content_type
+        return body
+
+    def get_stats(self, node_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法返回Node的运行统计信息，以Json形式返回。目前包括HTTP客户端各对端的连接池使用情况。
+
+        :param basestring node_id: URL中的<node_id>部分。
+        """
+        # 检查URL中的node_id是否和自身ID匹配
+        if node_id != self.config.node_id:
+            return generate_500("Cannot find node with node_id='%s'" % node_id)
+
+        return dumps({
+            "http_client": self.http_client.get_stats(),
+            "streams": dict((x.sensor_id, x.stream.get_stats()) for x in self.sensor_threads),
+            "outbox": self.outbox_sender.get_stats() if self.outbox_sender is not None else None,
+            "listener": self.listener.get_stats()
+        })
+
+    def get_stream(self, node_id, sensor_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法保持连接，把传感器的每一份新采样值作为一帧发送给客户端，直到客户端断开或传感器线程停止。
+        查询参数format为"sse"（默认）时，以Server-Sent Events的形式发送，每帧为"data: <SensorData的Json>"；
+        为"json"时，每帧为一行SensorData的Json。没有新数据时，每隔stream_keepalive_interval秒发送一个空帧。
+        查询参数max_rate给出每秒最多发送的帧数，超出的采样值被跳过。
+        客户端接收太慢时，每个连接最多缓存stream_queue_size帧，更旧的帧被丢弃。
+        如果请求错误，返回HTTP 500。
+
+        :param basestring node_id: URL中的<node_id>部分。
+        :param basestring sensor_id: URL中的<sensor_id>部分。
+        """
+        # 检查URL中的node_id是否和自身ID匹配
+        if node_id != self.config.node_id:
+            return generate_500("Cannot find node with node_id='%s'" % node_id)
+
+        # 在Node自身的sensor_threads中查找sensor_id相符的SensorThread对象
+        for x in self.sensor_threads:
+            if sensor_id == x.sensor_id:
+                sensor_thread = x
+                break
+        else:
+            return generate_500("Cannot find sensor with sensor_id='%s'" % sensor_id)
+
+        # 解析查询参数
+        stream_format = request.query.get("format", "sse")
+        if stream_format not in ("sse", "json"):
+            return generate_500("Unknown stream format '%s'" % stream_format)
+        try:
+            max_rate = float(request.query.get("max_rate", 0))
+        except ValueError as e:
+            return generate_500("Error on parsing max_rate.", e)
+        if max_rate < 0:
+            return generate_500("max_rate must not be negative")
+
+        if stream_format == "sse":
+            response.content_type = "text/event-stream"
+        else:
+            response.content_type = "application/x-ndjson"
+        response.set_header("Cache-Control", "no-cache")
+
+        subscriber = sensor_thread.stream.subscribe(Node.stream_queue_size, max_rate)
+        return self.generate_stream(sensor_thread, subscriber, stream_format == "sse")
+
+    def generate_stream(self, sensor_thread, subscriber, is_sse):
+        """
+        生成数据流的各帧，供get_stream返回。连接结束时（包括客户端断开），退订数据流。
+
+        :param SensorThread sensor_thread: 数据流所属的传感器线程
+        :param StreamSubscriber subscriber: 这个连接的订阅者
+        :param bool is_sse: 是否使用Server-Sent Events的格式
+        """
+        try:
+            # 先发送一帧，使客户端立即收到响应头
+            yield ": connected\n\n" if is_sse else "\n"
+            while not sensor_thread.stop_event.is_set():
+                frames = subscriber.take_all(Node.stream_keepalive_interval)
+                if not frames:
+                    yield ": keepalive\n\n" if is_sse else "\n"
+                    continue
+                if is_sse:
+                    yield "".join("data: %s\n\n" % x.get_json_dumps() for x in frames)
+                else:
+                    yield "".join("%s\n" % x.get_json_dumps() for x in frames)
+        finally:
+            sensor_thread.stream.unsubscribe(subscriber)
+
 
 class ServerMonitor(threading.Thread):
     """
     Server监视线程。已经被gevent monkey_patch成为greenlet。
     该线程定期向Server发送/server/keepnode/<node_id>这个心跳请求，以表明当前的Node存活。
+    没有配置发件箱时，线程另外开启一个greenlet，按产生的顺序逐份推送警报，使"enter"和随后的"leave"不会颠倒。
+    推送失败的警报留在队列的开头，等待一段时间后重试，等待的时间从1秒开始加倍，最长为max_push_backoff秒。
     """
 
+    push_queue_size = 256  # 等待推送的警报的最大数量，超过时丢弃最旧的
+    min_push_backoff = 1.0  # 秒，推送失败后第一次重试前的等待时间
+    max_push_backoff = 30.0  # 秒，推送失败后重试前的最长等待时间
+
     def __init__(self, node):
         """
         构造方法。
@@ -312,6 +561,8 @@ class ServerMonitor(threading.Thread):
         self.server_port = node.config.server_port
         self.node_id = node.config.node_id
         self.keep_alive_interval = 10.0  # 秒，每隔这个间隔向Server发送心跳请求
+        self.push_queue = deque()  # 类型：deque of dict，等待推送的警报，按产生的顺序排列
+        self.push_event = threading.Event()  # 有新的警报等待推送时被设置
         self.stop_event = threading.Event()  # 停止事件，建议使用ServerMonitor.stop()停止本线程
 
     def reg_to_server(self):
@@ -320,10 +571,8 @@ class ServerMonitor(threading.Thread):
         发送一个POST请求到server的/server/regnode，请求内容是Node的config。
         """
         logging.debug("[ServerMonitor.reg_to_server] reg to server. addr=%s, port=%d" % (self.server_addr, self.server_port))
-        request_url = str("http://%s:%d/server/regnode" % (self.server_addr, self.server_port))
         try:
-            greq = grequests.post(request_url, data=self.node.config.get_json_string())
-            greq.send()
+            self.node.http_client.post(self.server_addr, self.server_port, "/server/regnode", data=self.node.config.get_json_string())
         except RequestException as e:
             logging.warning("[ServerMonitor.reg_to_server] reg failed. err:" + str(e))
 
@@ -333,13 +582,74 @@ class ServerMonitor(threading.Thread):
         发送一个POST请求到server的/server/unregnode，请求内容是Node的config。
         """
         logging.debug("[ServerMonitor.unreg_to_server] unreg to server. addr=%s, port=%d" % (self.server_addr, self.server_port))
-        request_url = str("http://%s:%d/server/unregnode" % (self.server_addr, self.server_port))
         try:
-            greq = grequests.post(request_url, data=self.node.config.get_json_string())
-            greq.send()
+            self.node.http_client.post(self.server_addr, self.server_port, "/server/unregnode", data=self.node.config.get_json_string())
         except RequestException as e:
             logging.warning("[ServerMonitor.reg_to_server] reg failed. err:" + str(e))
 
+    def push_warning(self, sensor_data, is_warning):
+        """
+        向Server的/server/sensordata推送一份传感器数据，表示该传感器进入或离开了警报状态。
+        推送的内容是SensorData的Json，并附加node_id和warning_state（"enter"或"leave"）。
+        配置了发件箱时，警报被写入发件箱，由OutboxSender发送给Server的/server/sensordatabatch；
+        否则放入推送队列，由send_pushes按顺序发送。本方法不会阻塞。
+
+        :param SensorData sensor_data: 引起状态变化的传感器数据
+        :param bool is_warning: 传感器当前是否处于警报状态
+        """
+        warning_json_obj = sensor_data.get_dict()
+        warning_json_obj["node_id"] = self.node_id
+        warning_json_obj["warning_state"] = "enter" if is_warning else "leave"
+        logging.debug("[ServerMonitor.push_warning] pushing warning, sensor_id=%s state=%s" % (sensor_data.sensor_id, warning_json_obj["warning_state"]))
+
+        self.queue_pushes([warning_json_obj])
+
+    def queue_pushes(self, warning_json_objs):
+        """
+        按顺序排队推送若干份警报。替换ServerMonitor时，原来的ServerMonitor尚未推送的警报也由本方法交给新的ServerMonitor。
+        配置了发件箱时，警报被写入发件箱，由OutboxSender发送，Server无法访问时不会丢失；
+        否则放入推送队列，队列已满时丢弃最旧的警报。
+
+        :param list warning_json_objs: 类型：list of dict，要推送的警报，按产生的顺序排列
+        """
+        outbox_sender = self.node.outbox_sender
+        if outbox_sender is not None:
+            for warning_json_obj in warning_json_objs:
+                outbox_sender.enqueue("warning", dumps(warning_json_obj))
+            return
+
+        self.push_queue.extend(warning_json_objs)
+        while len(self.push_queue) > ServerMonitor.push_queue_size:
+            self.push_queue.popleft()
+            logging.warning("[ServerMonitor.queue_pushes] push queue is full, dropping the oldest warning")
+        self.push_event.set()
+
+    def send_pushes(self):
+        """
+        按顺序逐份推送队列中的警报，上一份推送完成后才开始下一份，直到停止本线程。
+        推送失败（无法连接或Server返回HTTP 500）时，警报留在队列的开头，等待后重试，以免后面的警报先于它送达。
+        """
+        backoff = ServerMonitor.min_push_backoff
+        while not self.stop_event.is_set():
+            if not self.push_queue:
+                self.push_event.wait()
+                self.push_event.clear()
+                continue
+            warning_json_obj = self.push_queue[0]
+            try:
+                response = self.node.http_client.post(self.server_addr, self.server_port, "/server/sensordata", data=dumps(warning_json_obj))
+                if response.status_code >= 500:
+                    raise RequestException("server returned HTTP %d" % response.status_code)
+            except RequestException as e:
+                logging.warning("[ServerMonitor.send_pushes] push failed, retrying in %.1fs. err: %s" % (backoff, str(e)))
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, ServerMonitor.max_push_backoff)
+                continue
+            backoff = ServerMonitor.min_push_backoff
+            # 等待推送时队列已满，这份警报可能已经被丢弃
+            if self.push_queue and (self.push_queue[0] is warning_json_obj):
+                self.push_queue.popleft()
+
     def send_keep_node(self):
         """
         向Server的/server/keepnode/<node_id>发送一个GET，证明自身存活。
@@ -347,10 +657,8 @@ class ServerMonitor(threading.Thread):
         如果返回500，说明Server尚不知道自身，故进行reg_to_server，重新向Server注册自己。
         """
         logging.debug("[ServerMonitor.send_keep_node] sending keep_node message")
-        request_url = str("http://%s:%d/server/keepnode/%s" % (self.server_addr, self.server_port, self.node_id))
         try:
-            greq = grequests.get(request_url)
-            response = greq.send()
+            response = self.node.http_client.get(self.server_addr, self.server_port, "/server/keepnode/%s" % self.node_id)
             if response.status_code == 500:
                 self.unreg_to_server()
                 self.reg_to_server()
@@ -362,8 +670,10 @@ class ServerMonitor(threading.Thread):
         ServerMonitor以如下方式运行：
 
         每keep_alive_interval秒，运行send_keep_node，发送自身存活消息。
+        同时在另一个greenlet中运行send_pushes，推送警报。
         """
 
+        gevent.spawn(self.send_pushes)
         while not self.stop_event.wait(self.keep_alive_interval):
             self.send_keep_node()
 
@@ -373,12 +683,155 @@ class ServerMonitor(threading.Thread):
         """
 
         self.stop_event.set()
+        self.push_event.set()
+
+
+class OutboxSender(threading.Thread):
+    """
+    发件箱发送线程。已经被gevent monkey_patch成为greenlet。
+    线程把Node的发件箱（Node.outbox）中的记录分批发送给Server的/server/sensordatabatch，发送成功后才从发件箱中删除。
+
+    * 有新的记录时，线程被立即唤醒并发送。
+
+    * 积压的记录按配置中的outbox_batch_size分批发送，每秒最多发送outbox_drain_rate批，以免在Server恢复时突然发送大量请求。
+
+    * 发送失败时，等待的时间从1秒开始加倍，最长为max_backoff秒。
+
+    * 配置中的report_interval大于0时，每隔report_interval秒，把各传感器缓冲区中自上次以来的所有采样值写入发件箱。
+    """
+
+    min_backoff = 1.0  # 秒，发送失败后第一次重试前的等待时间
+    max_backoff = 30.0  # 秒，发送失败后重试前的最长等待时间
+
+    def __init__(self, node):
+        """
+        :param Node node: 开启此线程的Node
+        """
+        super(OutboxSender, self).__init__()
+
+        self.node = node
+        self.outbox = node.outbox
+        self.server_addr = node.config.server_addr
+        self.server_port = node.config.server_port
+        self.node_id = node.config.node_id
+        self.batch_size = node.config.outbox_batch_size
+        self.drain_interval = 1.0 / node.config.outbox_drain_rate  # 秒，相邻两批之间的最小间隔
+        self.report_interval = node.config.report_interval
+        self.next_report_time = time() + self.report_interval
+        self.reported_counts = {}  # 类型：dict，SensorThread -> 上次报告时该传感器缓冲区的total_count
+        self.backoff = OutboxSender.min_backoff
+        self.sent_batches = 0  # 发送成功的批数
+        self.failed_batches = 0  # 发送失败的批数
+        self.wake_event = threading.Event()  # 有新的记录时被设置
+        self.stop_event = threading.Event()  # 停止事件，建议使用OutboxSender.stop()停止本线程
+
+    def enqueue(self, record_type, data_json):
+        """
+        向发件箱写入一条记录，并唤醒线程。
+
+        :param str record_type: 记录的种类，"warning"（警报）或"readings"（一批采样值）
+        :param str data_json: 记录的内容，是Json字符串
+        """
+        try:
+            self.outbox.append('{"type": "%s", "data": %s}' % (record_type, data_json))
+        except (IOError, OSError) as e:
+            logging.error("[OutboxSender.enqueue] cannot write to outbox: " + str(e))
+            return
+        self.wake_event.set()
+
+    def report_readings(self):
+        """
+        把各传感器缓冲区中自上次报告以来的采样值作为一条"readings"记录写入发件箱。
+        两次报告之间缓冲区被写满时，只报告缓冲区中仍保存的采样值。
+        """
+        batch = SensorBatch()
+        reported_counts = {}
+        for sensor_thread in self.node.sensor_threads:
+            total_count = sensor_thread.buffer.total_count
+            new_count = total_count - self.reported_counts.get(sensor_thread, 0)
+            if new_count > 0:
+                sensor_thread.buffer.extend_batch(batch, sensor_thread.sensor_id, sensor_thread.sensor_type, new_count)
+            reported_counts[sensor_thread] = total_count
+        self.reported_counts = reported_counts
+        if len(batch) > 0:
+            self.enqueue("readings", batch.to_json())
+
+    def send_batch(self):
+        """
+        从发件箱读取一批记录并发送给Server。返回是否发送了记录。发送失败时抛出异常。
+
+        :rtype: bool
+        """
+        records, end_offset = self.outbox.read_batch(self.batch_size)
+        if not records:
+            return False
+        body = '{"node_id": %s, "records": [%s]}' % (dumps(self.node_id), ", ".join(records))
+        response = self.node.http_client.post(self.server_addr, self.server_port, "/server/sensordatabatch", data=body)
+        if response.status_code != 200:
+            raise RequestException("server returned HTTP %d: %s" % (response.status_code, response.text[:200]))
+        self.outbox.commit(end_offset)
+        return True
+
+    def run(self):
+        """
+        OutboxSender以如下方式运行：
+
+        需要时报告采样值；之后发送一批记录。发送成功且仍有积压时，等待drain_interval秒后继续；
+        发件箱为空时，等待新的记录；发送失败时，等待backoff秒后重试。
+        """
+        while not self.stop_event.is_set():
+            if (self.report_interval > 0) and (time() >= self.next_report_time):
+                self.next_report_time = time() + self.report_interval
+                self.report_readings()
+
+            try:
+                has_sent = self.send_batch()
+            except RequestException as e:
+                self.failed_batches += 1
+                logging.warning("[OutboxSender.run] send failed, retrying in %.1fs. err: %s" % (self.backoff, str(e)))
+                self.stop_event.wait(self.backoff)
+                self.backoff = min(self.backoff * 2, OutboxSender.max_backoff)
+                continue
+            except Exception as e:
+                logging.exception("[OutboxSender.run] exception:" + str(e))
+                self.stop_event.wait(self.backoff)
+                continue
+
+            self.backoff = OutboxSender.min_backoff
+            if has_sent:
+                self.sent_batches += 1
+                self.stop_event.wait(self.drain_interval)
+            else:
+                timeout = (self.next_report_time - time()) if self.report_interval > 0 else None
+                self.wake_event.wait(max(0.0, timeout) if timeout is not None else None)
+                self.wake_event.clear()
+
+    def stop(self):
+        """
+        停止本线程的运行。
+        """
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        stats = self.outbox.get_stats()
+        stats["sent_batches"] = self.sent_batches
+        stats["failed_batches"] = self.failed_batches
+        return stats
 
 
 class SensorThread(threading.Thread):
     """
     传感器监视线程。已经被gevent monkey_patch为greenlet。
-    可以通过该线程的方法获取传感器的值。
+    线程以传感器配置中的sample_interval为间隔，在后台读取传感器，并将采样值写入环形缓冲区。
+    通过该线程的方法获取传感器的值时，返回的是缓冲区中最新的采样值，不会再次读取传感器。
+
+    每次采样后，线程用Node的过滤规则检查采样值，并记录传感器是否处于警报状态（is_warning）。
+    状态发生变化（进入或离开警报状态）时，通过ServerMonitor向Server推送这份数据。
+    Server定期检查（轮询）警报的方式仍然可用，参见Server配置中的warning_mode。
 
     在最初的设计中，有定期检查传感器并推送报警信息给Server的功能。
     但后来在2015年4月29日，因导师要求被移除，改为Server定期检查。
@@ -386,6 +839,8 @@ class SensorThread(threading.Thread):
     这次编辑参见Git commit记录： 699b6bc7aefe64eab56f5d9727ec341e001d0e4a
     """
 
+    buffer_capacity = 1024  # 环形缓冲区能保存的采样值个数
+
     def __init__(self, node, index):
         """
         构造方法。
@@ -395,15 +850,18 @@ class SensorThread(threading.Thread):
         """
         super(SensorThread, self).__init__()
 
+        self.node = node  # 开启此线程的Node
+
         # 得到传感器的配置
         sensor_config = node.config.sensors[index]
+        self.config_item = sensor_config  # 传感器在Node配置中的一项。应用新配置时，用于判断传感器的配置是否改变
         self.sensor_type = sensor_config["sensor_type"]
         self.sensor_id = sensor_config["sensor_id"]
         self.sensor_desc = sensor_config["sensor_desc"]
         self.sensor_config = sensor_config["sensor_config"]
         self.server_addr = node.config.server_addr
         self.server_port = node.config.server_port
-        self.sensor_interval = 10.0  # 已经无需定期检查传感器，但保留供停止传感器用
+        self.sample_interval = float(sensor_config["sample_interval"])  # 秒，每隔这个间隔读取一次传感器
 
         # 根据传感器的类型（sensor_type）导入传感器驱动的Python模块。
         # 路径为project/pinic/sensor/sensor_[sensor_type].py。
@@ -412,44 +870,98 @@ class SensorThread(threading.Thread):
         sensor_module = import_module("pinic.sensor.sensor_" + self.sensor_type)  # 导入模块
         self.sensor = sensor_module.Sensor(self.sensor_id, self.sensor_desc, sensor_config)  # self.sensor类型：BaseSensor的子类的实例
 
+        # 采样值的环形缓冲区
+        self.buffer = SensorRingBuffer(SensorThread.buffer_capacity)
+
+        # 最新的采样值是否处于警报状态（未被任何过滤规则过滤）
+        self.is_warning = False
+
+        # 实时数据流，每次采样后向订阅的客户端发布采样值
+        self.stream = SensorStream()
+
         # 设置停止事件
         self.stop_event = threading.Event()
 
     def get_data(self):
         """
-        读取传感器数据(SensorData)并返回SensorData对象。
+        返回缓冲区中最新的传感器数据(SensorData)。尚未采样时返回None。
 
         :rtype: SensorData
         """
-        return self.sensor.get_data()
+        latest = self.buffer.get_latest()
+        if latest is None:
+            return None
+        raw_value, timestamp = latest
+        return SensorData(self.sensor_id, self.sensor_type, raw_value, timestamp)
+
+    def append_latest_to_batch(self, batch):
+        """
+        把缓冲区中最新的传感器数据添加到SensorBatch中，不创建SensorData对象。尚未采样时不添加。
+
+        :param SensorBatch batch: 要添加到的SensorBatch
+        """
+        latest = self.buffer.get_latest()
+        if latest is not None:
+            batch.append(self.sensor_id, self.sensor_type, latest[0], latest[1])
 
     def get_json_dumps_sensor_data(self):
         """
-        读取传感器数据(SensorData)并返回其Json形式的字符串。
+        返回缓冲区中最新的传感器数据(SensorData)的Json形式的字符串。尚未采样时返回None。
 
         :rtype: str
         """
-        return self.sensor.get_json_dumps_data()
+        sensor_data = self.get_data()
+        if sensor_data is None:
+            return None
+        return sensor_data.get_json_dumps()
+
+    def sample(self):
+        """
+        读取一次传感器，并将采样值写入环形缓冲区。
+        之后用过滤规则检查采样值，如果警报状态发生变化且配置允许，则向Server推送。
+        """
+        sensor_data = self.sensor.get_data()
+        self.buffer.append(sensor_data.raw_value, sensor_data.timestamp)
+        self.stream.publish(sensor_data)
+
+        is_warning = not self.node.filter_sensor_data(sensor_data)
+        if is_warning != self.is_warning:
+            self.is_warning = is_warning
+            server_monitor = self.node.server_monitor
+            if self.node.config.push_warnings and (server_monitor is not None):
+                # 放入有序的推送队列或发件箱，不阻塞采样
+                server_monitor.push_warning(sensor_data, is_warning)
 
     def run(self):
         """
         线程的入口方法。
-        已经移除了线程自己定期检查传感器值并发送给Server的逻辑。
+        初始化传感器后，每隔sample_interval秒读取一次传感器，直到线程被停止。线程结束时关闭传感器。
+        初始化失败时记录日志并结束线程。
         """
 
-        # 初始化传感器
-        self.sensor.initialize()
-
-        while not self.stop_event.wait(self.sensor_interval):
+        try:
+            # 初始化传感器
             try:
-                pass  # 移除部分
+                self.sensor.initialize()
             except Exception as e:
-                logging.exception("[SensorThread.run] exception:" + str(e))
+                logging.exception("[SensorThread.run] cannot initialize sensor_id=%s. exception:%s" % (self.sensor_id, str(e)))
+                return
+
+            while not self.stop_event.is_set():
+                try:
+                    self.sample()
+                except Exception as e:
+                    logging.exception("[SensorThread.run] sensor_id=%s exception:%s" % (self.sensor_id, str(e)))
+                self.stop_event.wait(self.sample_interval)
+        finally:
+            if self.sensor.is_initialized:
+                self.sensor.close()
+            self.stream.close()
 
     def stop(self):
         """
-        停止线程。同时将关闭传感器。
+        停止线程。线程将在当前的采样结束后关闭传感器。数据流的连接将被结束。
         """
 
-        self.sensor.close()
         self.stop_event.set()
+        self.stream.close()
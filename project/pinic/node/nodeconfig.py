@@ -18,24 +18,46 @@ NodeConfig配置类用于解析和封装Node的配置。
         "node_desc":"Test node.",            # Node的描述文本
         "server_addr":"127.0.0.1",           # 要连接到的Server的IP地址
         "server_port":9002,                  # 要连接到的Server的端口
+        "push_warnings":true,                # 可选。传感器进入或离开警报状态时，是否主动向Server推送。默认为true
+        "outbox_path":"outbox.dat",          # 可选。发件箱的文件路径，为空字符串时不使用发件箱，直接推送。默认为""，即不使用
+        "outbox_max_bytes":4194304,          # 可选。发件箱中未发送的数据的最大字节数，超过时丢弃最旧的数据。默认为4194304
+        "outbox_batch_size":100,             # 可选。发件箱每次向Server发送的最大记录数。默认为100
+        "outbox_drain_rate":5.0,             # 可选。补发积压的数据时，每秒最多发送的批数。默认为5.0
+        "report_interval":0,                 # 可选。每隔这个间隔（秒）把期间的所有采样值经发件箱发送给Server，为0时不发送。默认为0
         "sensors":[                          # 本机连接到Node的传感器列表
             {
                 "sensor_type":"stub",            # 传感器的设备类型
                 "sensor_id":"TEST-SENSOR-1",     # 传感器的ID，建议在网络中唯一
                 "sensor_desc":"Test sensor.",    # 传感器描述文字
-                "sensor_config": {}              # 传感器初始化配置，可留空（设置为{}）。
+                "sensor_config": {},             # 传感器初始化配置，可留空（设置为{}）。
+                "sample_interval": 1.0           # 可选。采样间隔（秒），Node将以这个间隔在后台读取传感器。默认为1.0
             }
         ],
         "filters":[                           # 传感数据过滤规则列表
             {
                 "apply_on_sensor_type":"none",     # 在特定类型传感器上使用。设为"*"则包含任意传感器。
                 "apply_on_sensor_id":"none",       # 在特定ID的传感器上使用。设为"*"则包含任意传感器。
-                "comparing_method":"greater_than", # 可为"greater_than"和"less_than"。符合的数据被抛弃。
-                "threshold":100                    # 阈值。例如，"greater_than" 100，则大于100的数据被抛弃。
+                "comparing_method":"greater_than", # 比较方法，见下文。符合的数据被抛弃。
+                "threshold":100                    # 阈值，可以是整数或小数。例如，"greater_than" 100，则大于100的数据被抛弃。
             }
         ]
     }
 
+比较方法
+========
+
+过滤规则的comparing_method可为以下的值。某些比较方法需要额外的键。详细说明参见nodefilter.py的文档。
+
+* "greater_than"、"less_than"：大于、小于threshold的数据被抛弃。
+
+* "in_range"：需要额外的键"threshold_high"。在[threshold, threshold_high]范围内的数据被抛弃。
+
+* "hysteresis"：需要额外的键"clear_threshold"。数据越过threshold进入警报，越过clear_threshold才解除警报。
+
+* "above_for"、"below_for"：需要额外的键"duration"（秒）。数据持续大于（小于）threshold达到duration秒时警报。
+
+* "rate_greater_than"：数据每秒变化量的绝对值大于threshold时警报。
+
 """
 
 __author__ = "tgmerge"
@@ -65,6 +87,17 @@ class NodeConfig(object):
         ("filters", list)
     ]
 
+    # 用于在Json解析中，检查配置的第一级可选键值是否有误。
+    # 每项为(键, 类型, 默认值)，缺失的可选键将被设置为默认值。
+    first_level_optional_check = [
+        ("push_warnings", bool, True),
+        ("outbox_path", basestring, ""),
+        ("outbox_max_bytes", int, 4194304),
+        ("outbox_batch_size", int, 100),
+        ("outbox_drain_rate", (int, float), 5.0),
+        ("report_interval", (int, float), 0)
+    ]
+
     # 用于在Json解析中，检查配置的第二级键值是否有误
     second_level_item = [
         "sensors",
@@ -83,10 +116,27 @@ class NodeConfig(object):
             ("apply_on_sensor_type", basestring),
             ("apply_on_sensor_id", basestring),
             ("comparing_method", basestring),
-            ("threshold", int)
+            ("threshold", (int, float))
         ]
     }
 
+    # 用于在Json解析中，检查某些比较方法的过滤规则所需的额外键值是否有误
+    filter_method_checks = {
+        "in_range": [("threshold_high", (int, float))],
+        "hysteresis": [("clear_threshold", (int, float))],
+        "above_for": [("duration", (int, float))],
+        "below_for": [("duration", (int, float))]
+    }
+
+    # 用于在Json解析中，检查配置的第二级可选键值是否有误。
+    # 每项为(键, 类型, 默认值)，缺失的可选键将被设置为默认值。
+    second_level_optional_checks = {
+        "sensors": [
+            ("sample_interval", (int, float), 1.0)
+        ],
+        "filters": []
+    }
+
     def __init__(self, config_dict):
         """
         :param dict config_dict: 初始化用字典。用字典的对应键设置本NodeConfig对象的各个成员变量。
@@ -108,6 +158,18 @@ class NodeConfig(object):
 
         self.filters = config_dict["filters"]
 
+        self.push_warnings = config_dict["push_warnings"]
+
+        self.outbox_path = config_dict["outbox_path"]
+
+        self.outbox_max_bytes = config_dict["outbox_max_bytes"]
+
+        self.outbox_batch_size = config_dict["outbox_batch_size"]
+
+        self.outbox_drain_rate = config_dict["outbox_drain_rate"]
+
+        self.report_interval = config_dict["report_interval"]
+
     def get_json_string(self):
         """
         返回一个字符串，是本配置对象的Json数据。
@@ -124,7 +186,13 @@ class NodeConfig(object):
             "server_addr": self.server_addr,
             "server_port": self.server_port,
             "sensors": self.sensors,
-            "filters": self.filters
+            "filters": self.filters,
+            "push_warnings": self.push_warnings,
+            "outbox_path": self.outbox_path,
+            "outbox_max_bytes": self.outbox_max_bytes,
+            "outbox_batch_size": self.outbox_batch_size,
+            "outbox_drain_rate": self.outbox_drain_rate,
+            "report_interval": self.report_interval
         })
 
 
@@ -153,6 +221,22 @@ def parse_from_string(config_json):
         if not isinstance(config[key], val_type):
             raise ValueError("value of key '%s' is not a '%s' instance." % (key, str(val_type)))
 
+    # 检查第一级可选变量
+    for (key, val_type, default_val) in NodeConfig.first_level_optional_check:
+        if key not in config:
+            config[key] = default_val
+        elif not isinstance(config[key], val_type):
+            raise ValueError("value of key '%s' is not a '%s' instance." % (key, str(val_type)))
+
+    if config["outbox_max_bytes"] <= 0:
+        raise ValueError("value of key 'outbox_max_bytes' must be positive.")
+    if config["outbox_batch_size"] <= 0:
+        raise ValueError("value of key 'outbox_batch_size' must be positive.")
+    if config["outbox_drain_rate"] <= 0:
+        raise ValueError("value of key 'outbox_drain_rate' must be positive.")
+    if config["report_interval"] < 0:
+        raise ValueError("value of key 'report_interval' must not be negative.")
+
     logging.debug("[parse_from_string] first level item checked")
 
     # 检查第二级变量
@@ -164,6 +248,24 @@ def parse_from_string(config_json):
                     raise ValueError("key '%s' is not in '%s' list in config json" % (key, parent_key))
                 if not isinstance(dict_to_check[key], val_type):
                     raise ValueError("key '%s' is not '%s' instance in '%s' list" % (key, str(val_type), parent_key))
+            for (key, val_type, default_val) in NodeConfig.second_level_optional_checks[parent_key]:
+                if key not in dict_to_check:
+                    dict_to_check[key] = default_val
+                elif not isinstance(dict_to_check[key], val_type):
+                    raise ValueError("key '%s' is not '%s' instance in '%s' list" % (key, str(val_type), parent_key))
+
+    # 检查过滤规则中比较方法所需的额外变量
+    for data_filter in config["filters"]:
+        for (key, val_type) in NodeConfig.filter_method_checks.get(data_filter["comparing_method"], []):
+            if key not in data_filter:
+                raise ValueError("key '%s' is required by comparing_method '%s' in 'filters' list" % (key, data_filter["comparing_method"]))
+            if not isinstance(data_filter[key], val_type):
+                raise ValueError("key '%s' is not '%s' instance in 'filters' list" % (key, str(val_type)))
+
+    # 检查传感器的采样间隔
+    for sensor in config["sensors"]:
+        if sensor["sample_interval"] <= 0:
+            raise ValueError("sample_interval of sensor '%s' must be positive" % sensor["sensor_id"])
 
     logging.debug("[parse_from_string] second level item checked")
 
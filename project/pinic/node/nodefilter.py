@@ -0,0 +1,278 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Node的过滤规则引擎FilterEngine。
+
+Node的配置（NodeConfig.filters）中的每条过滤规则，在应用配置时被编译为一个过滤器对象。
+FilterEngine以(sensor_type, sensor_id)为键，为每个传感器保存适用于它的过滤器列表，
+规则中的通配符"*"在编译时就被展开。检查传感器数据时，只需遍历适用于该传感器的少数过滤器，
+不必每次重新读取所有规则并比较字符串。
+
+有状态的过滤器（滞回、持续时间、变化率）为每个传感器保存O(1)的状态，必须检查每一份采样值，
+因此它们总是全部被执行；无状态的过滤器在遇到第一个匹配时就停止检查。
+
+* 要检查一份传感器数据是否被过滤，使用FilterEngine.is_dropped(sensor_data)。
+
+过滤规则的比较方法
+==================
+
+和原有的规则一样，过滤器“匹配”的数据被丢弃（视为正常），未被任何过滤器匹配的数据才是警报。
+
+* "greater_than"、"less_than"：大于、小于threshold的数据被丢弃。
+
+* "in_range"：在[threshold, threshold_high]范围内的数据被丢弃，即超出范围时警报。
+
+* "hysteresis"：滞回比较。threshold为进入警报的阈值，clear_threshold为解除警报的阈值。
+  threshold大于clear_threshold时，数据大于threshold进入警报，之后直到数据小于clear_threshold才解除；
+  threshold小于clear_threshold时方向相反。不处于警报时，数据被丢弃。
+
+* "above_for"、"below_for"：数据持续大于（小于）threshold达到duration秒时警报，否则被丢弃。
+
+* "rate_greater_than"：数据每秒的变化量的绝对值大于threshold时警报，否则被丢弃。
+"""
+
+__author__ = "tgmerge"
+
+
+class ThresholdFilter(object):
+    """
+    比较阈值的过滤器，对应comparing_method为"greater_than"或"less_than"的过滤规则。
+    例如，"greater_than" 100，则大于100的数据被过滤（丢弃）。
+    """
+
+    is_stateful = False  # 过滤器是否保存状态。有状态的过滤器需要检查每一份数据
+
+    def __init__(self, filter_config):
+        """
+        :param dict filter_config: 一条过滤规则，即NodeConfig.filters中的一项
+        """
+        self.comparing_method = filter_config["comparing_method"]
+        self.threshold = filter_config["threshold"]
+        if self.comparing_method == "greater_than":
+            self.match = self.match_greater_than
+        else:
+            self.match = self.match_less_than
+
+    def match_greater_than(self, sensor_data):
+        """
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        return sensor_data.raw_value > self.threshold
+
+    def match_less_than(self, sensor_data):
+        """
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        return sensor_data.raw_value < self.threshold
+
+
+class RangeFilter(object):
+    """
+    范围过滤器，对应comparing_method为"in_range"的过滤规则。在[threshold, threshold_high]范围内的数据被丢弃。
+    """
+
+    is_stateful = False
+
+    def __init__(self, filter_config):
+        """
+        :param dict filter_config: 一条过滤规则，即NodeConfig.filters中的一项
+        """
+        self.low = filter_config["threshold"]
+        self.high = filter_config["threshold_high"]
+
+    def match(self, sensor_data):
+        """
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        return self.low <= sensor_data.raw_value <= self.high
+
+
+class HysteresisFilter(object):
+    """
+    滞回过滤器，对应comparing_method为"hysteresis"的过滤规则。
+    数据越过threshold后进入警报状态，直到越过clear_threshold才解除。不处于警报状态时，数据被丢弃。
+    """
+
+    is_stateful = True
+
+    def __init__(self, filter_config):
+        """
+        :param dict filter_config: 一条过滤规则，即NodeConfig.filters中的一项
+        """
+        self.set_threshold = filter_config["threshold"]
+        self.clear_threshold = filter_config["clear_threshold"]
+        self.is_rising = self.set_threshold >= self.clear_threshold  # 是否为数据升高时警报
+        self.in_alarm = False
+
+    def match(self, sensor_data):
+        """
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        value = sensor_data.raw_value
+        if self.is_rising:
+            if value > self.set_threshold:
+                self.in_alarm = True
+            elif value < self.clear_threshold:
+                self.in_alarm = False
+        else:
+            if value < self.set_threshold:
+                self.in_alarm = True
+            elif value > self.clear_threshold:
+                self.in_alarm = False
+        return not self.in_alarm
+
+
+class SustainedFilter(object):
+    """
+    持续时间过滤器，对应comparing_method为"above_for"或"below_for"的过滤规则。
+    数据持续大于（小于）threshold达到duration秒时不再丢弃，即产生警报。
+    """
+
+    is_stateful = True
+
+    def __init__(self, filter_config):
+        """
+        :param dict filter_config: 一条过滤规则，即NodeConfig.filters中的一项
+        """
+        self.threshold = filter_config["threshold"]
+        self.duration = filter_config["duration"]
+        self.is_above = filter_config["comparing_method"] == "above_for"
+        self.since = None  # 数据开始越过阈值的时间戳，未越过时为None
+
+    def match(self, sensor_data):
+        """
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        if self.is_above:
+            is_beyond = sensor_data.raw_value > self.threshold
+        else:
+            is_beyond = sensor_data.raw_value < self.threshold
+
+        if not is_beyond:
+            self.since = None
+            return True
+        if self.since is None:
+            self.since = sensor_data.timestamp
+        return sensor_data.timestamp - self.since < self.duration
+
+
+class RateFilter(object):
+    """
+    变化率过滤器，对应comparing_method为"rate_greater_than"的过滤规则。
+    和上一份数据相比，每秒变化量的绝对值大于threshold时不再丢弃，即产生警报。第一份数据总是被丢弃。
+    """
+
+    is_stateful = True
+
+    def __init__(self, filter_config):
+        """
+        :param dict filter_config: 一条过滤规则，即NodeConfig.filters中的一项
+        """
+        self.threshold = filter_config["threshold"]
+        self.last_value = None
+        self.last_timestamp = None
+
+    def match(self, sensor_data):
+        """
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        last_value, last_timestamp = self.last_value, self.last_timestamp
+        self.last_value, self.last_timestamp = sensor_data.raw_value, sensor_data.timestamp
+
+        if (last_timestamp is None) or (sensor_data.timestamp <= last_timestamp):
+            return True
+        rate = abs(sensor_data.raw_value - last_value) / (sensor_data.timestamp - last_timestamp)
+        return rate <= self.threshold
+
+
+# comparing_method的值 -> 过滤器类
+filter_classes = {
+    "greater_than": ThresholdFilter,
+    "less_than": ThresholdFilter,
+    "in_range": RangeFilter,
+    "hysteresis": HysteresisFilter,
+    "above_for": SustainedFilter,
+    "below_for": SustainedFilter,
+    "rate_greater_than": RateFilter
+}
+
+
+def create_filter(filter_config):
+    """
+    把一条过滤规则编译为过滤器对象。比较方法无效时返回None（原有行为是该规则不过滤任何数据）。
+
+    :param dict filter_config: 一条过滤规则，即NodeConfig.filters中的一项
+    """
+    filter_class = filter_classes.get(filter_config["comparing_method"])
+    if filter_class is None:
+        return None
+    return filter_class(filter_config)
+
+
+class FilterEngine(object):
+    """
+    编译后的过滤规则。每个传感器拥有自己的过滤器对象，因此有状态的过滤器为每个传感器分别保存状态。
+    """
+
+    def __init__(self, filters, sensors):
+        """
+        :param list filters: 过滤规则列表，即NodeConfig.filters
+        :param list sensors: 传感器配置列表，即NodeConfig.sensors。在创建时为这些传感器编译过滤器
+        """
+        self.filters = filters
+        self.compiled = {}  # 类型：dict，(sensor_type, sensor_id) -> (有状态过滤器的match方法list, 无状态过滤器的match方法list)
+        for sensor in sensors:
+            self.get_matchers(sensor["sensor_type"], sensor["sensor_id"])
+
+    def get_matchers(self, sensor_type, sensor_id):
+        """
+        返回适用于某个传感器的过滤器的match方法，形式为(有状态过滤器的list, 无状态过滤器的list)。
+        第一次访问一个传感器时编译。
+
+        :param basestring sensor_type: 传感器的种类
+        :param basestring sensor_id: 传感器的ID
+        :rtype: tuple
+        """
+        key = (sensor_type, sensor_id)
+        matchers = self.compiled.get(key)
+        if matchers is None:
+            matchers = ([], [])
+            for filter_config in self.filters:
+                # "*"将匹配任意的sensor_type和sensor_id
+                if filter_config["apply_on_sensor_type"] not in ("*", sensor_type):
+                    continue
+                if filter_config["apply_on_sensor_id"] not in ("*", sensor_id):
+                    continue
+                compiled_filter = create_filter(filter_config)
+                if compiled_filter is not None:
+                    matchers[0 if compiled_filter.is_stateful else 1].append(compiled_filter.match)
+            self.compiled[key] = matchers
+        return matchers
+
+    def is_dropped(self, sensor_data):
+        """
+        检查一份传感器数据。如果和任何一个过滤器匹配，则它被过滤（丢弃），返回True。
+        有状态的过滤器总是全部执行，以更新它们的状态；无状态的过滤器在第一个匹配时停止。
+
+        :param SensorData sensor_data: 要检查的传感器数据
+        :rtype: bool
+        """
+        stateful_matchers, stateless_matchers = self.get_matchers(sensor_data.sensor_type, sensor_data.sensor_id)
+
+        is_dropped = False
+        for match in stateful_matchers:
+            if match(sensor_data):
+                is_dropped = True
+        if is_dropped:
+            return True
+
+        for match in stateless_matchers:
+            if match(sensor_data):
+                return True
+        return False
@@ -0,0 +1,190 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Node的发件箱Outbox。
+
+Node要发送给Server的警报和传感器数据先写入发件箱，再由后台线程分批发送。
+Server无法访问时，数据保存在发件箱的文件中，Server恢复后按顺序补发，Node重启也不会丢失。
+
+发件箱的文件
+============
+
+* 数据文件只追加写入。每条记录为4字节的小端序长度，之后是该长度的记录内容（一个Json字符串）。
+
+* 检查点文件（数据文件名加上 ``.offset`` ）保存第一条尚未发送成功的记录在数据文件中的偏移。
+  检查点先写入临时文件再替换，不会写坏。
+
+* 所有记录都发送成功后，数据文件被清空；已发送的部分超过数据文件的一半时，数据文件被重写为只含未发送的部分。
+
+* 未发送的数据超过max_bytes时，最旧的记录被丢弃，使发件箱的大小有上限。
+
+* 要写入一条记录，使用Outbox.append(record)。要发送，使用Outbox.read_batch(max_count)读取一批记录，
+  发送成功后使用Outbox.commit(end_offset)前进检查点。
+"""
+
+__author__ = "tgmerge"
+
+
+import struct
+import os
+import logging
+
+
+length_format = "<I"
+length_size = struct.calcsize(length_format)
+
+
+class Outbox(object):
+    """
+    基于文件、带检查点的发件箱。所有方法都不会让出执行权，可以在多个greenlet中调用。
+    """
+
+    def __init__(self, path, max_bytes):
+        """
+        打开发件箱。文件末尾不完整的记录（例如写入时断电）被截断。
+
+        :param str path: 数据文件的路径，目录不存在时创建
+        :param int max_bytes: 未发送的数据的最大字节数
+        """
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.max_bytes = max_bytes
+        self.dropped = 0  # 因超过max_bytes而丢弃的记录数
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.offset = self.read_checkpoint()  # 第一条未发送的记录的偏移
+        self.file = open(path, "ab+")
+        self.size = self.find_valid_size()  # 数据文件中完整记录的总字节数
+        if self.size != os.path.getsize(path):
+            self.file.truncate(self.size)
+        if self.offset > self.size:
+            self.offset = self.size
+
+    def read_checkpoint(self):
+        """
+        读取检查点文件。文件不存在或损坏时返回0。
+
+        :rtype: int
+        """
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def write_checkpoint(self):
+        """
+        写入检查点文件。
+        """
+        temp_path = self.offset_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(self.offset))
+        os.rename(temp_path, self.offset_path)
+
+    def find_valid_size(self):
+        """
+        从头扫描数据文件，返回完整记录的总字节数。
+
+        :rtype: int
+        """
+        file_size = os.path.getsize(self.path)
+        position = 0
+        self.file.seek(0)
+        while position + length_size <= file_size:
+            length = struct.unpack(length_format, self.file.read(length_size))[0]
+            if position + length_size + length > file_size:
+                break
+            self.file.seek(length, os.SEEK_CUR)
+            position += length_size + length
+        return position
+
+    def __len__(self):
+        """
+        返回未发送的数据的字节数。
+
+        :rtype: int
+        """
+        return self.size - self.offset
+
+    def append(self, record):
+        """
+        写入一条记录。未发送的数据超过max_bytes时，丢弃最旧的记录。
+
+        :param str record: 记录的内容
+        """
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(struct.pack(length_format, len(record)) + record)
+        self.file.flush()
+        self.size += length_size + len(record)
+
+        while len(self) > self.max_bytes:
+            records, end_offset = self.read_batch(1)
+            if not records:
+                break
+            self.offset = end_offset
+            self.dropped += 1
+        self.write_checkpoint()
+
+    def read_batch(self, max_count):
+        """
+        从检查点开始读取最多max_count条记录，返回(记录的list, 这些记录之后的偏移)。
+
+        :param int max_count: 最多读取的记录数
+        :rtype: tuple
+        """
+        records = []
+        position = self.offset
+        self.file.seek(position)
+        while (len(records) < max_count) and (position < self.size):
+            length = struct.unpack(length_format, self.file.read(length_size))[0]
+            records.append(self.file.read(length))
+            position += length_size + length
+        return records, position
+
+    def commit(self, end_offset):
+        """
+        把检查点前进到end_offset，表示之前的记录已经发送成功。需要时清空或重写数据文件。
+
+        :param int end_offset: read_batch返回的偏移
+        """
+        self.offset = max(self.offset, min(end_offset, self.size))
+        if self.offset == self.size:
+            self.file.truncate(0)
+            self.size = 0
+            self.offset = 0
+        elif self.offset > self.size // 2:
+            self.rewrite()
+        self.write_checkpoint()
+
+    def rewrite(self):
+        """
+        把数据文件重写为只含未发送的部分，回收已发送的部分占用的空间。
+        """
+        self.file.seek(self.offset)
+        remaining = self.file.read(self.size - self.offset)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(remaining)
+        self.file.close()
+        # 先把检查点写为0，再替换数据文件。两者之间断电时，旧文件中已发送的记录会被重发，但不会丢失记录
+        self.offset = 0
+        self.write_checkpoint()
+        os.rename(temp_path, self.path)
+        self.file = open(self.path, "ab+")
+        self.size = len(remaining)
+        logging.debug("[Outbox.rewrite] rewrote outbox %s, %d bytes remaining" % (self.path, self.size))
+
+    def close(self):
+        self.file.close()
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "pending_bytes": len(self),
+            "dropped": self.dropped
+        }
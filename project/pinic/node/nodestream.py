@@ -0,0 +1,134 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Node的实时传感器数据流SensorStream。
+
+客户端通过Node的/node/stream/<node_id>/<sensor_id>保持一个长连接，每当SensorThread采样一次，
+新的采样值就作为一帧（Server-Sent Events或逐行的Json）发送给客户端，不必反复发送HTTP请求。
+
+每个客户端是一个StreamSubscriber，拥有一个有界的帧队列。
+发送速度跟不上采样速度的客户端，队列满后丢弃最旧的帧，不会阻塞采样，也不会占用无限的内存。
+客户端还可以用max_rate限制每秒最多接收的帧数，超出的采样值被抽稀（跳过）。
+
+* 采样线程使用SensorStream.publish(sensor_data)发布新的采样值。
+
+* HTTP处理方法使用SensorStream.subscribe(...)订阅，并在连接结束时使用SensorStream.unsubscribe(subscriber)退订。
+"""
+
+__author__ = "tgmerge"
+
+
+from collections import deque
+import threading
+
+
+class StreamSubscriber(object):
+    """
+    一个实时数据流的订阅者，即一个保持连接的客户端。
+    """
+
+    def __init__(self, queue_size, max_rate=None):
+        """
+        :param int queue_size: 帧队列的最大长度，队列满时丢弃最旧的帧
+        :param float max_rate: 每秒最多接收的帧数，为None时不限制
+        """
+        self.frames = deque(maxlen=queue_size)  # 类型：deque of SensorData，等待发送的帧
+        self.min_interval = (1.0 / max_rate) if max_rate else 0.0  # 相邻两帧的最小时间间隔（按采样时间戳）
+        self.last_timestamp = None  # 最近一个入队的帧的采样时间戳
+        self.event = threading.Event()  # 有新的帧时被设置。已经被gevent monkey_patch
+        self.dropped = 0  # 因队列已满而丢弃的帧数
+        self.skipped = 0  # 因max_rate而跳过的采样值数
+
+    def offer(self, sensor_data):
+        """
+        向队列中放入一帧。由SensorStream.publish调用，不会阻塞。
+
+        :param SensorData sensor_data: 新的采样值
+        """
+        if (self.last_timestamp is not None) and (sensor_data.timestamp - self.last_timestamp < self.min_interval):
+            self.skipped += 1
+            return
+        self.last_timestamp = sensor_data.timestamp
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1  # deque会自动丢弃最旧的一帧
+        self.frames.append(sensor_data)
+        self.event.set()
+
+    def take_all(self, timeout):
+        """
+        等待最多timeout秒，取出队列中的所有帧。超时时返回空的list。
+
+        :param float timeout: 最长的等待时间（秒）
+        :rtype: list
+        """
+        if not self.frames:
+            self.event.wait(timeout)
+        self.event.clear()
+        frames = list(self.frames)
+        self.frames.clear()
+        return frames
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "queued": len(self.frames),
+            "dropped": self.dropped,
+            "skipped": self.skipped
+        }
+
+
+class SensorStream(object):
+    """
+    一个传感器的实时数据流，向所有订阅者分发新的采样值。
+    """
+
+    def __init__(self):
+        self.subscribers = []  # 类型：list of StreamSubscriber
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, queue_size, max_rate=None):
+        """
+        添加一个订阅者并返回它。参数参见StreamSubscriber。
+
+        :rtype: StreamSubscriber
+        """
+        subscriber = StreamSubscriber(queue_size, max_rate)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        删除一个订阅者。订阅者不存在时什么也不做。
+
+        :param StreamSubscriber subscriber: 要删除的订阅者
+        """
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, sensor_data):
+        """
+        向所有订阅者发布一份新的采样值。
+
+        :param SensorData sensor_data: 新的采样值
+        """
+        for subscriber in self.subscribers:
+            subscriber.offer(sensor_data)
+
+    def close(self):
+        """
+        唤醒所有订阅者，例如在传感器线程停止时，让它们结束连接。
+        """
+        for subscriber in self.subscribers:
+            subscriber.event.set()
+
+    def get_stats(self):
+        """
+        返回所有订阅者的统计信息组成的list。
+
+        :rtype: list
+        """
+        return [subscriber.get_stats() for subscriber in self.subscribers]
@@ -0,0 +1,127 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含ExpiryRegistry类，是Server的已知Node列表和Forwarder的已知Server列表所共用的注册表。
+
+注册表以ID为键保存对象（NodeInfo或ServerInfo），查找、添加、删除的复杂度为O(1)，
+刷新最后存活时间的复杂度为O(log n)。
+注册表另外维护一个以last_active_time为键的最小堆，清理超时对象时只访问已经到期的堆顶元素，不扫描整个注册表。
+
+注册表的所有方法都在锁内完成，且不会让出执行权，可以在多个greenlet中并发调用。
+"""
+
+__author__ = "tgmerge"
+
+
+from heapq import heappush, heappop, heapify
+from time import time
+import threading
+
+
+class ExpiryRegistry(object):
+    """
+    以ID为键、带有超时清理功能的注册表。
+    保存的对象必须具有id和last_active_time两个属性。请通过本类的方法修改last_active_time。
+    """
+
+    compact_threshold = 64  # 堆中过期的条目比注册表中的对象多出这个数量的两倍以上时，重建堆
+
+    def __init__(self):
+        self.items = {}  # 类型：dict，ID -> 对象
+        self.heap = []  # 类型：list of (float, basestring)，(last_active_time, ID)的最小堆。可能含有已失效的条目
+        self.lock = threading.RLock()  # 已经被gevent monkey_patch
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item_id):
+        return item_id in self.items
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def get(self, item_id):
+        """
+        按ID查找对象。找不到时返回None。
+
+        :param basestring item_id: 要查找的ID
+        """
+        return self.items.get(item_id)
+
+    def values(self):
+        """
+        返回注册表中所有对象组成的list。返回的是副本，遍历时可以修改注册表。
+
+        :rtype: list
+        """
+        with self.lock:
+            return list(self.items.values())
+
+    def add(self, item):
+        """
+        添加一个对象。如果已经存在相同ID的对象，则替换它。
+
+        :param item: 要添加的对象，需要有id和last_active_time属性
+        """
+        with self.lock:
+            self.items[item.id] = item
+            self._push(item)
+
+    def remove(self, item_id):
+        """
+        按ID删除一个对象，返回被删除的对象。找不到时返回None。
+        堆中对应的条目不会立即删除，而是在到期或重建堆时丢弃。
+
+        :param basestring item_id: 要删除的ID
+        """
+        with self.lock:
+            return self.items.pop(item_id, None)
+
+    def refresh(self, item_id, timestamp=None):
+        """
+        刷新一个对象的最后存活时间。返回是否找到了该对象。
+
+        :param basestring item_id: 要刷新的ID
+        :param float timestamp: 新的最后存活时间，默认为当前时间
+        :rtype: bool
+        """
+        with self.lock:
+            item = self.items.get(item_id)
+            if item is None:
+                return False
+            item.last_active_time = time() if timestamp is None else timestamp
+            self._push(item)
+            return True
+
+    def pop_expired(self, max_live_interval, now=None):
+        """
+        删除并返回所有超过max_live_interval秒没有被刷新的对象。
+        只访问堆顶已经到期的条目，复杂度为O(k log n)，k为到期的条目数。
+
+        :param float max_live_interval: 最大存活时间（秒）
+        :param float now: 当前时间，默认为time()
+        :rtype: list
+        """
+        if now is None:
+            now = time()
+        expire_before = now - max_live_interval
+
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] < expire_before:
+                last_active_time, item_id = heappop(self.heap)
+                item = self.items.get(item_id)
+                # 只有当条目仍是该对象的最新条目时才删除，否则这是一个已失效的条目
+                if (item is not None) and (item.last_active_time == last_active_time):
+                    del self.items[item_id]
+                    expired.append(item)
+        return expired
+
+    def _push(self, item):
+        """
+        为对象的当前last_active_time在堆中添加一个条目。失效条目过多时重建堆。
+        """
+        heappush(self.heap, (item.last_active_time, item.id))
+        if len(self.heap) > 2 * len(self.items) + ExpiryRegistry.compact_threshold:
+            self.heap = [(i.last_active_time, i.id) for i in self.items.values()]
+            heapify(self.heap)
@@ -14,6 +14,10 @@
 
 * sensordata.SensorData类包装一份传感器数据。该模块还含有从文本解析传感数据的方法。
 
+* sensordata.SensorBatch类按列保存一批传感器数据，用于在缓冲区、批量接口之间传递大量数据。
+
+* sensorbuffer.SensorRingBuffer是保存一个传感器最近采样值的环形缓冲区。
+
 如果要……
 ==========
 
@@ -21,6 +25,7 @@
 并继承basesensor.BaseSensor类。示例见sensor_tlc1549.py和sensor_stub.py。
 
 * 要处理传感器数据，请参考sensordata.SensorData.get_json_dumps()方法和sensordata.parse_from_string(str)方法。
+  要处理大量的传感器数据，请使用sensordata.SensorBatch。
 """
 
 __author__ = 'tgmerge'
@@ -0,0 +1,116 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含传感器数据的环形缓冲区SensorRingBuffer。
+
+SensorThread以固定的间隔采样传感器，并把采样值写入环形缓冲区。
+HTTP请求直接从缓冲区读取最新的采样值，而不必每次都访问传感器（例如SPI总线）。
+
+* 要写入一份采样值，使用SensorRingBuffer.append(raw_value, timestamp)。
+
+* 要读取最新的采样值，使用SensorRingBuffer.get_latest()。
+
+* 要读取最近的若干份采样值，使用SensorRingBuffer.get_recent(count)。
+
+* 要把最近的若干份采样值添加到SensorBatch中，使用SensorRingBuffer.extend_batch(batch, sensor_id, sensor_type, count)。
+"""
+
+__author__ = "tgmerge"
+
+
+from array import array
+
+
+class SensorRingBuffer(object):
+    """
+    定长的环形缓冲区，保存一个传感器最近的采样值和时间戳。
+    采样值和时间戳分别存放在两个array('d')中，写入时不产生新的对象。
+    缓冲区写满后，新的采样值将覆盖最旧的采样值。
+    """
+
+    def __init__(self, capacity):
+        """
+        :param int capacity: 缓冲区能保存的采样值的个数。
+        """
+        if capacity <= 0:
+            raise ValueError("capacity of SensorRingBuffer must be positive, got %s" % str(capacity))
+
+        self.capacity = capacity
+        self.raw_values = array("d", [0.0]) * capacity  # 类型：array，采样值
+        self.timestamps = array("d", [0.0]) * capacity  # 类型：array，采样时间戳
+        self.total_count = 0  # 类型：int，自创建以来写入的采样值总数
+
+    def __len__(self):
+        """
+        返回缓冲区中当前保存的采样值个数。
+
+        :rtype: int
+        """
+        return min(self.total_count, self.capacity)
+
+    def append(self, raw_value, timestamp):
+        """
+        写入一份采样值。缓冲区已满时覆盖最旧的一份。
+
+        :param float raw_value: 采样值
+        :param float timestamp: 采样时间戳
+        """
+        index = self.total_count % self.capacity
+        self.raw_values[index] = raw_value
+        self.timestamps[index] = timestamp
+        self.total_count += 1
+
+    def get_latest(self):
+        """
+        返回最新的一份采样值，形式为(raw_value, timestamp)。缓冲区为空时返回None。
+
+        :rtype: tuple
+        """
+        if self.total_count == 0:
+            return None
+        index = (self.total_count - 1) % self.capacity
+        return self.raw_values[index], self.timestamps[index]
+
+    def get_recent(self, count):
+        """
+        返回最近的count份采样值，形式为(raw_value, timestamp)的list，按时间从旧到新排列。
+
+        :param int count: 要返回的采样值个数，超过缓冲区中的个数时返回全部
+        :rtype: list
+        """
+        count = min(count, len(self))
+        start = self.total_count - count
+        result = []
+        for n in xrange(start, self.total_count):
+            index = n % self.capacity
+            result.append((self.raw_values[index], self.timestamps[index]))
+        return result
+
+    def get_recent_arrays(self, count):
+        """
+        返回最近的count份采样值，形式为(采样值的array, 时间戳的array)，按时间从旧到新排列。
+        使用数组切片复制，不为每份采样值创建tuple。
+
+        :param int count: 要返回的采样值个数，超过缓冲区中的个数时返回全部
+        :rtype: tuple
+        """
+        count = min(count, len(self))
+        start = (self.total_count - count) % self.capacity
+        end = start + count
+        if end <= self.capacity:
+            return self.raw_values[start:end], self.timestamps[start:end]
+        end -= self.capacity
+        return (self.raw_values[start:] + self.raw_values[:end],
+                self.timestamps[start:] + self.timestamps[:end])
+
+    def extend_batch(self, batch, sensor_id, sensor_type, count):
+        """
+        把最近的count份采样值添加到SensorBatch中。
+
+        :param SensorBatch batch: 要添加到的SensorBatch
+        :param str sensor_id: 传感器的ID
+        :param str sensor_type: 传感器的种类
+        :param int count: 要添加的采样值个数，超过缓冲区中的个数时添加全部
+        """
+        raw_values, timestamps = self.get_recent_arrays(count)
+        batch.extend(sensor_id, sensor_type, raw_values, timestamps)
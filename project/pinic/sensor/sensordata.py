@@ -8,19 +8,54 @@
 * 要Json化一个SensorData对象，可以使用SensorData.get_json_dumps()方法。
 
 * 要从Json文本解析SensorData对象，可以使用本模块中的parse_from_string(str)方法。
+
+* 要保存或传输大量的传感器数据，使用SensorBatch。它按列存放数据，不为每份数据创建SensorData对象。
+  SensorBatch.to_json()和SensorBatch.from_json(str)与Json数组互相转换，数组的每一项和SensorData的Json相同。
+  NaN和无穷大不是合法的Json，SensorData.get_json_dumps()和SensorBatch.to_json()把它们写为null；
+  解析时传感值为null的数据被读取为NaN。
+
+二进制格式
+==========
+
+除Json外，传感器数据还可以用紧凑的二进制格式传输，Content-Type为binary_content_type。
+Node、Server和Forwarder根据请求的Accept头选择格式，没有要求二进制格式时仍返回Json，以便浏览器直接使用。
+一份SensorData按只含一份数据的SensorBatch编码。格式如下，所有整数和浮点数均为小端序：
+
+* 头部：binary_header_format，即(magic "PSDB", 版本号, 保留字节, 传感器数, 数据份数)。
+
+* 传感器表：每个传感器为(sensor_id的字节数, sensor_type的字节数)，之后是UTF-8编码的sensor_id和sensor_type。
+
+* 数据：依次为所有数据的传感器表索引（uint32）、所有传感值（double）、所有时间戳（double）。
+
+* 要按请求的Accept头编码数据，使用encode_batch(batch, accept)；要按Content-Type解码，使用decode_batch(body, content_type)。
 """
 
 __author__ = "tgmerge"
 
 
-from json import loads
+from json import loads, dumps
+from array import array
+from math import isinf, isnan
+import struct
+
+
+json_content_type = "application/json"
+binary_content_type = "application/x-pinic-sensordata"
+
+binary_magic = "PSDB"
+binary_version = 1
+binary_header_format = "<4sBBHI"  # magic、版本号、保留字节、传感器数、数据份数
+binary_id_format = "<HH"  # sensor_id和sensor_type的字节数
 
 
 class SensorData(object):
     """
     SensorData对象是一份传感器数据。
+    使用__slots__，不为每个实例创建__dict__。
     """
 
+    __slots__ = ("sensor_id", "sensor_type", "raw_value", "timestamp")
+
     def __init__(self, sensor_id="", sensor_type="", raw_value=None, timestamp=None):
         """
         :param str sensor_id:   源传感器的ID。
@@ -34,24 +69,274 @@ class SensorData(object):
         self.raw_value = raw_value
         self.timestamp = timestamp
 
-    def get_json_dumps(self):
+    def get_dict(self):
         """
-        返回代表该SensorData数据的JSON。
+        以dict的形式返回该SensorData数据。
 
-        :rtype: str
+        :rtype: dict
         """
-        from json import dumps
-        return dumps({
+        return {
             "sensor_id": self.sensor_id,
             "sensor_type": self.sensor_type,
             "raw_value": self.raw_value,
             "timestamp": self.timestamp
-        })
+        }
+
+    def get_json_dumps(self):
+        """
+        返回代表该SensorData数据的JSON。与SensorBatch.to_json()相同，NaN和无穷大写为null。
+
+        :rtype: str
+        """
+        json_obj = self.get_dict()
+        json_obj["raw_value"] = json_float(self.raw_value)
+        json_obj["timestamp"] = json_float(self.timestamp)
+        return dumps(json_obj)
+
+    def get_binary_dumps(self):
+        """
+        返回代表这个SensorData的二进制数据，即只含这一份数据的SensorBatch。
+
+        :rtype: str
+        """
+        batch = SensorBatch()
+        batch.append_data(self)
+        return batch.to_binary()
+
+
+class SensorBatch(object):
+    """
+    按列存放的一批传感器数据。
+    传感器的(sensor_id, sensor_type)在id_table中只保存一次，每份数据只记录它在id_table中的索引；
+    传感值和时间戳分别存放在array('d')中。
+    """
+
+    def __init__(self):
+        self.id_table = []  # 类型：list of (sensor_id, sensor_type)，不重复的传感器
+        self.id_lookup = {}  # 类型：dict，(sensor_id, sensor_type) -> 在id_table中的索引
+        self.id_indexes = array("I")  # 每份数据对应的id_table索引
+        self.raw_values = array("d")  # 每份数据的传感值
+        self.timestamps = array("d")  # 每份数据的时间戳
+
+    def __len__(self):
+        return len(self.raw_values)
+
+    def __getitem__(self, index):
+        """
+        以SensorData对象的形式返回第index份数据。
+
+        :rtype: SensorData
+        """
+        sensor_id, sensor_type = self.id_table[self.id_indexes[index]]
+        return SensorData(sensor_id, sensor_type, self.raw_values[index], self.timestamps[index])
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def get_id_index(self, sensor_id, sensor_type):
+        """
+        返回传感器在id_table中的索引。传感器不在id_table中时添加它。
+
+        :rtype: int
+        """
+        key = (sensor_id, sensor_type)
+        index = self.id_lookup.get(key)
+        if index is None:
+            index = len(self.id_table)
+            self.id_table.append(key)
+            self.id_lookup[key] = index
+        return index
+
+    def append(self, sensor_id, sensor_type, raw_value, timestamp):
+        """
+        添加一份数据。
+
+        :param str sensor_id:   源传感器的ID。
+        :param str sensor_type: 源传感器的种类(type值)。
+        :param float raw_value: 原始数据的值。
+        :param float timestamp: 产生该数据的时间戳。
+        """
+        self.id_indexes.append(self.get_id_index(sensor_id, sensor_type))
+        self.raw_values.append(raw_value)
+        self.timestamps.append(timestamp)
+
+    def append_data(self, sensor_data):
+        """
+        添加一份SensorData。
+
+        :param SensorData sensor_data: 要添加的数据
+        """
+        self.append(sensor_data.sensor_id, sensor_data.sensor_type, sensor_data.raw_value, sensor_data.timestamp)
+
+    def extend(self, sensor_id, sensor_type, raw_values, timestamps):
+        """
+        添加同一个传感器的多份数据。
+
+        :param str sensor_id:   源传感器的ID。
+        :param str sensor_type: 源传感器的种类(type值)。
+        :param raw_values: 传感值的序列
+        :param timestamps: 时间戳的序列，长度和raw_values相同
+        """
+        if len(raw_values) != len(timestamps):
+            raise ValueError("raw_values and timestamps have different lengths")
+        index = self.get_id_index(sensor_id, sensor_type)
+        self.id_indexes.extend(array("I", [index]) * len(raw_values))
+        self.raw_values.extend(raw_values)
+        self.timestamps.extend(timestamps)
+
+    def to_json(self):
+        """
+        返回代表这批数据的Json数组，数组的每一项和SensorData.get_json_dumps()的结果相同。
+        每个传感器的Json前缀只生成一次，不为每份数据创建dict。
+
+        :rtype: str
+        """
+        prefixes = ['{"sensor_id": %s, "sensor_type": %s, "raw_value": ' % (dumps(sensor_id), dumps(sensor_type))
+                    for (sensor_id, sensor_type) in self.id_table]
+        raw_values = self.raw_values
+        timestamps = self.timestamps
+        items = [prefixes[id_index] + format_json_float(raw_values[n]) + ', "timestamp": ' + format_json_float(timestamps[n]) + "}"
+                 for n, id_index in enumerate(self.id_indexes)]
+        return "[" + ", ".join(items) + "]"
+
+    @classmethod
+    def from_json(cls, data_json):
+        """
+        从Json数组解析SensorBatch。数组的每一项和SensorData的Json相同。
+        如果解析中发现缺失的键，或值的类型错误，将抛出ValueError异常。
+
+        :param str data_json: Json字符串
+        :rtype: SensorBatch
+        """
+        return cls.from_list(loads(data_json))
+
+    @classmethod
+    def from_list(cls, data_list):
+        """
+        从已经解析的Json数组（dict的list）创建SensorBatch。检查方式同from_json。
+        传感值为null（to_json对NaN和无穷大的写法）时，读取为NaN。
+
+        :param list data_list: SensorData的dict形式组成的list
+        :rtype: SensorBatch
+        """
+        if not isinstance(data_list, list):
+            raise ValueError("data_json is not a json array")
+
+        batch = cls()
+        for data in data_list:
+            if not isinstance(data, dict):
+                raise ValueError("item of data_json is not a json object")
+            for (key, key_type) in batch_item_checks:
+                if key not in data:
+                    raise ValueError("key %s is not in data_json" % key)
+                if (key == "raw_value") and (data[key] is None):
+                    continue
+                if not isinstance(data[key], key_type):
+                    raise ValueError("key %s is not '%s' instance" % (key, str(key_type)))
+            raw_value = float(data["raw_value"]) if data["raw_value"] is not None else float("nan")
+            batch.append(data["sensor_id"], data["sensor_type"], raw_value, float(data["timestamp"]))
+        return batch
+
+    def to_binary(self):
+        """
+        返回代表这批数据的二进制数据，格式参见本模块的文档。
+
+        :rtype: str
+        """
+        count = len(self)
+        parts = [struct.pack(binary_header_format, binary_magic, binary_version, 0, len(self.id_table), count)]
+        for (sensor_id, sensor_type) in self.id_table:
+            id_bytes = sensor_id.encode("utf-8")
+            type_bytes = sensor_type.encode("utf-8")
+            parts.append(struct.pack(binary_id_format, len(id_bytes), len(type_bytes)))
+            parts.append(id_bytes)
+            parts.append(type_bytes)
+        parts.append(struct.pack("<%dI" % count, *self.id_indexes))
+        parts.append(struct.pack("<%dd" % count, *self.raw_values))
+        parts.append(struct.pack("<%dd" % count, *self.timestamps))
+        return "".join(parts)
+
+    @classmethod
+    def from_binary(cls, data):
+        """
+        从二进制数据解析SensorBatch，格式参见本模块的文档。
+        如果数据不完整或格式错误，将抛出ValueError异常。
+
+        :param str data: 二进制数据
+        :rtype: SensorBatch
+        """
+        try:
+            magic, version, _, id_count, count = struct.unpack_from(binary_header_format, data, 0)
+            if magic != binary_magic or version != binary_version:
+                raise ValueError("data is not pinic sensor data of version %d" % binary_version)
+            offset = struct.calcsize(binary_header_format)
+
+            batch = cls()
+            id_size = struct.calcsize(binary_id_format)
+            for n in xrange(id_count):
+                id_length, type_length = struct.unpack_from(binary_id_format, data, offset)
+                offset += id_size
+                sensor_id = data[offset:offset + id_length].decode("utf-8")
+                offset += id_length
+                sensor_type = data[offset:offset + type_length].decode("utf-8")
+                offset += type_length
+                batch.get_id_index(sensor_id, sensor_type)
+
+            id_indexes = struct.unpack_from("<%dI" % count, data, offset)
+            offset += 4 * count
+            raw_values = struct.unpack_from("<%dd" % count, data, offset)
+            offset += 8 * count
+            timestamps = struct.unpack_from("<%dd" % count, data, offset)
+            offset += 8 * count
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError("malformed binary sensor data: %s" % str(e))
+
+        if offset != len(data):
+            raise ValueError("binary sensor data has %d trailing bytes" % (len(data) - offset))
+        if count > 0 and max(id_indexes) >= id_count:
+            raise ValueError("binary sensor data refers to unknown sensor")
+        batch.id_indexes.extend(id_indexes)
+        batch.raw_values.extend(raw_values)
+        batch.timestamps.extend(timestamps)
+        return batch
+
+
+# 用于检查SensorBatch的Json数组中每一项的键值
+batch_item_checks = [
+    ("sensor_id", basestring),
+    ("sensor_type", basestring),
+    ("raw_value", (int, float)),
+    ("timestamp", (int, float)),
+]
+
+
+def format_json_float(value):
+    """
+    按json.dumps的方式把浮点数格式化为Json。NaN和无穷大不是合法的Json，格式化为null。
+
+    :param float value: 浮点数
+    :rtype: str
+    """
+    if isnan(value) or isinf(value):
+        return "null"
+    return repr(value)
+
+
+def json_float(value):
+    """
+    返回可以写入Json的值：NaN和无穷大返回None，即null；其他值原样返回。
+
+    :param float value: 浮点数，可以为None
+    """
+    if isinstance(value, float) and (isnan(value) or isinf(value)):
+        return None
+    return value
 
 
 def parse_from_string(data_json):
     """
-    从Json字符串解析SensorData，返回解析后的SensorData对象。
+    从Json字符串解析SensorData，返回解析后的SensorData对象。传感值为null时，读取为NaN。
 
     :param str data_json: Json字符串
 
@@ -60,6 +345,8 @@ def parse_from_string(data_json):
 
     # Load into dict
     data = loads(data_json)
+    if isinstance(data, dict) and ("raw_value" in data) and (data["raw_value"] is None):
+        data["raw_value"] = float("nan")
 
     # Check first level items
     valid_config_items = [
@@ -76,4 +363,73 @@ def parse_from_string(data_json):
             raise ValueError("key %s is not '%s' instance" % (key, str(keyType)))
 
     # Return new object
-    return SensorData(data["sensor_id"], data["sensor_type"], data["raw_value"], data["timestamp"])
\ No newline at end of file
+    return SensorData(data["sensor_id"], data["sensor_type"], data["raw_value"], data["timestamp"])
+
+
+def parse_from_binary(data):
+    """
+    从二进制数据解析SensorData，数据应为只含一份数据的SensorBatch，参见SensorData.get_binary_dumps()。
+
+    :param str data: 二进制数据
+
+    :rtype: SensorData
+    """
+    batch = SensorBatch.from_binary(data)
+    if len(batch) != 1:
+        raise ValueError("binary sensor data contains %d readings, expected 1" % len(batch))
+    return batch[0]
+
+
+def accepts_binary(accept):
+    """
+    检查HTTP请求的Accept头是否要求二进制格式。
+    Accept头中明确列出binary_content_type，其q值大于0，且不小于application/json的q值时，才使用二进制格式。
+    通配符（如*/*）不选择二进制格式。
+
+    :param str accept: Accept头的值，可以为None
+    :rtype: bool
+    """
+    if accept is None:
+        return False
+    qualities = {}
+    for media_range in accept.split(","):
+        params = media_range.split(";")
+        media_type = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        qualities[media_type] = max(quality, qualities.get(media_type, 0.0))
+    binary_quality = qualities.get(binary_content_type, 0.0)
+    return (binary_quality > 0) and (binary_quality >= qualities.get(json_content_type, 0.0))
+
+
+def encode_batch(batch, accept):
+    """
+    按HTTP请求的Accept头编码SensorBatch，返回(正文, Content-Type)。默认使用Json。
+
+    :param SensorBatch batch: 要编码的数据
+    :param str accept: 请求的Accept头，可以为None
+    :rtype: tuple
+    """
+    if accepts_binary(accept):
+        return batch.to_binary(), binary_content_type
+    return batch.to_json(), json_content_type
+
+
+def decode_batch(body, content_type):
+    """
+    按HTTP响应的Content-Type解码SensorBatch。Content-Type不是二进制格式时按Json数组解析。
+    解析失败时抛出ValueError异常。
+
+    :param str body: 响应的正文
+    :param str content_type: 响应的Content-Type，可以为None
+    :rtype: SensorBatch
+    """
+    if (content_type is not None) and content_type.startswith(binary_content_type):
+        return SensorBatch.from_binary(body)
+    return SensorBatch.from_json(body)
@@ -10,6 +10,13 @@ Server在启动时并不知道任何关于Node的信息。每一个Node启动后
 
 一段时间没有收到来自某个Node的心跳请求后，该Node将从已知Node列表中被删除。
 
+默认情况下，Node在传感器进入或离开警报状态时，主动向Server的/server/sensordata推送警报，
+Server再把警报转发给Forwarder。如果配置中的warning_mode为"poll"，Server改为定期向Node检查警报。
+配置了发件箱的Node改为向/server/sensordatabatch分批发送警报和采样值，Server无法访问期间积压的数据会在之后补发。
+
+经过Server的传感器数据和警报数据被写入history模块的HistoryStore，可以通过/server/history查询某个传感器的历史数据。
+已经封闭的历史数据段由HistoryCompactor线程在后台压缩，压缩格式参见gorilla模块。
+
 如果要……
 ==========
 
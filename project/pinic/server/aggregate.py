@@ -0,0 +1,145 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含对传感器历史数据（参见history模块）的降采样方法。
+
+* aggregate_buckets(timestamps, raw_values, time_from, bucket_width)：
+  把时间范围按bucket_width秒分桶，返回每个桶内数据的个数、最小值、最大值和平均值。
+
+* lttb(timestamps, raw_values, threshold)：
+  用LTTB（Largest-Triangle-Three-Buckets）算法从数据中挑选threshold个点，保留曲线的形状，适合绘制图表。
+
+两个方法的输入均为按时间排序的array('d')。安装了NumPy时，使用NumPy的向量化运算直接处理这些数组（不复制）；
+否则使用纯Python实现，结果相同。
+"""
+
+__author__ = "tgmerge"
+
+
+from array import array
+
+# NumPy是可选的依赖
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def aggregate_buckets(timestamps, raw_values, time_from, bucket_width):
+    """
+    把数据按时间分桶聚合。第n个桶的时间范围为[time_from + n * bucket_width, time_from + (n + 1) * bucket_width)。
+    返回dict，各键的值为等长的list，每项对应一个非空的桶：
+    "timestamp"为桶的开始时间戳，"count"、"min"、"max"、"mean"为桶内数据的个数、最小值、最大值和平均值。
+
+    :param array timestamps: 按时间排序的时间戳，不小于time_from
+    :param array raw_values: 对应的传感值
+    :param float time_from: 第一个桶的开始时间戳
+    :param float bucket_width: 每个桶的宽度（秒）
+    :rtype: dict
+    """
+    if numpy is not None:
+        return aggregate_buckets_numpy(timestamps, raw_values, time_from, bucket_width)
+
+    result = {"timestamp": [], "count": [], "min": [], "max": [], "mean": []}
+    current_bucket = None
+    for n in xrange(len(timestamps)):
+        bucket = int((timestamps[n] - time_from) // bucket_width)
+        value = raw_values[n]
+        if bucket != current_bucket:
+            if current_bucket is not None:
+                result["mean"][-1] /= result["count"][-1]
+            current_bucket = bucket
+            result["timestamp"].append(time_from + bucket * bucket_width)
+            result["count"].append(1)
+            result["min"].append(value)
+            result["max"].append(value)
+            result["mean"].append(value)  # 桶结束前暂存总和
+        else:
+            result["count"][-1] += 1
+            if value < result["min"][-1]:
+                result["min"][-1] = value
+            if value > result["max"][-1]:
+                result["max"][-1] = value
+            result["mean"][-1] += value
+    if current_bucket is not None:
+        result["mean"][-1] /= result["count"][-1]
+    return result
+
+
+def aggregate_buckets_numpy(timestamps, raw_values, time_from, bucket_width):
+    """
+    aggregate_buckets的NumPy实现。用reduceat在每个桶的边界处分段归约。
+    """
+    result = {"timestamp": [], "count": [], "min": [], "max": [], "mean": []}
+    if len(timestamps) == 0:
+        return result
+
+    ts = numpy.frombuffer(timestamps, dtype=numpy.float64)
+    values = numpy.frombuffer(raw_values, dtype=numpy.float64)
+    buckets = numpy.floor((ts - time_from) / bucket_width).astype(numpy.int64)
+
+    # 数据按时间排序，桶号变化的位置即为各桶的开始
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(buckets)) + 1))
+    counts = numpy.diff(numpy.append(starts, len(ts)))
+    sums = numpy.add.reduceat(values, starts)
+
+    result["timestamp"] = (time_from + buckets[starts] * bucket_width).tolist()
+    result["count"] = counts.tolist()
+    result["min"] = numpy.minimum.reduceat(values, starts).tolist()
+    result["max"] = numpy.maximum.reduceat(values, starts).tolist()
+    result["mean"] = (sums / counts).tolist()
+    return result
+
+
+def lttb(timestamps, raw_values, threshold):
+    """
+    用LTTB算法降采样，返回(时间戳的array, 传感值的array)。数据点不多于threshold时原样返回。
+    第一个和最后一个点总被保留；其余的点被分为threshold - 2个桶，每个桶选出与前一个选中点、
+    下一个桶的平均点组成的三角形面积最大的点。
+
+    :param array timestamps: 按时间排序的时间戳
+    :param array raw_values: 对应的传感值
+    :param int threshold: 要保留的点数，至少为3
+    :rtype: tuple
+    """
+    count = len(timestamps)
+    if (threshold >= count) or (threshold < 3):
+        return timestamps, raw_values
+
+    if numpy is not None:
+        ts = numpy.frombuffer(timestamps, dtype=numpy.float64)
+        values = numpy.frombuffer(raw_values, dtype=numpy.float64)
+
+    selected = [0]
+    bucket_size = float(count - 2) / (threshold - 2)
+    previous = 0
+    for n in xrange(threshold - 2):
+        # 当前桶和下一个桶的范围。最后一个桶的下一个桶是最后一个点
+        start = int(n * bucket_size) + 1
+        end = int((n + 1) * bucket_size) + 1
+        next_start = end
+        next_end = min(int((n + 2) * bucket_size) + 1, count)
+        if next_start >= count - 1:
+            next_start, next_end = count - 1, count
+
+        prev_t, prev_v = timestamps[previous], raw_values[previous]
+        if numpy is not None:
+            avg_t = ts[next_start:next_end].mean()
+            avg_v = values[next_start:next_end].mean()
+            areas = numpy.abs((prev_t - avg_t) * (values[start:end] - prev_v) -
+                              (prev_t - ts[start:end]) * (avg_v - prev_v))
+            previous = start + int(areas.argmax())
+        else:
+            span = next_end - next_start
+            avg_t = sum(timestamps[next_start:next_end]) / span
+            avg_v = sum(raw_values[next_start:next_end]) / span
+            max_area = -1.0
+            for m in xrange(start, end):
+                area = abs((prev_t - avg_t) * (raw_values[m] - prev_v) - (prev_t - timestamps[m]) * (avg_v - prev_v))
+                if area > max_area:
+                    max_area = area
+                    previous = m
+        selected.append(previous)
+    selected.append(count - 1)
+
+    return array("d", [timestamps[m] for m in selected]), array("d", [raw_values[m] for m in selected])
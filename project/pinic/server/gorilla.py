@@ -0,0 +1,314 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含传感器历史数据的压缩段格式，参考Facebook Gorilla时间序列数据库的编码方法。
+
+传感器通常以固定的间隔采样，相邻时间戳的差几乎不变；ADC读数变化也很小。因此：
+
+* 时间戳按微秒取整后，用“差的差”（delta-of-delta）编码，间隔不变时每个时间戳只占1位。
+
+* 传感值用与上一个值的异或（XOR）编码，值不变时只占1位，变化时只保存异或结果中有意义的位。
+
+压缩段文件的格式
+================
+
+* 数据按block_size条记录分块，每块独立编码，第一条记录以原始的64位值保存。
+  查询时只需要解码与时间范围重叠的块。
+
+* 文件依次为：所有块的数据、块索引、文件尾。
+  块索引的每项为index_entry_format，即(第一个时间戳, 最后一个时间戳, 块的偏移, 块的字节数, 记录数)。
+  文件尾为footer_format，即(magic "PSDG", 版本号, 块数, 块索引的偏移)。
+
+时间戳按微秒保存，解码后与原值的差在1微秒以内。
+
+* 要压缩一个段的数据，使用encode_segment(timestamps, raw_values)。
+
+* 要读取压缩段中某个时间范围的数据，使用read_segment_range(data, time_from, time_to)。
+"""
+
+__author__ = "tgmerge"
+
+
+from array import array
+from bisect import bisect_left, bisect_right
+import struct
+
+
+compressed_magic = "PSDG"
+compressed_version = 1
+index_entry_format = "<ddIII"
+index_entry_size = struct.calcsize(index_entry_format)
+footer_format = "<4sBIQ"
+footer_size = struct.calcsize(footer_format)
+default_block_size = 256
+
+mask64 = (1 << 64) - 1
+
+# 时间戳“差的差”的编码：(前缀, 前缀的位数, 值的位数)。值加上偏移量(1 << (值的位数 - 1)) - 1后保存为无符号数
+dod_classes = [
+    (0b10, 2, 7),
+    (0b110, 3, 14),
+    (0b1110, 4, 20)
+]
+
+
+class BitWriter(object):
+    """
+    按位写入的缓冲区。
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0  # 尚未凑满一个字节的位
+        self.nbits = 0  # acc中的位数
+
+    def write(self, value, nbits):
+        """
+        写入value的低nbits位，高位在前。
+        """
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.nbits += nbits
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.data.append((self.acc >> self.nbits) & 0xFF)
+        self.acc &= (1 << self.nbits) - 1
+
+    def get_bytes(self):
+        """
+        返回写入的所有数据，最后不满一个字节的部分用0补齐。
+
+        :rtype: str
+        """
+        data = bytearray(self.data)
+        if self.nbits > 0:
+            data.append((self.acc << (8 - self.nbits)) & 0xFF)
+        return str(data)
+
+
+class BitReader(object):
+    """
+    按位读取的缓冲区。
+    """
+
+    def __init__(self, data):
+        """
+        :param str data: 要读取的数据
+        """
+        self.data = bytearray(data)
+        self.pos = 0  # 下一个要读取的位的序号
+
+    def read(self, nbits):
+        """
+        读取nbits位，返回无符号整数。数据不足时抛出ValueError。
+        """
+        if self.pos + nbits > 8 * len(self.data):
+            raise ValueError("compressed block is truncated")
+        result = 0
+        while nbits > 0:
+            offset = self.pos & 7
+            available = 8 - offset
+            take = available if available < nbits else nbits
+            bits = (self.data[self.pos >> 3] >> (available - take)) & ((1 << take) - 1)
+            result = (result << take) | bits
+            self.pos += take
+            nbits -= take
+        return result
+
+    def read_bit(self):
+        return self.read(1)
+
+
+def float_to_bits(value):
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+
+def bits_to_float(bits):
+    return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+
+def to_signed64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def count_leading_zeros(value):
+    return 64 - value.bit_length()
+
+
+def count_trailing_zeros(value):
+    return (value & -value).bit_length() - 1
+
+
+def encode_block(timestamps, raw_values, start, end):
+    """
+    编码第start到第end条记录（不含end）为一个块。
+
+    :param array timestamps: 时间戳
+    :param array raw_values: 传感值
+    :rtype: str
+    """
+    writer = BitWriter()
+
+    # 第一条记录
+    previous_time = int(round(timestamps[start] * 1e6))
+    previous_bits = float_to_bits(raw_values[start])
+    writer.write(previous_time & mask64, 64)
+    writer.write(previous_bits, 64)
+    previous_delta = 0
+    previous_leading, previous_trailing = -1, -1
+
+    for n in xrange(start + 1, end):
+        # 时间戳：差的差
+        current_time = int(round(timestamps[n] * 1e6))
+        delta = current_time - previous_time
+        dod = delta - previous_delta
+        previous_time, previous_delta = current_time, delta
+        if dod == 0:
+            writer.write(0, 1)
+        else:
+            for (prefix, prefix_bits, value_bits) in dod_classes:
+                bias = (1 << (value_bits - 1)) - 1
+                if -bias <= dod <= bias + 1:
+                    writer.write(prefix, prefix_bits)
+                    writer.write(dod + bias, value_bits)
+                    break
+            else:
+                writer.write(0b1111, 4)
+                writer.write(dod & mask64, 64)
+
+        # 传感值：与上一个值异或
+        current_bits = float_to_bits(raw_values[n])
+        xor = current_bits ^ previous_bits
+        previous_bits = current_bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        leading = min(count_leading_zeros(xor), 31)
+        trailing = count_trailing_zeros(xor)
+        if (previous_leading >= 0) and (leading >= previous_leading) and (trailing >= previous_trailing):
+            # 有意义的位落在上一个窗口内，沿用上一个窗口
+            writer.write(0, 1)
+            writer.write(xor >> previous_trailing, 64 - previous_leading - previous_trailing)
+        else:
+            meaningful = 64 - leading - trailing
+            writer.write(1, 1)
+            writer.write(leading, 5)
+            writer.write(meaningful - 1, 6)
+            writer.write(xor >> trailing, meaningful)
+            previous_leading, previous_trailing = leading, trailing
+
+    return writer.get_bytes()
+
+
+def decode_block(data, count):
+    """
+    解码一个块，返回(时间戳的array, 传感值的array)。
+
+    :param str data: 块的数据
+    :param int count: 块中的记录数
+    :rtype: tuple
+    """
+    reader = BitReader(data)
+    timestamps = array("d")
+    raw_values = array("d")
+
+    previous_time = to_signed64(reader.read(64))
+    previous_bits = reader.read(64)
+    timestamps.append(previous_time / 1e6)
+    raw_values.append(bits_to_float(previous_bits))
+    previous_delta = 0
+    previous_leading, previous_trailing = -1, -1
+
+    for n in xrange(1, count):
+        # 时间戳。前缀为0到4个1，以0结束（4个1时没有结束的0）
+        ones = 0
+        while (ones < 4) and (reader.read_bit() == 1):
+            ones += 1
+        if ones == 0:
+            dod = 0
+        elif ones == 4:
+            dod = to_signed64(reader.read(64))
+        else:
+            value_bits = dod_classes[ones - 1][2]
+            dod = reader.read(value_bits) - ((1 << (value_bits - 1)) - 1)
+        previous_delta += dod
+        previous_time += previous_delta
+        timestamps.append(previous_time / 1e6)
+
+        # 传感值
+        if reader.read_bit() == 1:
+            if reader.read_bit() == 1:
+                previous_leading = reader.read(5)
+                meaningful = reader.read(6) + 1
+                previous_trailing = 64 - previous_leading - meaningful
+            else:
+                meaningful = 64 - previous_leading - previous_trailing
+            previous_bits ^= reader.read(meaningful) << previous_trailing
+        raw_values.append(bits_to_float(previous_bits))
+
+    return timestamps, raw_values
+
+
+def encode_segment(timestamps, raw_values, block_size=default_block_size, pause=None):
+    """
+    把一个段的数据编码为压缩段文件的内容。
+
+    :param array timestamps: 按时间排序的时间戳
+    :param array raw_values: 对应的传感值
+    :param int block_size: 每块的记录数
+    :param pause: 每编码一块后调用的函数，例如用于让出执行权。可以为None
+    :rtype: str
+    """
+    parts = []
+    index = []
+    offset = 0
+    for start in xrange(0, len(timestamps), block_size):
+        end = min(start + block_size, len(timestamps))
+        block = encode_block(timestamps, raw_values, start, end)
+        parts.append(block)
+        index.append(struct.pack(index_entry_format, round(timestamps[start] * 1e6) / 1e6,
+                                 round(timestamps[end - 1] * 1e6) / 1e6, offset, len(block), end - start))
+        offset += len(block)
+        if pause is not None:
+            pause()
+    parts.extend(index)
+    parts.append(struct.pack(footer_format, compressed_magic, compressed_version, len(index), offset))
+    return "".join(parts)
+
+
+def read_index(data):
+    """
+    读取压缩段的块索引，返回(第一个时间戳, 最后一个时间戳, 偏移, 字节数, 记录数)的list。
+
+    :param data: 压缩段文件的内容，可以是mmap或str
+    :rtype: list
+    """
+    if len(data) < footer_size:
+        raise ValueError("compressed segment is truncated")
+    magic, version, block_count, index_offset = struct.unpack_from(footer_format, data, len(data) - footer_size)
+    if (magic != compressed_magic) or (version != compressed_version):
+        raise ValueError("data is not a compressed segment of version %d" % compressed_version)
+    return [struct.unpack_from(index_entry_format, data, index_offset + n * index_entry_size)
+            for n in xrange(block_count)]
+
+
+def read_segment_range(data, time_from, time_to):
+    """
+    读取压缩段中[time_from, time_to]之间的记录，返回(时间戳的array, 传感值的array)。只解码与时间范围重叠的块。
+
+    :param data: 压缩段文件的内容，可以是mmap或str
+    :param float time_from: 开始时间戳
+    :param float time_to: 结束时间戳
+    :rtype: tuple
+    """
+    timestamps = array("d")
+    raw_values = array("d")
+    for (first_time, last_time, offset, length, count) in read_index(data):
+        if (last_time < time_from) or (first_time > time_to):
+            continue
+        block_times, block_values = decode_block(data[offset:offset + length], count)
+        start = bisect_left(block_times, time_from)
+        end = bisect_right(block_times, time_to)
+        timestamps.extend(block_times[start:end])
+        raw_values.extend(block_values[start:end])
+    return timestamps, raw_values
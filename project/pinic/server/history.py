@@ -0,0 +1,601 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Server的传感器历史数据存储HistoryStore。
+
+Server把经过自身的传感器数据（转发的传感器数据、Node推送和轮询得到的警报数据）写入HistoryStore，
+之后可以按时间范围查询某个传感器的历史数据。
+
+存储格式
+========
+
+* 每个传感器的数据保存在目录 ``<root_dir>/<node_id>/<sensor_id>/`` 下，ID经过URL编码以用作文件名，参见quote_id。
+  目录中的 ``sensor_type`` 文件保存传感器的种类。
+
+* 数据按时间窗口分为多个段（segment）文件，每个窗口长segment_duration秒，
+  文件名为 ``<窗口开始的时间戳>_<窗口长度>.raw`` 。窗口长度保存在文件名中，修改segment_duration后已有的段仍按原来的窗口查询；
+  此时新旧窗口可能重叠，查询结果会重新排序。没有窗口长度的旧文件名 ``<窗口开始的时间戳>.raw`` 按当前的segment_duration处理。
+
+* 段文件只追加写入，每条记录为定长的(timestamp, raw_value)，即record_format（两个小端序double）。
+  同一个传感器的数据可能不按时间顺序到达，例如Node发件箱中的警报先于覆盖同一时间段的采样值到达。
+  时间戳不大于上一条记录、但仍属于当前打开的段的数据也被写入，该段在被查询或关闭前按时间戳排序，
+  时间戳相同的记录只保留先写入的一条。更早的段已经封闭，属于它们的数据被丢弃。
+
+* 查询时用mmap映射段文件，用二分查找确定时间范围内的记录，不必读取整个文件。
+
+* 已经封闭的段（同一个传感器已经有更新的段，不会再被写入）可以用HistoryStore.compact_sealed()压缩为
+  ``<窗口开始的时间戳>_<窗口长度>.gor`` 文件，格式参见gorilla模块。压缩后的段仍可按块随机读取。
+  同一个窗口同时存在两种文件时（例如压缩中途断电），以压缩后的文件为准。
+
+* 要写入数据，使用HistoryStore.append(node_id, sensor_data)或HistoryStore.append_batch(node_id, batch)。
+
+* 要查询数据，使用HistoryStore.query(node_id, sensor_id, time_from, time_to)，返回SensorBatch。
+"""
+
+__author__ = "tgmerge"
+
+
+from pinic.sensor.sensordata import SensorBatch
+from pinic.server.gorilla import encode_segment, read_segment_range, read_index
+
+from collections import OrderedDict
+from urllib import quote, unquote
+from array import array
+import struct
+import mmap
+import sys
+import os
+import logging
+
+
+record_format = "<dd"  # 每条记录为(timestamp, raw_value)
+record_size = struct.calcsize(record_format)
+raw_segment_suffix = ".raw"
+compressed_segment_suffix = ".gor"
+
+
+def read_records(data, start=0, end=None):
+    """
+    把段文件中第start到第end条记录（不含end）读取为(时间戳的array, 传感值的array)。
+
+    :param data: 段文件的内容，可以是mmap或str
+    :param int start: 开始的记录序号
+    :param int end: 结束的记录序号，默认为最后一条记录之后
+    :rtype: tuple
+    """
+    if end is None:
+        end = len(data) // record_size
+    records = array("d")
+    records.fromstring(data[start * record_size:end * record_size])
+    if sys.byteorder == "big":
+        records.byteswap()
+    return records[0::2], records[1::2]
+
+
+def write_records(timestamps, raw_values):
+    """
+    把(时间戳的array, 传感值的array)转换为段文件的内容，是read_records的逆操作。
+
+    :rtype: str
+    """
+    records = array("d", [0.0]) * (2 * len(timestamps))
+    records[0::2] = timestamps
+    records[1::2] = raw_values
+    if sys.byteorder == "big":
+        records.byteswap()
+    return records.tostring()
+
+
+def is_sorted(timestamps):
+    """
+    检查时间戳是否严格递增。
+
+    :rtype: bool
+    """
+    return all(timestamps[n] < timestamps[n + 1] for n in xrange(len(timestamps) - 1))
+
+
+def sort_records(timestamps, raw_values):
+    """
+    按时间戳排序记录，时间戳相同的记录只保留先写入的一条。返回(时间戳的array, 传感值的array)。
+
+    :rtype: tuple
+    """
+    sorted_timestamps = array("d")
+    sorted_raw_values = array("d")
+    # sorted是稳定的，时间戳相同的记录保持写入的顺序
+    for n in sorted(xrange(len(timestamps)), key=timestamps.__getitem__):
+        if sorted_timestamps and (sorted_timestamps[-1] == timestamps[n]):
+            continue
+        sorted_timestamps.append(timestamps[n])
+        sorted_raw_values.append(raw_values[n])
+    return sorted_timestamps, sorted_raw_values
+
+
+def search_records(data, timestamp):
+    """
+    在段文件的内容中二分查找第一条时间戳不小于timestamp的记录，返回它的序号。
+
+    :param data: 段文件的内容，可以是mmap或str
+    :param float timestamp: 要查找的时间戳
+    :rtype: int
+    """
+    low, high = 0, len(data) // record_size
+    while low < high:
+        middle = (low + high) // 2
+        if struct.unpack_from(record_format, data, middle * record_size)[0] < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def quote_id(item_id):
+    """
+    把Node或传感器的ID编码为可以用作文件名的字符串。
+    quote不编码"."，开头的"."被编码为"%2E"，使"."、".."等ID不会指向上级目录或根目录本身。空的ID无法用作文件名，抛出ValueError。
+
+    :param basestring item_id: ID，unicode将按UTF-8编码
+    :rtype: str
+    """
+    if isinstance(item_id, unicode):
+        item_id = item_id.encode("utf-8")
+    if item_id == "":
+        raise ValueError("empty id cannot be used as a file name")
+    quoted_id = quote(item_id, safe="")
+    if quoted_id.startswith("."):
+        quoted_id = "%2E" + quoted_id[1:]
+    return quoted_id
+
+
+class SegmentWriter(object):
+    """
+    一个传感器当前时间窗口的段文件的写入者。
+    """
+
+    def __init__(self, path, window_start):
+        """
+        打开段文件以追加写入。文件末尾不完整的记录（例如写入时断电）被截断。
+        已有的记录未排序时（例如排序前断电），在下次查询或关闭时排序。
+
+        :param str path: 段文件的路径
+        :param int window_start: 段的时间窗口的开始时间戳
+        """
+        self.path = path
+        self.window_start = window_start
+        self.file = open(path, "ab")
+        size = os.path.getsize(path)
+        if size % record_size != 0:
+            size -= size % record_size
+            self.file.truncate(size)
+        self.unsorted = False  # 是否写入了时间戳不递增的记录。为True时，段文件不能被二分查找
+        if size > 0:
+            with open(path, "rb") as f:
+                self.unsorted = not is_sorted(read_records(f.read(size))[0])
+
+    def append(self, timestamp, raw_value):
+        """
+        追加一条记录。
+
+        :param float timestamp: 时间戳
+        :param float raw_value: 传感值
+        """
+        self.file.write(struct.pack(record_format, timestamp, raw_value))
+
+    def sort(self):
+        """
+        按时间戳排序段文件中的记录，并删除时间戳重复的记录。返回删除的记录数。
+
+        :rtype: int
+        """
+        self.file.flush()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        timestamps, raw_values = read_records(data)
+        timestamps, raw_values = sort_records(timestamps, raw_values)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(write_records(timestamps, raw_values))
+        self.file.close()
+        os.rename(temp_path, self.path)
+        self.file = open(self.path, "ab")
+        self.unsorted = False
+        return len(data) // record_size - len(timestamps)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class HistoryStore(object):
+    """
+    基于文件的传感器历史数据存储。所有方法都不会让出执行权，可以在多个greenlet中调用。
+    """
+
+    max_open_writers = 256  # 最多同时打开的段文件数，超过时关闭最久未写入的
+
+    def __init__(self, root_dir, segment_duration):
+        """
+        :param str root_dir: 存储的根目录，不存在时创建
+        :param int segment_duration: 每个段文件的时间窗口长度（秒）
+        """
+        self.root_dir = root_dir
+        self.segment_duration = segment_duration
+        self.writers = OrderedDict()  # 类型：OrderedDict，(node_id, sensor_id) -> SegmentWriter，按最近写入排序
+        self.last_timestamps = {}  # 类型：dict，(node_id, sensor_id) -> 最后一条记录的时间戳
+        self.dropped = 0  # 因属于已经封闭的段或时间戳重复而丢弃的数据数
+        self.compacted = 0  # 已经压缩的段数
+        self.compacted_bytes_saved = 0  # 压缩节省的字节数
+        if not os.path.isdir(root_dir):
+            os.makedirs(root_dir)
+
+    def get_sensor_dir(self, node_id, sensor_id):
+        """
+        返回传感器的数据目录。
+
+        :rtype: str
+        """
+        return os.path.join(self.root_dir, quote_id(node_id), quote_id(sensor_id))
+
+    def get_window_start(self, timestamp):
+        """
+        返回时间戳所在的时间窗口的开始时间戳。
+
+        :rtype: int
+        """
+        return int(timestamp // self.segment_duration) * self.segment_duration
+
+    def get_segment_name(self, window_start):
+        """
+        返回当前segment_duration下，一个窗口的原始段的文件名。
+
+        :rtype: str
+        """
+        return "%d_%d%s" % (window_start, self.segment_duration, raw_segment_suffix)
+
+    def parse_segment_name(self, name):
+        """
+        从去掉后缀的段文件名解析(窗口开始时间戳, 窗口结束时间戳)。旧的文件名没有窗口长度，按当前的segment_duration处理。
+
+        :rtype: tuple
+        """
+        if "_" in name:
+            window_start, duration = name.split("_", 1)
+            window_start, duration = int(window_start), int(duration)
+        else:
+            window_start, duration = int(name), self.segment_duration
+        return window_start, window_start + duration
+
+    def list_segments(self, node_id, sensor_id):
+        """
+        返回传感器的所有段文件，形式为(窗口开始时间戳, 窗口结束时间戳, 文件路径)的list，按窗口排序。
+
+        :rtype: list
+        """
+        sensor_dir = self.get_sensor_dir(node_id, sensor_id)
+        if not os.path.isdir(sensor_dir):
+            return []
+        segments = {}  # (窗口开始时间戳, 窗口结束时间戳) -> 文件路径
+        for file_name in os.listdir(sensor_dir):
+            if file_name.endswith(raw_segment_suffix):
+                window = self.parse_segment_name(file_name[:-len(raw_segment_suffix)])
+                segments.setdefault(window, os.path.join(sensor_dir, file_name))
+            elif file_name.endswith(compressed_segment_suffix):
+                window = self.parse_segment_name(file_name[:-len(compressed_segment_suffix)])
+                segments[window] = os.path.join(sensor_dir, file_name)
+        return sorted(window + (path,) for (window, path) in segments.items())
+
+    def get_last_timestamp(self, node_id, sensor_id):
+        """
+        返回传感器最后一条记录的时间戳，没有记录时返回None。第一次调用时从段文件读取。
+        窗口长度改变后，各段的窗口可能重叠，因此按窗口结束时间从后向前读取，直到剩下的段不可能含有更新的记录。
+
+        :rtype: float
+        """
+        key = (node_id, sensor_id)
+        if key not in self.last_timestamps:
+            last_timestamp = None
+            segments = sorted(self.list_segments(node_id, sensor_id), key=lambda x: x[1], reverse=True)
+            for _, window_end, path in segments:
+                if (last_timestamp is not None) and (window_end <= last_timestamp):
+                    break
+                segment_last_timestamp = self.read_last_timestamp(path)
+                if (segment_last_timestamp is not None) and ((last_timestamp is None) or (segment_last_timestamp > last_timestamp)):
+                    last_timestamp = segment_last_timestamp
+            self.last_timestamps[key] = last_timestamp
+        return self.last_timestamps[key]
+
+    def read_last_timestamp(self, path):
+        """
+        返回一个段文件中最后一条记录的时间戳，没有记录时返回None。
+
+        :rtype: float
+        """
+        if path.endswith(compressed_segment_suffix):
+            with open(path, "rb") as f:
+                index = read_index(f.read())
+            return index[-1][1] if index else None
+        size = os.path.getsize(path) // record_size * record_size
+        if size == 0:
+            return None
+        with open(path, "rb") as f:
+            f.seek(size - record_size)
+            return struct.unpack(record_format, f.read(record_size))[0]
+
+    def get_writer(self, node_id, sensor_id, sensor_type, timestamp):
+        """
+        返回时间戳所在的时间窗口的SegmentWriter。需要时创建目录和段文件。
+
+        :rtype: SegmentWriter
+        """
+        key = (node_id, sensor_id)
+        window_start = self.get_window_start(timestamp)
+        writer = self.writers.pop(key, None)
+        if (writer is not None) and (writer.window_start != window_start):
+            self.close_writer(writer)
+            writer = None
+        if writer is None:
+            sensor_dir = self.get_sensor_dir(node_id, sensor_id)
+            if not os.path.isdir(sensor_dir):
+                os.makedirs(sensor_dir)
+                with open(os.path.join(sensor_dir, "sensor_type"), "w") as f:
+                    f.write(sensor_type.encode("utf-8") if isinstance(sensor_type, unicode) else sensor_type)
+            writer = SegmentWriter(os.path.join(sensor_dir, self.get_segment_name(window_start)), window_start)
+        self.writers[key] = writer
+        while len(self.writers) > HistoryStore.max_open_writers:
+            _, evicted_writer = self.writers.popitem(last=False)
+            self.close_writer(evicted_writer)
+        return writer
+
+    def close_writer(self, writer):
+        """
+        关闭一个SegmentWriter。写入了时间戳不递增的记录时，先排序段文件。
+        """
+        try:
+            if writer.unsorted:
+                self.dropped += writer.sort()
+        except (IOError, OSError) as e:
+            logging.error("[HistoryStore.close_writer] cannot sort %s: %s" % (writer.path, str(e)))
+        writer.close()
+
+    def append(self, node_id, sensor_data):
+        """
+        写入一份传感器数据。
+
+        :param str node_id: 数据所属的Node的ID
+        :param SensorData sensor_data: 传感器数据
+        """
+        self.append_record(node_id, sensor_data.sensor_id, sensor_data.sensor_type,
+                           sensor_data.timestamp, sensor_data.raw_value)
+        self.flush()
+
+    def append_batch(self, node_id, batch):
+        """
+        写入一批传感器数据。
+
+        :param str node_id: 数据所属的Node的ID
+        :param SensorBatch batch: 传感器数据
+        """
+        for n in xrange(len(batch)):
+            sensor_id, sensor_type = batch.id_table[batch.id_indexes[n]]
+            self.append_record(node_id, sensor_id, sensor_type, batch.timestamps[n], batch.raw_values[n])
+        self.flush()
+
+    def append_record(self, node_id, sensor_id, sensor_type, timestamp, raw_value):
+        """
+        写入一条记录，但不刷新文件缓冲。
+        时间戳不大于上一条记录时，只有记录属于上一条记录所在的段（当前打开的段）才写入，该段被标记为需要排序；
+        时间戳与上一条记录相同的记录是重发的数据，直接丢弃。
+        """
+        try:
+            last_timestamp = self.get_last_timestamp(node_id, sensor_id)
+        except ValueError as e:
+            logging.warning("[HistoryStore.append_record] cannot record history of sensor_id=%s: %s" % (sensor_id, str(e)))
+            self.dropped += 1
+            return
+        out_of_order = (last_timestamp is not None) and (timestamp <= last_timestamp)
+        if out_of_order and ((timestamp == last_timestamp) or
+                             (self.get_window_start(timestamp) != self.get_window_start(last_timestamp))):
+            self.dropped += 1
+            return
+        try:
+            writer = self.get_writer(node_id, sensor_id, sensor_type, timestamp)
+            writer.append(timestamp, raw_value)
+        except (IOError, OSError) as e:
+            logging.error("[HistoryStore.append_record] cannot write history of sensor_id=%s: %s" % (sensor_id, str(e)))
+            return
+        if out_of_order:
+            writer.unsorted = True
+        else:
+            self.last_timestamps[(node_id, sensor_id)] = timestamp
+
+    def flush(self):
+        """
+        刷新所有打开的段文件的缓冲，使写入的数据可以被查询。
+        """
+        for writer in self.writers.values():
+            writer.flush()
+
+    def get_sensor_type(self, node_id, sensor_id):
+        """
+        返回传感器的种类。没有这个传感器的历史数据时返回None。
+
+        :rtype: unicode
+        """
+        path = os.path.join(self.get_sensor_dir(node_id, sensor_id), "sensor_type")
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return f.read().decode("utf-8")
+
+    def query(self, node_id, sensor_id, time_from, time_to):
+        """
+        查询传感器在[time_from, time_to]之间的历史数据，以SensorBatch返回，按时间排序。
+        没有这个传感器的历史数据时返回空的SensorBatch。
+
+        :param str node_id: Node的ID
+        :param str sensor_id: 传感器的ID
+        :param float time_from: 开始时间戳
+        :param float time_to: 结束时间戳
+        :rtype: SensorBatch
+        """
+        batch = SensorBatch()
+        sensor_type = self.get_sensor_type(node_id, sensor_id)
+        if sensor_type is None:
+            return batch
+
+        # 当前打开的段写入了时间戳不递增的记录时，先排序，才能二分查找
+        writer = self.writers.get((node_id, sensor_id))
+        if (writer is not None) and writer.unsorted:
+            try:
+                self.dropped += writer.sort()
+            except (IOError, OSError) as e:
+                logging.error("[HistoryStore.query] cannot sort %s: %s" % (writer.path, str(e)))
+
+        all_timestamps = array("d")
+        all_raw_values = array("d")
+        overlapped = False  # 是否有窗口重叠的段（窗口长度改变过），此时需要重新排序
+        last_window_end = None
+        for window_start, window_end, path in self.list_segments(node_id, sensor_id):
+            if (window_end <= time_from) or (window_start > time_to):
+                continue
+            if (last_window_end is not None) and (window_start < last_window_end):
+                overlapped = True
+            last_window_end = max(last_window_end, window_end)
+            timestamps, raw_values = self.read_segment(path, time_from, time_to)
+            all_timestamps.extend(timestamps)
+            all_raw_values.extend(raw_values)
+        if overlapped:
+            all_timestamps, all_raw_values = sort_records(all_timestamps, all_raw_values)
+        batch.extend(sensor_id, sensor_type, all_raw_values, all_timestamps)
+        return batch
+
+    def read_segment(self, path, time_from, time_to):
+        """
+        用mmap读取一个段文件中[time_from, time_to]之间的记录，返回(时间戳的array, 传感值的array)。
+
+        :rtype: tuple
+        """
+        if path.endswith(compressed_segment_suffix):
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return read_segment_range(data, time_from, time_to)
+                finally:
+                    data.close()
+
+        size = os.path.getsize(path) // record_size * record_size
+        if size == 0:
+            return array("d"), array("d")
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                start = search_records(data, time_from)
+                # 找到第一条时间戳大于time_to的记录
+                end = search_records(data, time_to)
+                count = size // record_size
+                while (end < count) and (struct.unpack_from(record_format, data, end * record_size)[0] <= time_to):
+                    end += 1
+                return read_records(data, start, end)
+            finally:
+                data.close()
+
+    def compact_sealed(self, pause=None):
+        """
+        把所有已经封闭的原始段压缩为压缩段，返回压缩的段数。
+        窗口在该传感器最新的窗口开始之前结束、且没有被打开写入的段是封闭的；其他的段可能仍在写入，不被压缩。
+        压缩后的文件写入完成后才替换原始段。
+
+        :param pause: 每压缩一块后调用的函数，例如用于让出执行权。可以为None
+        :rtype: int
+        """
+        count = 0
+        open_paths = set(writer.path for writer in self.writers.values())
+        for node_dir_name in os.listdir(self.root_dir):
+            node_dir = os.path.join(self.root_dir, node_dir_name)
+            if not os.path.isdir(node_dir):
+                continue
+            for sensor_dir_name in os.listdir(node_dir):
+                sensor_dir = os.path.join(node_dir, sensor_dir_name)
+                if not os.path.isdir(sensor_dir):
+                    continue
+                segments = self.list_segments_in_dir(sensor_dir)
+                if not segments:
+                    continue
+                latest_window_start = max(x[0] for x in segments)
+                for window_start, window_end, path in segments:
+                    if (window_end > latest_window_start) or (path in open_paths):
+                        continue
+                    if not path.endswith(raw_segment_suffix):
+                        # 删除压缩中途中断后留下的原始段
+                        raw_path = path[:-len(compressed_segment_suffix)] + raw_segment_suffix
+                        if os.path.isfile(raw_path):
+                            os.remove(raw_path)
+                        continue
+                    try:
+                        self.compact_segment(path, pause)
+                    except (IOError, OSError) as e:
+                        logging.error("[HistoryStore.compact_sealed] cannot compact %s: %s" % (path, str(e)))
+                        continue
+                    count += 1
+        return count
+
+    def list_segments_in_dir(self, sensor_dir):
+        """
+        返回传感器目录中的所有段文件，参见list_segments。
+
+        :rtype: list
+        """
+        node_id = unquote(os.path.basename(os.path.dirname(sensor_dir)))
+        sensor_id = unquote(os.path.basename(sensor_dir))
+        return self.list_segments(node_id, sensor_id)
+
+    def compact_segment(self, path, pause=None):
+        """
+        把一个原始段压缩为压缩段，并删除原始段。
+
+        :param str path: 原始段的路径
+        :param pause: 参见compact_sealed
+        """
+        with open(path, "rb") as f:
+            raw_data = f.read()
+        raw_data = raw_data[:len(raw_data) // record_size * record_size]
+        timestamps, raw_values = read_records(raw_data)
+        if not is_sorted(timestamps):
+            # 排序前断电时，原始段可能未排序
+            timestamps, raw_values = sort_records(timestamps, raw_values)
+        compressed_data = encode_segment(timestamps, raw_values, pause=pause)
+
+        compressed_path = path[:-len(raw_segment_suffix)] + compressed_segment_suffix
+        temp_path = compressed_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(compressed_data)
+            f.flush()
+            os.fsync(f.fileno())
+        # 替换时不让出执行权，查询不会同时看到两个文件
+        os.rename(temp_path, compressed_path)
+        os.remove(path)
+
+        self.compacted += 1
+        self.compacted_bytes_saved += len(raw_data) - len(compressed_data)
+
+    def close(self):
+        """
+        关闭所有打开的段文件。
+        """
+        for writer in self.writers.values():
+            self.close_writer(writer)
+        self.writers.clear()
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "open_segments": len(self.writers),
+            "dropped": self.dropped,
+            "compacted": self.compacted,
+            "compacted_bytes_saved": self.compacted_bytes_saved
+        }
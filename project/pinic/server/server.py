@@ -8,6 +8,9 @@ Server在启动时并不知道任何关于Node的信息。每一个Node启动后
 会自己向Server的/server/regnode注册，并以一定间隔发送心跳请求。
 
 一段时间没有收到来自某个Node的心跳请求后，该Node将从已知Node列表中被删除。
+
+默认情况下，Node在传感器进入或离开警报状态时向Server的/server/sensordata推送警报，Server再转发给Forwarder。
+配置中的warning_mode为"poll"时，Server改为定期向每个Node检查警报，并忽略Node的推送。
 """
 
 __author__ = "tgmerge"
@@ -17,18 +20,27 @@ from gevent import monkey
 monkey.patch_all()
 
 # 外部模块
-import grequests
-from requests.exceptions import RequestException
-from bottle import Bottle, request
+from requests.exceptions import RequestException, Timeout
+from gevent.pool import Pool
+import gevent
+from bottle import Bottle, request, response
 
 # 项目内的其他模块
 from pinic.server.serverconfig import ServerConfig
 from pinic.server.serverconfig import parse_from_string as parse_server_config_from_string
 from pinic.util import generate_500
+from pinic.httpclient import HttpClient
+from pinic.listener import Listener, create_wsgi_server
+from pinic.registry import ExpiryRegistry
+from pinic.server.servercache import SensorDataCache
+from pinic.server.history import HistoryStore
+from pinic.server.aggregate import aggregate_buckets, lttb
 from pinic.node.nodeconfig import parse_from_string as parse_node_config_from_string
 from pinic.node.nodeconfig import NodeConfig
+from pinic.sensor.sensordata import SensorData, SensorBatch, decode_batch, encode_batch, accepts_binary, binary_content_type
 
 # python内置模块
+from collections import deque
 from time import time
 from json import dumps, loads
 import threading
@@ -44,6 +56,11 @@ class Server(object):
     本类是项目中的Server服务器。运行指导参见pinic.server.__init__.py的文档
     """
 
+    # 应用新配置时，这些配置项改变才需要向Forwarder解除注册并重新注册
+    registration_keys = ("server_id", "server_host", "server_port", "forwarder_addr", "forwarder_port")
+
+    listener_drain_timeout = 10.0  # 更换监听地址后，等待原地址上正在处理的请求完成的最长时间（秒）
+
     def __init__(self, server_config):
         """
         :param ServerConfig server_config: 初始化用的Server配置（ServerConfig对象）。
@@ -53,11 +70,23 @@ class Server(object):
 
         self.bottle = Bottle()            # 类型：Bottle，是本Server内含的Bottle Web服务器
 
+        self.listener = Listener(create_wsgi_server, self.bottle, Server.listener_drain_timeout)  # 类型：Listener，运行Bottle的监听器
+
         self.node_monitor = None          # 类型：NodeMonitor，定期检查Node的最后存活时间
 
         self.forwarder_monitor = None     # 类型：ForwarderMonitor，定期向Forwarder确认自身存活
 
-        self.known_nodes = []             # 类型：list of NodeInfo，已知的node
+        self.known_nodes = ExpiryRegistry()  # 类型：ExpiryRegistry of NodeInfo，已知的node
+
+        self.http_client = HttpClient()   # 类型：HttpClient，向Node和Forwarder发送请求所用的、带连接池的HTTP客户端
+
+        self.sensor_cache = None          # 类型：SensorDataCache，缓存从Node获取的传感器数据
+
+        self.history_store = None         # 类型：HistoryStore，传感器历史数据的存储。配置中history_dir为空时为None
+
+        self.history_compactor = None     # 类型：HistoryCompactor，在后台压缩历史数据。未启用压缩时为None
+
+        self.warning_relay = None         # 类型：WarningRelay，按顺序把Node批量发送的警报转发给Forwarder
 
         # 应用初始化配置
         self.apply_config(server_config)
@@ -72,6 +101,18 @@ class Server(object):
         """
         为Server服务器应用新的配置。
 
+        只重启输入发生变化的部分，已知的Node列表始终保留：
+
+        * 只有registration_keys中的配置项（Server的ID、端口，Forwarder的地址）改变时，才向Forwarder解除注册并重新注册；
+          Server的描述改变时，只重新发送一次注册，Forwarder会原地更新这个Server的信息。
+
+        * NodeMonitor、ForwarderMonitor和HistoryCompactor每次等待前从当前配置读取间隔和超时，修改后不需要重启。
+
+        * 历史数据存储只在目录或段的时间窗口改变时重新打开，压缩线程只在存储重新打开或开关压缩时重启。
+
+        * 监听的地址或端口改变时，先在新的地址上开始监听，原来的监听在处理完正在进行的请求后关闭。
+          新的地址无法监听时抛出异常，新配置的其他部分都不会被应用。
+
         :param ServerConfig new_config: 要应用的新配置（ServerConfig对象）。
         :param bool load_old_config: 是否在失败时重新加载旧的配置，默认为False。
         """
@@ -81,34 +122,65 @@ class Server(object):
         if not isinstance(new_config, ServerConfig):
             raise TypeError("%s is not a ServerConfig instance" % str(new_config))
 
-        # 备份旧的配置
+        # 备份旧的配置，并找出改变的部分
         old_config = self.config
 
+        def changed(keys):
+            return (old_config is None) or any(getattr(new_config, k) != getattr(old_config, k) for k in keys)
+
+        registration_changed = changed(Server.registration_keys)
+        history_store_changed = changed(("history_dir", "history_segment_duration"))
+
+        # 监听的地址或端口改变时，先在新的地址上开始监听。无法监听时抛出异常，新配置的其他部分都不会被应用
+        if (old_config is not None) and changed(("server_host", "server_port")):
+            self.restart_bottle(new_config.server_host, new_config.server_port)
+
         # 向Forwarder解除注册
-        if self.forwarder_monitor is not None:
+        if registration_changed and (self.forwarder_monitor is not None):
             self.forwarder_monitor.stop()
             self.forwarder_monitor.unreg_to_forwarder_destory_tunnel()
-
-        # 停止Node监视线程
-        if self.node_monitor is not None:
-            self.node_monitor.stop()
+            self.forwarder_monitor = None
 
         # 将Server的配置设置为新的配置
         self.config = new_config
 
-        # 向Forwarder重新注册
-        self.forwarder_monitor = ForwarderMonitor(self)
-        self.forwarder_monitor.reg_to_forwarder_establish_tunnel()
-        self.forwarder_monitor.start()
-
-        # 启动新的Node监视线程
-        self.node_monitor = NodeMonitor(self)
-        self.node_monitor.start()
-
-        # 如果需要，重启整个服务器
-        # TODO 由于需求变化，不实现
-        if (old_config is not None) and ((new_config.server_port != old_config.server_port) or (new_config.server_host != old_config.server_host)):
-            self.restart_bottle()
+        # 创建或调整传感器数据缓存
+        if self.sensor_cache is None:
+            self.sensor_cache = SensorDataCache(new_config.sensor_cache_ttl, new_config.sensor_cache_size)
+        else:
+            self.sensor_cache.resize(new_config.sensor_cache_ttl, new_config.sensor_cache_size)
+
+        # 需要时停止历史数据压缩线程，并重新打开历史数据存储
+        if (self.history_compactor is not None) and (history_store_changed or not new_config.history_compression):
+            self.history_compactor.stop()
+            self.history_compactor = None
+        if history_store_changed:
+            if self.history_store is not None:
+                self.history_store.close()
+                self.history_store = None
+            if new_config.history_dir != "":
+                self.history_store = HistoryStore(new_config.history_dir, new_config.history_segment_duration)
+        if (self.history_store is not None) and new_config.history_compression and (self.history_compactor is None):
+            self.history_compactor = HistoryCompactor(self)
+            self.history_compactor.start()
+
+        # 向Forwarder重新注册；只有描述改变时，重新发送注册以更新Forwarder上的Server信息
+        if self.forwarder_monitor is None:
+            self.forwarder_monitor = ForwarderMonitor(self)
+            self.forwarder_monitor.reg_to_forwarder_establish_tunnel()
+            self.forwarder_monitor.start()
+        elif changed(("server_desc",)):
+            self.forwarder_monitor.reg_to_forwarder_establish_tunnel()
+
+        # 启动Node监视线程。它从当前配置读取间隔，配置改变时不需要重启
+        if self.node_monitor is None:
+            self.node_monitor = NodeMonitor(self)
+            self.node_monitor.start()
+
+        # 启动警报转发线程。它在发送时读取当前配置中Forwarder的地址，配置改变时不需要重启
+        if self.warning_relay is None:
+            self.warning_relay = WarningRelay(self)
+            self.warning_relay.start()
 
     def start_bottle(self):
         """
@@ -125,20 +197,30 @@ class Server(object):
         self.bottle.route("/server/serverconfig/<server_id>", method="POST", callback=self.post_server_config)
         self.bottle.route("/server/nodeconfig/<server_id>/<node_id>", method="GET", callback=self.get_node_config)
         self.bottle.route("/server/nodeconfig/<server_id>/<node_id>", method="POST", callback=self.post_node_config)
+        self.bottle.route("/server/sensordata/<server_id>/<node_id>", method="GET", callback=self.get_node_sensor_data)
         self.bottle.route("/server/sensordata/<server_id>/<node_id>/<sensor_id>", method="GET", callback=self.get_sensor_data)
+        self.bottle.route("/server/warningdata/<server_id>/<node_id>", method="GET", callback=self.get_node_warning_data)
         self.bottle.route("/server/sensordata", method="POST", callback=self.post_sensor_data)
+        self.bottle.route("/server/sensordatabatch", method="POST", callback=self.post_sensor_data_batch)
         self.bottle.route("/server/knownnodes/<server_id>", method="GET", callback=self.get_known_nodes)
+        self.bottle.route("/server/topology/<server_id>", method="GET", callback=self.get_topology)
+        self.bottle.route("/server/stats/<server_id>", method="GET", callback=self.get_stats)
+        self.bottle.route("/server/history/<server_id>/<node_id>/<sensor_id>", method="GET", callback=self.get_history)
+        self.bottle.route("/server/aggregate/<server_id>/<node_id>/<sensor_id>", method="GET", callback=self.get_aggregate)
 
-        # 开启Bottle
-        self.bottle.run(
-            host=self.config.server_host,
-            port=self.config.server_port,
-            server="gevent"
-        )
+        # 开启Bottle。使用Listener运行，使监听的地址和端口可以在运行中更换
+        self.listener.serve_forever(self.config.server_host, self.config.server_port)
 
-    def restart_bottle(self):
-        logging.debug("[Server.restart_bottle] restarting bottle")
-        pass
+    def restart_bottle(self, host, port):
+        """
+        在新的地址和端口上开始监听，原来的监听在处理完正在进行的请求后关闭（参见pinic.listener）。
+        已知的Node、Server列表，缓存和各个线程都不受影响。新的地址无法监听时抛出异常，原来的监听继续工作。
+
+        :param str host: 新的监听地址
+        :param int port: 新的监听端口
+        """
+        logging.debug("[Server.restart_bottle] rebinding bottle to %s:%d" % (host, port))
+        self.listener.rebind(host, port)
 
     def find_node_by_id(self, node_id):
         """
@@ -148,9 +230,7 @@ class Server(object):
 
         :rtype NodeInfo:
         """
-        for n in self.known_nodes:
-            if n.id == node_id:
-                return n
+        return self.known_nodes.get(node_id)
 
     def remove_known_node(self, node_id):
         """
@@ -158,14 +238,16 @@ class Server(object):
 
         :param basestring node_id: 要删除的Node的ID。
         """
-        node_to_remove = self.find_node_by_id(node_id)
-        if isinstance(node_to_remove, NodeInfo):
-            logging.debug("[Server.remove_known_node] removing node with node_id=%s" % node_id)
-            self.known_nodes.remove(node_to_remove)
+        removed_node = self.known_nodes.remove(node_id)
+        if removed_node is not None:
+            logging.debug("[Server.remove_known_node] removed node with node_id=%s" % node_id)
+            self.http_client.forget_peer(removed_node.addr, removed_node.port)
+            self.sensor_cache.invalidate(lambda key: key[0] == node_id)
+            self.notify_topology_changed()
 
     def add_known_node(self, node_addr, node_port, node_id, node_desc, node_config):
         """
-        用Node的信息添加一个Node到已知Node列表里。
+        用Node的信息添加一个Node到已知Node列表里。如果已经存在相同ID的Node，则替换它。
 
         :param basestring node_addr: 要添加的Node的地址
         :param int node_port: 要添加的Node的端口号
@@ -174,8 +256,37 @@ class Server(object):
         :param NodeConfig node_config: 要添加的Node的配置（一个NodeConfig对象）
         """
         logging.debug("[Server.add_known_node] adding node with node_id=%s" % node_id)
-        self.remove_known_node(node_id)
-        self.known_nodes.append(NodeInfo(node_addr, node_port, node_id, node_desc, node_config))
+        self.known_nodes.add(NodeInfo(node_addr, node_port, node_id, node_desc, node_config))
+        self.notify_topology_changed()
+
+    def notify_topology_changed(self):
+        """
+        在后台通知Forwarder的/forwarder/topologychanged/<server_id>，已知的Node发生了变化，使Forwarder缓存的拓扑文档失效。
+        不等待通知完成；通知失败时，Forwarder的缓存会在有效时间后自然失效。
+        """
+
+        def notify():
+            try:
+                self.http_client.post(self.config.forwarder_addr, self.config.forwarder_port,
+                                      "/forwarder/topologychanged/%s" % self.config.server_id)
+            except RequestException as e:
+                logging.debug("[Server.notify_topology_changed] notify failed. err:" + str(e))
+
+        gevent.spawn(notify)
+
+    def send_warning_to_forwarder(self, node_info, warning_json_obj, timeout=None):
+        """
+        把一份警报数据发送给Forwarder的/forwarder/warningdata。
+        发送前在警报数据中附加Node的信息（node）和本Server的ID（server）。
+
+        :param NodeInfo node_info: 产生警报的Node
+        :param dict warning_json_obj: 警报数据，即SensorData的dict形式
+        :param tuple timeout: 请求的超时时间，(连接超时, 读取超时)。默认使用HttpClient的默认值
+        """
+        warning_json_obj["node"] = node_info.get_dict()
+        warning_json_obj["server"] = self.config.server_id
+        self.http_client.post(self.config.forwarder_addr, self.config.forwarder_port, "/forwarder/warningdata",
+                              data=dumps(warning_json_obj), timeout=timeout)
 
     def refresh_node_alive(self, node_id):
         """
@@ -186,10 +297,7 @@ class Server(object):
         :param basestring node_id: 要刷新的Node的ID
         """
 
-        node_to_refresh = self.find_node_by_id(node_id)
-        if isinstance(node_to_refresh, NodeInfo):
-            node_to_refresh.last_active_time = time()
-        else:
+        if not self.known_nodes.refresh(node_id):
             logging.warning("[Server.refresh_node_alive] cannot find node with node_id=%s to refresh." % node_id)
 
     # HTTP处理方法
@@ -327,10 +435,8 @@ class Server(object):
             return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
 
         # 向那个Node发送请求
-        request_url = str("http://%s:%d/node/nodeconfig/%s" % (node.addr, node.port, node.id))
         try:
-            greq = grequests.get(request_url)
-            response = greq.send()
+            response = self.http_client.get(node.addr, node.port, "/node/nodeconfig/%s" % node.id)
         except RequestException as e:
             return generate_500("Error on curling config from node.", e)
 
@@ -359,10 +465,8 @@ class Server(object):
             return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
 
         # 向那个Node发送请求
-        request_url = str("http://%s:%d/node/nodeconfig/%s" % (node.addr, node.port, node.id))
         try:
-            greq = grequests.post(request_url, data=request.body.read())
-            response = greq.send()
+            response = self.http_client.post(node.addr, node.port, "/node/nodeconfig/%s" % node.id, data=request.body.read())
         except RequestException as e:
             return generate_500("Error on sending config to node.", e)
 
@@ -375,7 +479,7 @@ class Server(object):
 
         本方法将处理Forwarder发来的请求，要求获得某个传感器的传感器值。
         方法将把请求转发给相应的Node，并把获得的响应转发回Forwarder。
-        目标传感器的值（SensorData）以Json形式在响应中返回。
+        目标传感器的值（SensorData）以Json形式在响应中返回，Accept头要求二进制格式时以二进制格式返回。
         """
 
         # 检查URL中的server_id是否和自身的ID相符
@@ -387,29 +491,297 @@ class Server(object):
         if node is None:
             return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
 
-        # 向那个Node发送请求
-        request_url = str("http://%s:%d/node/sensordata/%s/%s" % (node.addr, node.port, node_id, sensor_id))
+        # 向那个Node发送请求，并向Forwarder返回请求的结果
         try:
-            greq = grequests.get(request_url)
-            response = greq.send()
+            return self.proxy_sensor_data(node, "/node/sensordata/%s/%s" % (node_id, sensor_id), use_cache=True, record_history=True)
         except RequestException as e:
             return generate_500("Error on sending config to node.", e)
 
-        # 向Forwarder返回请求的结果
-        return response.text
+    def get_node_sensor_data(self, server_id, node_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法将处理Forwarder发来的请求，要求一次获得某个Node所有传感器的传感器值。
+        方法将把请求转发给相应Node的/node/sensordata/<node_id>，并把获得的响应转发回Forwarder。
+        各传感器的值（SensorData）以Json数组的形式在响应中返回，Accept头要求二进制格式时以二进制格式返回。
+        """
+
+        # 检查URL中的server_id是否和自身的ID相符
+        if server_id != self.config.server_id:
+            return generate_500("Cannot find server with server_id='%s'" % server_id)
+
+        # 在自身已知的Node列表里查找URL中给出的目标Node
+        node = self.find_node_by_id(node_id)
+        if node is None:
+            return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
+
+        # 向那个Node发送请求，并向Forwarder返回请求的结果
+        try:
+            return self.proxy_sensor_data(node, "/node/sensordata/%s" % node_id, use_cache=True, record_history=True)
+        except RequestException as e:
+            return generate_500("Error on getting sensor data from node.", e)
+
+    def get_node_warning_data(self, server_id, node_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法将处理Forwarder发来的请求，要求一次获得某个Node所有传感器中未被过滤的警报数据。
+        方法将把请求转发给相应Node的/node/warningdata/<node_id>，并把获得的响应转发回Forwarder。
+        警报数据（SensorData）以Json数组的形式在响应中返回，Accept头要求二进制格式时以二进制格式返回。
+        """
+
+        # 检查URL中的server_id是否和自身的ID相符
+        if server_id != self.config.server_id:
+            return generate_500("Cannot find server with server_id='%s'" % server_id)
+
+        # 在自身已知的Node列表里查找URL中给出的目标Node
+        node = self.find_node_by_id(node_id)
+        if node is None:
+            return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
+
+        # 向那个Node发送请求，并向Forwarder返回请求的结果
+        try:
+            return self.proxy_sensor_data(node, "/node/warningdata/%s" % node_id)
+        except RequestException as e:
+            return generate_500("Error on getting warning data from node.", e)
+
+    def proxy_sensor_data(self, node, path, use_cache=False, record_history=False):
+        """
+        向Node转发一个获取传感器数据的GET请求，返回Node响应的正文，并设置相同的Content-Type。
+        请求的Accept头要求二进制格式时，向Node要求二进制格式，参见pinic.sensor.sensordata。
+        use_cache为True时，使用传感器数据缓存（sensor_cache），在配置的sensor_cache_ttl秒内不重复请求Node。
+        record_history为True时，把Node返回的传感器数据写入历史数据存储。
+        请求失败时抛出requests.exceptions.RequestException。
+
+        :param NodeInfo node: 目标Node
+        :param str path: 请求的路径
+        :param bool use_cache: 是否使用缓存
+        :param bool record_history: 是否记录历史数据。响应必须是一份或一批SensorData
+        :rtype: str
+        """
+        is_binary = accepts_binary(request.headers.get("Accept"))
+
+        def fetch():
+            headers = {"Accept": binary_content_type} if is_binary else {}
+            node_response = self.http_client.get(node.addr, node.port, path, headers=headers)
+            content_type = node_response.headers.get("Content-Type")
+            is_ok = node_response.status_code == 200
+            if record_history and is_ok:
+                self.record_response_history(node.id, node_response.content, content_type)
+            # 只缓存正常的响应
+            return (node_response.content, content_type), is_ok
+
+        if use_cache:
+            body, content_type = self.sensor_cache.get((node.id, path, is_binary), fetch)
+        else:
+            body, content_type = fetch()[0]
+        if content_type is not None:
+            response.content_type = content_type
+        return body
+
+    def record_response_history(self, node_id, body, content_type):
+        """
+        把Node响应中的传感器数据写入历史数据存储。响应可以是一份SensorData的Json，或一批数据的Json数组或二进制格式。
+        没有启用历史数据存储时什么也不做。
+
+        :param str node_id: Node的ID
+        :param str body: 响应的正文
+        :param str content_type: 响应的Content-Type
+        """
+        if self.history_store is None:
+            return
+        try:
+            if (not body.lstrip().startswith("[")) and (not accepts_binary(content_type)):
+                body = "[" + body + "]"  # 一份SensorData的Json
+            self.history_store.append_batch(node_id, decode_batch(body, content_type))
+        except ValueError as e:
+            logging.debug("[Server.record_response_history] cannot parse sensor data from node_id=%s: %s" % (node_id, str(e)))
+
+    def record_sensor_data_history(self, node_id, sensor_data):
+        """
+        把一份传感器数据写入历史数据存储。没有启用历史数据存储时什么也不做。
+
+        :param str node_id: Node的ID
+        :param SensorData sensor_data: 传感器数据
+        """
+        if self.history_store is not None:
+            self.history_store.append(node_id, sensor_data)
+
+    def get_history(self, server_id, node_id, sensor_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法返回一个传感器的历史数据。查询参数from和to给出时间范围（时间戳，包含两端），
+        from默认为0，to默认为当前时间。
+        数据以SensorData的Json数组返回，Accept头要求二进制格式时以二进制格式返回。
+        如果请求错误，或没有启用历史数据存储，返回HTTP 500。
+
+        :param basestring server_id: URL中的<server_id>部分。
+        :param basestring node_id: URL中的<node_id>部分。
+        :param basestring sensor_id: URL中的<sensor_id>部分。
+        """
+
+        # 检查URL中的server_id是否和自身的ID相符
+        if server_id != self.config.server_id:
+            return generate_500("Cannot find server with server_id='%s'" % server_id)
+
+        if self.history_store is None:
+            return generate_500("History is not enabled on this server")
+
+        # 解析时间范围
+        try:
+            time_from = float(request.query.get("from", 0))
+            time_to = float(request.query.get("to", time()))
+        except ValueError as e:
+            return generate_500("Error on parsing time range.", e)
+
+        batch = self.history_store.query(node_id, sensor_id, time_from, time_to)
+        body, content_type = encode_batch(batch, request.headers.get("Accept"))
+        response.content_type = content_type
+        return body
+
+    def get_aggregate(self, server_id, node_id, sensor_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法返回一个传感器降采样后的历史数据。查询参数from和to同get_history。
+        查询参数mode为"buckets"（默认）时，按bucket秒分桶（默认为60），以Json返回每个非空桶的
+        开始时间戳、数据个数、最小值、最大值和平均值，参见pinic.server.aggregate.aggregate_buckets。
+        mode为"lttb"时，用LTTB算法选出points个点（默认为500），格式同get_history。
+        如果请求错误，或没有启用历史数据存储，返回HTTP 500。
+
+        :param basestring server_id: URL中的<server_id>部分。
+        :param basestring node_id: URL中的<node_id>部分。
+        :param basestring sensor_id: URL中的<sensor_id>部分。
+        """
+
+        # 检查URL中的server_id是否和自身的ID相符
+        if server_id != self.config.server_id:
+            return generate_500("Cannot find server with server_id='%s'" % server_id)
+
+        if self.history_store is None:
+            return generate_500("History is not enabled on this server")
+
+        # 解析查询参数
+        mode = request.query.get("mode", "buckets")
+        if mode not in ("buckets", "lttb"):
+            return generate_500("Unknown aggregate mode '%s'" % mode)
+        try:
+            time_from = float(request.query.get("from", 0))
+            time_to = float(request.query.get("to", time()))
+            bucket_width = float(request.query.get("bucket", 60))
+            points = int(request.query.get("points", 500))
+        except ValueError as e:
+            return generate_500("Error on parsing query parameters.", e)
+        if (bucket_width <= 0) or (points < 3):
+            return generate_500("bucket must be positive and points must be at least 3")
+
+        batch = self.history_store.query(node_id, sensor_id, time_from, time_to)
+
+        if mode == "lttb":
+            timestamps, raw_values = lttb(batch.timestamps, batch.raw_values, points)
+            result = SensorBatch()
+            if len(batch) > 0:
+                sensor_id, sensor_type = batch.id_table[0]
+                result.extend(sensor_id, sensor_type, raw_values, timestamps)
+            body, content_type = encode_batch(result, request.headers.get("Accept"))
+            response.content_type = content_type
+            return body
+
+        result = aggregate_buckets(batch.timestamps, batch.raw_values, time_from, bucket_width)
+        result["from"] = time_from
+        result["to"] = time_to
+        result["bucket"] = bucket_width
+        return dumps(result)
 
     def post_sensor_data(self):
         """
-        处理POST /server/sensordata，即Node主动发送的传感器值。
-        由于需求变更，本方法现在没有作用。
-        参见Git commit记录：699b6bc7aefe64eab56f5d9727ec341e001d0e4a
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法处理Node主动推送的警报数据（HTTP POST）。Node在传感器进入或离开警报状态时推送。
+        正文是SensorData的Json，附加了node_id和warning_state（"enter"或"leave"）。
+        收到后，附加Node和Server的信息，转发给Forwarder的/forwarder/warningdata。
+        warning_mode为"poll"时，警报由NodeMonitor检查，推送的数据被忽略。
         """
-        request_url = str("http://%s:%d/forwarder/sensordata" % (self.config.forwarder_addr, self.config.forwarder_port))
+
+        # Server使用轮询方式时，忽略推送，以免重复发送警报
+        if self.config.warning_mode != "push":
+            logging.debug("[Server.post_sensor_data] warning_mode is '%s', ignoring pushed data" % self.config.warning_mode)
+            return
+
+        # 解析推送的数据
         try:
-            greq = grequests.post(request_url, data=request.body.read())
-            response = greq.send()
+            warning_json_obj = loads(request.body.read())
+            node_id = warning_json_obj["node_id"]
+        except (ValueError, KeyError, TypeError) as e:
+            return generate_500("Error on parsing pushed sensor data.", e)
+
+        # 在已知列表里查找这个Node
+        node = self.find_node_by_id(node_id)
+        if node is None:
+            return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
+
+        # 记录历史数据
+        try:
+            self.record_sensor_data_history(node_id, SensorData(
+                warning_json_obj["sensor_id"], warning_json_obj["sensor_type"],
+                float(warning_json_obj["raw_value"]), float(warning_json_obj["timestamp"])))
+        except (KeyError, TypeError, ValueError) as e:
+            logging.debug("[Server.post_sensor_data] cannot record history: %s" % str(e))
+
+        # 转发给Forwarder
+        try:
+            self.send_warning_to_forwarder(node, warning_json_obj)
         except RequestException as e:
-            return generate_500("Error on send sensordata to forwarder.", e)
+            return generate_500("Error on sending warning data to forwarder.", e)
+        return  # HTTP 200
+
+    def post_sensor_data_batch(self):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法处理Node从发件箱中批量发送的数据（HTTP POST）。
+        正文为{"node_id": Node的ID, "records": [记录, ...]}，每条记录为{"type": 种类, "data": 内容}：
+
+        * "warning"：内容同post_sensor_data的正文。记录历史数据，warning_mode为"push"时放入WarningRelay的队列，
+          由它按顺序转发给Forwarder。
+
+        * "readings"：内容为一批传感器数据的Json数组。写入历史数据存储。
+
+        返回200时Node从发件箱中删除这些记录；否则Node稍后重发整批记录。
+        记录写入历史数据后即返回200，Forwarder无法访问时不会阻塞历史数据的写入，也不会使Node重发已经转发的警报。
+        """
+
+        # 解析发送的数据
+        try:
+            batch_json_obj = loads(request.body.read())
+            node_id = batch_json_obj["node_id"]
+            records = batch_json_obj["records"]
+        except (ValueError, KeyError, TypeError) as e:
+            return generate_500("Error on parsing sensor data batch.", e)
+
+        # 在已知列表里查找这个Node
+        node = self.find_node_by_id(node_id)
+        if node is None:
+            return generate_500("Cannot find node with node_id='%s' from this server" % node_id)
+
+        for record in records:
+            try:
+                record_type = record["type"]
+                data = record["data"]
+                if record_type == "readings":
+                    if self.history_store is not None:
+                        self.history_store.append_batch(node_id, SensorBatch.from_list(data))
+                elif record_type == "warning":
+                    self.record_sensor_data_history(node_id, SensorData(
+                        data["sensor_id"], data["sensor_type"], float(data["raw_value"]), float(data["timestamp"])))
+                    if self.config.warning_mode == "push":
+                        self.warning_relay.enqueue(node, data)
+                else:
+                    logging.debug("[Server.post_sensor_data_batch] unknown record type '%s', ignored" % record_type)
+            except (KeyError, TypeError, ValueError) as e:
+                # 无法解析的记录重发也无法解析，跳过
+                logging.warning("[Server.post_sensor_data_batch] cannot parse record from node_id=%s: %s" % (node_id, str(e)))
         return  # HTTP 200
 
     def get_known_nodes(self, server_id):
@@ -426,17 +798,71 @@ class Server(object):
 
         result = []
 
-        for n in self.known_nodes:
+        for n in self.known_nodes.values():
             # 调用每个NodeInfo的get_dict方法，将NodeInfo的信息转换为字典，以供返回
             result.append(n.get_dict())
         return dumps(result)
 
+    def get_topology(self, server_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法将处理Forwarder发来的请求，返回Server自身、已知的Node和各Node的传感器组成的拓扑，以Json格式返回。
+        Forwarder合并各Server的拓扑，生成/forwarder/topology的文档。
+        """
+
+        # 检查URL中的server_id是否和自身的ID相符
+        if server_id != self.config.server_id:
+            return generate_500("Cannot find server with server_id='%s'" % server_id)
+
+        nodes = []
+        for n in self.known_nodes.values():
+            node_dict = n.get_dict()
+            node_dict["sensors"] = [{
+                "sensor_id": x["sensor_id"],
+                "sensor_type": x["sensor_type"],
+                "sensor_desc": x["sensor_desc"]
+            } for x in n.config.sensors]
+            nodes.append(node_dict)
+        return dumps({
+            "id": self.config.server_id,
+            "desc": self.config.server_desc,
+            "nodes": nodes
+        })
+
+    def get_stats(self, server_id):
+        """
+        处理HTTP URL，参见start_bottle方法的注释。
+
+        本方法返回Server的运行统计信息，以Json形式返回。
+        包括HTTP客户端各对端的连接池使用情况、传感器数据缓存的命中情况，和NodeMonitor最近一轮检查的统计信息。
+
+        :param basestring server_id: URL中的<server_id>部分
+        """
+
+        # 检查URL中的server_id是否和自身的ID相符
+        if server_id != self.config.server_id:
+            return generate_500("Cannot find server with server_id='%s'" % server_id)
+
+        return dumps({
+            "http_client": self.http_client.get_stats(),
+            "sensor_cache": self.sensor_cache.get_stats(),
+            "history": self.history_store.get_stats() if self.history_store is not None else None,
+            "node_monitor": self.node_monitor.last_cycle_stats if self.node_monitor is not None else None,
+            "warning_relay": self.warning_relay.get_stats(),
+            "listener": self.listener.get_stats()
+        })
+
 
 class NodeMonitor(threading.Thread):
     """
     NodeMonitor线程。已经被gevent monkey_patch成为greenlet。
-    以一定间隔检查已知的Node列表，如果发现其中的Node超过一段时间（30秒）没有发送心跳请求，
-    则将其从Server的已知Node列表中删除。
+    以配置中的node_check_interval为间隔检查已知的Node列表，如果发现其中的Node超过node_live_interval秒没有发送心跳请求，
+    则将其从Server的已知Node列表中删除。两个间隔在每轮检查时从Server的当前配置读取，修改配置后从下一轮起生效。
+
+    配置中的warning_mode为"poll"时，对仍然存活的Node，线程在一个gevent池中并发地检查警报，同时检查的Node数量不超过配置中的warning_check_concurrency。
+    每次向Node发送的请求都带有连接和读取超时。一轮检查不会超过node_check_interval秒，
+    到时仍未开始检查的Node被跳过，仍未完成检查的Node被视为超时。
     """
 
     def __init__(self, server):
@@ -450,50 +876,105 @@ class NodeMonitor(threading.Thread):
 
         self.server = server  # 开启这个线程的Server对象
 
-        self.max_live_interval = 30.0  # Node不发送心跳请求后的最大存活时间
-
-        self.check_interval = 5.0  # 执行检查的时间间隔
+        self.last_cycle_stats = None  # 类型：dict，最近一轮检查的统计信息
 
         self.stop_event = threading.Event()  # 本线程的停止事件。使用stop_event.set()可停止本线程，但更推荐使用NodeMonitor.stop()方法
 
-    def check_warning(self, node_info):
+    def check_warning(self, node_info, cycle_stats):
         """
         检查一个Node的所有Sensor是否超过警报阈值。如果有，发送数据给forwarder。
+        一次请求Node的/node/warningdata/<node_id>，得到该Node所有传感器的警报数据。请求使用二进制格式。
 
         :param NodeInfo node_info: node to check
+        :param dict cycle_stats: 本轮检查的统计信息，检查结果将被计入其中
         """
-        # 对node的每一个传感器……
-        for sensor in node_info.config.sensors:
-            request_url = "http://%s:%d/node/warningdata/%s/%s" % (node_info.addr, node_info.port, node_info.id, sensor["sensor_id"])
-            try:
-                # 检查是否有警报
-                greq = grequests.get(request_url)
-                response = greq.send()
-                # 有警报数据，发送给forwarder
-                if len(response.text) > 0:
-                    request_url = "http://%s:%d/forwarder/warningdata" % (self.server.config.forwarder_addr, self.server.config.forwarder_port)
-                    warning_json_obj = loads(response.text)
-                    warning_json_obj["node"] = node_info.get_dict()
-                    warning_json_obj["server"] = self.server.config.server_id
-                    greq = grequests.post(request_url, data=dumps(warning_json_obj))
-                    response = greq.send()
-            except RequestException as e:
-                logging.debug("[Exception on check_warning]" + str(e))
-                pass
+        timeout = (self.server.config.node_connect_timeout, self.server.config.node_read_timeout)
+        try:
+            # 检查是否有警报
+            response = self.server.http_client.get(node_info.addr, node_info.port, "/node/warningdata/%s" % node_info.id,
+                                                   timeout=timeout, headers={"Accept": binary_content_type})
+            if response.status_code != 200:
+                logging.debug("[NodeMonitor.check_warning] node_id=%s returned HTTP %d" % (node_info.id, response.status_code))
+                cycle_stats["failed"] += 1
+                return
+
+            # 有警报数据，逐个发送给forwarder
+            for sensor_data in decode_batch(response.content, response.headers.get("Content-Type")):
+                self.server.record_sensor_data_history(node_info.id, sensor_data)
+                self.server.send_warning_to_forwarder(node_info, sensor_data.get_dict(), timeout)
+            cycle_stats["checked"] += 1
+        except Timeout as e:
+            logging.debug("[NodeMonitor.check_warning] node_id=%s timed out: %s" % (node_info.id, str(e)))
+            cycle_stats["timed_out"] += 1
+        except (RequestException, ValueError) as e:
+            logging.debug("[Exception on check_warning]" + str(e))
+            cycle_stats["failed"] += 1
+
+    def check_nodes(self):
+        """
+        进行一轮检查：删除太久没有发送心跳请求的Node。
+        如果warning_mode为"poll"，再在gevent池中并发地检查其余Node的警报。
+        本轮检查最多持续node_check_interval秒。返回本轮检查的统计信息。
+
+        :rtype: dict
+        """
+        start_time = time()
+        deadline = start_time + self.server.config.node_check_interval
+        cycle_stats = {
+            "nodes": len(self.server.known_nodes),
+            "expired": 0,
+            "checked": 0,
+            "failed": 0,
+            "timed_out": 0,
+            "skipped": 0,
+            "duration": 0.0
+        }
+
+        # 删除超时的Node。注册表只访问已经到期的Node
+        for n in self.server.known_nodes.pop_expired(self.server.config.node_live_interval, start_time):
+            logging.debug("[NodeMonitor.check_nodes] node_id=%s expired" % n.id)
+            self.server.http_client.forget_peer(n.addr, n.port)
+            self.server.sensor_cache.invalidate(lambda key: key[0] == n.id)
+            self.server.notify_topology_changed()
+            cycle_stats["expired"] += 1
+        nodes_to_check = self.server.known_nodes.values() if self.server.config.warning_mode == "poll" else []
+
+        # 在gevent池中并发检查警报。池满时等待空位，但最多等到deadline；到达deadline后不再开始新的检查
+        # gevent 1.0.1的Pool.wait_available()不接受timeout参数，用gevent.Timeout限制等待时间
+        pool = Pool(self.server.config.warning_check_concurrency)
+        for index, n in enumerate(nodes_to_check):
+            remaining = deadline - time()
+            available = False
+            if remaining > 0:
+                with gevent.Timeout(remaining, False):
+                    pool.wait_available()
+                    available = True
+            if not available:
+                cycle_stats["skipped"] += len(nodes_to_check) - index
+                break
+            pool.spawn(self.check_warning, n, cycle_stats)
+
+        # 等待检查完成。到达deadline时仍未完成的检查被中止，计为超时
+        pool.join(timeout=max(0.0, deadline - time()))
+        cycle_stats["timed_out"] += len(pool)
+        pool.kill(block=False)
+
+        cycle_stats["duration"] = time() - start_time
+        return cycle_stats
 
     def run(self):
         """
         线程执行入口方法。
-        间隔check_interval秒进行一次检查，删除太久没有发送心跳请求的Node。
+        每隔node_check_interval秒进行一轮检查，并记录本轮检查的耗时和被跳过、超时的Node数量。
         """
-        while not self.stop_event.wait(self.check_interval):
-            logging.debug("[NodeMonitor.run] checking %d known nodes." % len(self.server.known_nodes))
-            for n in self.server.known_nodes:
-                if time() - n.last_active_time > self.max_live_interval:
-                    self.server.remove_known_node(n.id)
-                else:
-                    self.check_warning(n)
-            logging.debug("[NodeMonitor.run] done. remain: %d known nodes." % len(self.server.known_nodes))
+        next_check_time = time() + self.server.config.node_check_interval
+        while not self.stop_event.wait(max(0.0, next_check_time - time())):
+            next_check_time = max(next_check_time + self.server.config.node_check_interval, time())
+            cycle_stats = self.check_nodes()
+            self.last_cycle_stats = cycle_stats
+            logging.info("[NodeMonitor.run] cycle done in %.3fs. nodes=%d, expired=%d, checked=%d, failed=%d, timed_out=%d, skipped=%d" % (
+                cycle_stats["duration"], cycle_stats["nodes"], cycle_stats["expired"], cycle_stats["checked"],
+                cycle_stats["failed"], cycle_stats["timed_out"], cycle_stats["skipped"]))
 
     def stop(self):
         """
@@ -520,7 +1001,6 @@ class ForwarderMonitor(threading.Thread):
         self.forwarder_addr = server.config.forwarder_addr
         self.forwarder_port = server.config.forwarder_port
         self.server_id = server.config.server_id
-        self.keep_alive_interval = 10.0  # 秒
         self.stop_event = threading.Event()  # 设置停止事件
 
     def reg_to_forwarder_establish_tunnel(self):
@@ -528,10 +1008,8 @@ class ForwarderMonitor(threading.Thread):
         向Forwarder注册Server。发送一个POST请求到Forwarder的``/forwarder/regserver``，请求内容是Server的config。
         """
         logging.debug("[ForwarderMonitor.reg_to_forwarder_establish_tunnel] reg to forwarder. addr=%s, port=%d" % (self.forwarder_addr, self.forwarder_port))
-        request_url = str("http://%s:%d/forwarder/regserver" % (self.forwarder_addr, self.forwarder_port))
         try:
-            greq = grequests.post(request_url, data=self.server.config.get_json_string())
-            greq.send()
+            self.server.http_client.post(self.forwarder_addr, self.forwarder_port, "/forwarder/regserver", data=self.server.config.get_json_string())
         except RequestException as e:
             logging.warning("[ServerMonitor.reg_to_server] reg failed. err:" + str(e))
 
@@ -540,10 +1018,8 @@ class ForwarderMonitor(threading.Thread):
         向Forwarder解除注册Server。发送一个POST请求到Forwarder的``/server/unregserver``，请求内容是Server的config。
         """
         logging.debug("[ForwarderMonitor.unreg_to_forwarder_destory_tunnel] unreg to forwarder. addr=%s, port=%d" % (self.forwarder_addr, self.forwarder_port))
-        request_url = str("http://%s:%d/forwarder/unregserver" % (self.forwarder_addr, self.forwarder_port))
         try:
-            greq = grequests.post(request_url, data=self.server.config.get_json_string())
-            greq.send()
+            self.server.http_client.post(self.forwarder_addr, self.forwarder_port, "/forwarder/unregserver", data=self.server.config.get_json_string())
         except RequestException as e:
             logging.warning("[ServerMonitor.reg_to_server] reg failed. err:" + str(e))
 
@@ -554,10 +1030,8 @@ class ForwarderMonitor(threading.Thread):
         如果返回500，说明Forwarder尚不知道自身，故进行reg_to_forwarder向Forwarder注册自己。
         """
         logging.debug("[ForwarderMonitor.send_keep_server] sending keep_server message")
-        request_url = str("http://%s:%d/forwarder/keepserver/%s" % (self.forwarder_addr, self.forwarder_port, self.server_id))
         try:
-            greq = grequests.get(request_url)
-            response = greq.send()
+            response = self.server.http_client.get(self.forwarder_addr, self.forwarder_port, "/forwarder/keepserver/%s" % self.server_id)
             if response.status_code == 500:
                 self.unreg_to_forwarder_destory_tunnel()
                 self.reg_to_forwarder_establish_tunnel()
@@ -568,9 +1042,10 @@ class ForwarderMonitor(threading.Thread):
         """
         ForwarderMonitor以如下方式运行。
 
-        每self.keep_alive_interval秒，运行send_keep_server，发送自身存活消息。
+        每隔配置中的forwarder_keep_alive_interval秒，运行send_keep_server，发送自身存活消息。
+        间隔在每次等待前从Server的当前配置读取。
         """
-        while not self.stop_event.wait(self.keep_alive_interval):
+        while not self.stop_event.wait(self.server.config.forwarder_keep_alive_interval):
             self.send_keep_server()
             # self.check_reverse_tunnel()
 
@@ -578,6 +1053,130 @@ class ForwarderMonitor(threading.Thread):
         self.stop_event.set()
 
 
+class HistoryCompactor(threading.Thread):
+    """
+    历史数据压缩线程。已经被gevent monkey_patch成为greenlet。
+    每隔配置中的history_compact_interval秒，把历史数据存储中已经封闭的原始段压缩为压缩段。
+    每压缩一块数据后让出执行权，不会长时间阻塞HTTP请求的处理。
+    """
+
+    def __init__(self, server):
+        """
+        :param Server server: 开启此线程的Server
+        """
+        super(HistoryCompactor, self).__init__()
+        self.server = server
+        self.history_store = server.history_store
+        self.stop_event = threading.Event()  # 设置停止事件
+
+    def run(self):
+        """
+        每隔配置中的history_compact_interval秒，压缩一次已经封闭的段。间隔在每次等待前从Server的当前配置读取。
+        """
+        while not self.stop_event.wait(self.server.config.history_compact_interval):
+            try:
+                count = self.history_store.compact_sealed(pause=lambda: gevent.sleep(0))
+                if count > 0:
+                    logging.info("[HistoryCompactor.run] compacted %d segments" % count)
+            except Exception as e:
+                logging.exception("[HistoryCompactor.run] exception:" + str(e))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class WarningRelay(threading.Thread):
+    """
+    警报转发线程。已经被gevent monkey_patch成为greenlet。
+    线程按收到的顺序，把Node批量发送的警报逐份发送给Forwarder的/forwarder/warningdata。
+
+    * 发送失败时，等待的时间从1秒开始加倍，最长为max_backoff秒，之后重试同一份警报，警报的顺序不变。
+
+    * 队列最多保存queue_size份警报，Forwarder长时间无法访问、超出时丢弃最旧的警报。
+    """
+
+    min_backoff = 1.0  # 秒，发送失败后第一次重试前的等待时间
+    max_backoff = 30.0  # 秒，发送失败后重试前的最长等待时间
+    queue_size = 1024  # 队列最多保存的警报数
+
+    def __init__(self, server):
+        """
+        :param Server server: 开启此线程的Server
+        """
+        super(WarningRelay, self).__init__()
+        self.server = server
+        self.queue = deque()  # 类型：deque of (NodeInfo, dict)，等待发送的警报
+        self.backoff = WarningRelay.min_backoff
+        self.sent = 0  # 发送成功的警报数
+        self.failed = 0  # 发送失败的次数
+        self.dropped = 0  # 因队列已满而丢弃的警报数
+        self.wake_event = threading.Event()  # 有新的警报时被设置
+        self.stop_event = threading.Event()  # 停止事件，建议使用WarningRelay.stop()停止本线程
+
+    def enqueue(self, node_info, warning_json_obj):
+        """
+        把一份警报放入队列，并唤醒线程。
+
+        :param NodeInfo node_info: 产生警报的Node
+        :param dict warning_json_obj: 警报数据，参见Server.send_warning_to_forwarder
+        """
+        self.queue.append((node_info, warning_json_obj))
+        while len(self.queue) > WarningRelay.queue_size:
+            self.queue.popleft()
+            self.dropped += 1
+        self.wake_event.set()
+
+    def run(self):
+        """
+        WarningRelay以如下方式运行：
+
+        队列为空时，等待新的警报；否则发送队列中最旧的警报，成功后把它移出队列；发送失败时，等待backoff秒后重试。
+        """
+        while not self.stop_event.is_set():
+            if not self.queue:
+                self.wake_event.wait()
+                self.wake_event.clear()
+                continue
+
+            item = self.queue[0]
+            try:
+                self.server.send_warning_to_forwarder(*item)
+            except RequestException as e:
+                self.failed += 1
+                logging.warning("[WarningRelay.run] send failed, retrying in %.1fs. err: %s" % (self.backoff, str(e)))
+                self.stop_event.wait(self.backoff)
+                self.backoff = min(self.backoff * 2, WarningRelay.max_backoff)
+                continue
+            except Exception as e:
+                logging.exception("[WarningRelay.run] exception:" + str(e))
+                self.stop_event.wait(self.backoff)
+                continue
+
+            self.backoff = WarningRelay.min_backoff
+            self.sent += 1
+            # 发送期间队列已满时，这份警报可能已经被丢弃
+            if self.queue and (self.queue[0] is item):
+                self.queue.popleft()
+
+    def stop(self):
+        """
+        停止本线程的运行。
+        """
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def get_stats(self):
+        """
+        :rtype: dict
+        """
+        return {
+            "queued": len(self.queue),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped
+        }
+
+
 class NodeInfo(object):
     """
     表示一个Node的信息，在Server中使用，包含addr, port, id, desc属性。
@@ -0,0 +1,133 @@
+# -*- coding: utf8 -*-
+
+"""
+本Python模块包含Server的传感器数据缓存SensorDataCache。
+
+Forwarder转发来的传感器数据请求，原本每次都被转发给Node。多个客户端同时查看同一个传感器时，
+Node会在短时间内收到大量相同的请求。SensorDataCache在Server上按请求的键（Node、传感器和数据格式）
+缓存Node的响应，在ttl秒内直接返回缓存的响应。
+
+* 单飞（single-flight）：同一个键的缓存失效时，只有第一个请求会被转发给Node，
+  同时到达的其他请求等待这次请求的结果，不会重复转发。
+
+* 缓存的条目数不超过max_entries，超出时删除最久未使用的条目（LRU）。
+
+* 要读取缓存，使用SensorDataCache.get(key, fetch)。要获取命中率等统计信息，使用SensorDataCache.get_stats()。
+"""
+
+__author__ = "tgmerge"
+
+
+from gevent.event import AsyncResult
+from collections import OrderedDict
+from time import time
+
+
+class SensorDataCache(object):
+    """
+    带有TTL、LRU上限和单飞合并的缓存。所有方法都在一个greenlet中完成，除等待其他请求的结果外不会让出执行权。
+    """
+
+    def __init__(self, ttl, max_entries):
+        """
+        :param float ttl: 缓存条目的有效时间（秒）。为0时不缓存，但仍然合并同时到达的请求
+        :param int max_entries: 最多缓存的条目数
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # 类型：OrderedDict，键 -> (过期时间, 值)，按最近使用排序
+        self.in_flight = {}  # 类型：dict，键 -> AsyncResult，正在向Node请求的键
+
+        # 统计信息
+        self.hits = 0  # 命中缓存的请求数
+        self.misses = 0  # 未命中、被转发的请求数
+        self.coalesced = 0  # 未命中、但与正在进行的请求合并的请求数
+        self.evictions = 0  # 因超过max_entries而删除的条目数
+
+    def get(self, key, fetch):
+        """
+        返回键key对应的值。缓存中没有有效的值时，调用fetch()获取。
+        fetch()返回(值, 是否可缓存)，例如Node返回错误时不应缓存。fetch()抛出的异常会传给所有等待的请求。
+
+        :param key: 缓存的键，需要可哈希
+        :param fetch: 获取值的函数
+        """
+        now = time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.hits += 1
+                # 移到末尾，表示最近使用
+                del self.entries[key]
+                self.entries[key] = entry
+                return entry[1]
+            del self.entries[key]
+
+        # 已经有相同的请求正在进行，等待它的结果
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.get()
+
+        self.misses += 1
+        pending = AsyncResult()
+        self.in_flight[key] = pending
+        try:
+            value, cacheable = fetch()
+        except BaseException as e:
+            # fetch所在的greenlet被杀死（GreenletExit）时也要唤醒等待的请求，否则它们会一直等待。
+            # 等待的请求收到普通的异常，由Bottle返回HTTP 500
+            pending.set_exception(e if isinstance(e, Exception) else RuntimeError("fetch was interrupted: %r" % e))
+            raise
+        else:
+            if cacheable and self.ttl > 0:
+                self.put(key, value, time() + self.ttl)
+            pending.set(value)
+            return value
+        finally:
+            del self.in_flight[key]
+
+    def put(self, key, value, expire_time):
+        """
+        添加一个条目。条目数超过max_entries时删除最久未使用的条目。
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = (expire_time, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, match):
+        """
+        删除所有键满足match(key)的条目，例如在Node被删除时。
+
+        :param match: 判断键的函数
+        """
+        for key in [k for k in self.entries if match(k)]:
+            del self.entries[key]
+
+    def resize(self, ttl, max_entries):
+        """
+        更改缓存的有效时间和条目数上限，例如在应用新配置时。已有条目的过期时间不变。
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_stats(self):
+        """
+        以dict的形式返回缓存的统计信息。
+
+        :rtype: dict
+        """
+        return {
+            "ttl": self.ttl,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions
+        }
@@ -17,7 +17,21 @@ ServerConfig配置类用于解析和封装Server的配置。
         "server_id": "TEST-SERVER-1",   # Server的ID，需要在网络中唯一
         "server_desc": "地区A/地点1",    # Server的位置描述。以路径的方式配置。路径中的节点将在客户端显示为Server的目录节点。
         "forwarder_addr": "127.0.0.1",  # 要连接到的Forwarder的IP地址
-        "forwarder_port": 9003          # 要连接到的Server的端口
+        "forwarder_port": 9003,         # 要连接到的Server的端口
+
+        "warning_mode": "push",           # 可选。"push"为由Node主动推送警报，"poll"为由Server定期向Node检查警报。默认为"push"
+        "warning_check_concurrency": 20,  # 可选。检查Node警报时，同时进行检查的Node数量上限。默认为20
+        "node_connect_timeout": 2.0,      # 可选。向Node发送请求时，建立连接的超时时间（秒）。默认为2.0
+        "node_read_timeout": 3.0,         # 可选。向Node发送请求时，读取响应的超时时间（秒）。默认为3.0
+        "sensor_cache_ttl": 0.5,          # 可选。从Node获取的传感器数据的缓存时间（秒），为0时不缓存。默认为0.5
+        "sensor_cache_size": 1024,        # 可选。最多缓存的传感器数据条目数。默认为1024
+        "history_dir": "history",         # 可选。传感器历史数据的存储目录，为空字符串时不保存历史数据。默认为"history"
+        "history_segment_duration": 3600, # 可选。历史数据每个段文件的时间窗口（秒）。默认为3600
+        "history_compression": true,      # 可选。是否在后台压缩已经封闭的历史数据段。默认为true
+        "history_compact_interval": 600,  # 可选。后台压缩历史数据段的间隔（秒）。默认为600
+        "node_check_interval": 5.0,       # 可选。检查Node是否存活（和轮询警报）的间隔（秒）。默认为5.0
+        "node_live_interval": 30.0,       # 可选。Node超过这个时间（秒）没有发送心跳请求，即被删除。默认为30.0
+        "forwarder_keep_alive_interval": 10.0  # 可选。向Forwarder发送心跳请求的间隔（秒），应小于Forwarder的server_live_interval。默认为10.0
     }
 
 """
@@ -47,6 +61,24 @@ class ServerConfig(object):
         ("forwarder_port", int)
     ]
 
+    # 用于在Json解析中，检查配置的第一级可选键值是否有误。
+    # 每项为(键, 类型, 默认值)，缺失的可选键将被设置为默认值。
+    first_level_optional_check = [
+        ("warning_mode", basestring, "push"),
+        ("warning_check_concurrency", int, 20),
+        ("node_connect_timeout", (int, float), 2.0),
+        ("node_read_timeout", (int, float), 3.0),
+        ("sensor_cache_ttl", (int, float), 0.5),
+        ("sensor_cache_size", int, 1024),
+        ("history_dir", basestring, "history"),
+        ("history_segment_duration", int, 3600),
+        ("history_compression", bool, True),
+        ("history_compact_interval", (int, float), 600.0),
+        ("node_check_interval", (int, float), 5.0),
+        ("node_live_interval", (int, float), 30.0),
+        ("forwarder_keep_alive_interval", (int, float), 10.0)
+    ]
+
     def __init__(self, config_dict):
         """
         :param dict config_dict: 初始化用字典。用字典的对应键设置本ServerConfig对象的各个成员变量。
@@ -63,6 +95,32 @@ class ServerConfig(object):
 
         self.forwarder_port = config_dict["forwarder_port"]
 
+        self.warning_mode = config_dict["warning_mode"]
+
+        self.warning_check_concurrency = config_dict["warning_check_concurrency"]
+
+        self.node_connect_timeout = config_dict["node_connect_timeout"]
+
+        self.node_read_timeout = config_dict["node_read_timeout"]
+
+        self.sensor_cache_ttl = config_dict["sensor_cache_ttl"]
+
+        self.sensor_cache_size = config_dict["sensor_cache_size"]
+
+        self.history_dir = config_dict["history_dir"]
+
+        self.history_segment_duration = config_dict["history_segment_duration"]
+
+        self.history_compression = config_dict["history_compression"]
+
+        self.history_compact_interval = config_dict["history_compact_interval"]
+
+        self.node_check_interval = config_dict["node_check_interval"]
+
+        self.node_live_interval = config_dict["node_live_interval"]
+
+        self.forwarder_keep_alive_interval = config_dict["forwarder_keep_alive_interval"]
+
     def get_json_string(self):
         """
         返回一个字符串，是本配置对象的Json数据。
@@ -77,7 +135,20 @@ class ServerConfig(object):
             "server_id": self.server_id,
             "server_desc": self.server_desc,
             "forwarder_addr": self.forwarder_addr,
-            "forwarder_port": self.forwarder_port
+            "forwarder_port": self.forwarder_port,
+            "warning_mode": self.warning_mode,
+            "warning_check_concurrency": self.warning_check_concurrency,
+            "node_connect_timeout": self.node_connect_timeout,
+            "node_read_timeout": self.node_read_timeout,
+            "sensor_cache_ttl": self.sensor_cache_ttl,
+            "sensor_cache_size": self.sensor_cache_size,
+            "history_dir": self.history_dir,
+            "history_segment_duration": self.history_segment_duration,
+            "history_compression": self.history_compression,
+            "history_compact_interval": self.history_compact_interval,
+            "node_check_interval": self.node_check_interval,
+            "node_live_interval": self.node_live_interval,
+            "forwarder_keep_alive_interval": self.forwarder_keep_alive_interval
         })
 
 
@@ -106,6 +177,29 @@ def parse_from_string(config_json):
         if not isinstance(config[key], val_type):
             raise ValueError("value of key '%s' is not a '%s' instance." % (key, str(val_type)))
 
+    # 检查第一级可选变量
+    for (key, val_type, default_val) in ServerConfig.first_level_optional_check:
+        if key not in config:
+            config[key] = default_val
+        elif not isinstance(config[key], val_type):
+            raise ValueError("value of key '%s' is not a '%s' instance." % (key, str(val_type)))
+
+    if config["warning_mode"] not in ("push", "poll"):
+        raise ValueError("value of key 'warning_mode' must be 'push' or 'poll'.")
+    if config["warning_check_concurrency"] <= 0:
+        raise ValueError("value of key 'warning_check_concurrency' must be positive.")
+    if config["sensor_cache_ttl"] < 0:
+        raise ValueError("value of key 'sensor_cache_ttl' must not be negative.")
+    if config["sensor_cache_size"] <= 0:
+        raise ValueError("value of key 'sensor_cache_size' must be positive.")
+    if config["history_segment_duration"] <= 0:
+        raise ValueError("value of key 'history_segment_duration' must be positive.")
+    if config["history_compact_interval"] <= 0:
+        raise ValueError("value of key 'history_compact_interval' must be positive.")
+    for key in ("node_check_interval", "node_live_interval", "forwarder_keep_alive_interval"):
+        if config[key] <= 0:
+            raise ValueError("value of key '%s' must be positive." % key)
+
     logging.debug("[parse_from_string] first level item checked")
 
     # 返回解析后的对象
@@ -1119,13 +1119,36 @@
         };
 
         /**
-         * 监听SocketIO的警报事件，收到警报后高亮设备并添加到警报列表中显示
+         * 处理一份警报：高亮设备并添加到警报列表中显示
+         * @param warningData 警报数据（Json字符串）
          */
-        socketIO.on('warning', function(data) {
-            var info = JSON.parse(data.data);
+        self.handleWarning = function(warningData) {
+            var info = JSON.parse(warningData);
             var time = new Date(info.timestamp * 1000);
+            // Node推送的“离开警报状态”消息只加入列表，不高亮设备
+            if (info.warning_state === 'leave') {
+                self.addWarningItem(time, info.server + '/' + info.node.id, info.sensor_id, info.sensor_type, '恢复', info.raw_value);
+                return;
+            }
             self.highlightDevice(info.server, info.node.id, info.sensor_id, info.raw_value);
             self.addWarningItem(time, info.server + '/' + info.node.id, info.sensor_id, info.sensor_type, '警报', info.raw_value);
+        };
+
+        /**
+         * 监听SocketIO的警报事件，收到警报后交给handleWarning处理
+         */
+        socketIO.on('warning', function(data) {
+            self.handleWarning(data.data);
+        });
+
+        /**
+         * 监听SocketIO的最近警报事件。连接时Forwarder一次发送最近的若干份警报（从旧到新），逐份交给handleWarning处理，
+         * 使页面不需要轮询就能恢复警报列表和设备的高亮状态
+         */
+        socketIO.on('warnings', function(data) {
+            for (var i = 0; i < data.data.length; i++) {
+                self.handleWarning(data.data[i]);
+            }
         });
     }]);
 
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+"""
+tests
+这个包是项目的单元测试，覆盖各模块中的编码格式和数据结构。
+在项目根目录 ``project`` 下运行 ``python -m pytest tests`` 。
+"""
+
+__author__ = 'tgmerge'
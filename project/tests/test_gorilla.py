@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+
+"""
+pinic.server.gorilla的压缩段编码的往返测试。
+"""
+
+__author__ = "tgmerge"
+
+
+from pinic.server.gorilla import encode_segment, encode_block, decode_block, read_segment_range, read_index
+from array import array
+import struct
+
+
+def same_float(a, b):
+    """
+    按位比较两个浮点数，NaN与NaN相同，0.0与-0.0不同。
+    """
+    return struct.pack("<d", a) == struct.pack("<d", b)
+
+
+def assert_round_trip(timestamps, raw_values, block_size=256):
+    data = encode_segment(array("d", timestamps), array("d", raw_values), block_size=block_size)
+    decoded_timestamps, decoded_raw_values = read_segment_range(data, float("-inf"), float("inf"))
+    assert len(decoded_timestamps) == len(timestamps)
+    for expected, actual in zip(timestamps, decoded_timestamps):
+        assert abs(expected - actual) < 1e-6
+    for expected, actual in zip(raw_values, decoded_raw_values):
+        assert same_float(expected, actual)
+    return data
+
+
+def test_empty_segment():
+    data = assert_round_trip([], [])
+    assert read_index(data) == []
+
+
+def test_single_record():
+    data = assert_round_trip([1000.5], [42.0])
+    assert len(read_index(data)) == 1
+
+
+def test_regular_interval():
+    # 间隔不变、值不变时，每条记录只占2位
+    count = 1000
+    data = assert_round_trip([1000.0 + n * 0.5 for n in xrange(count)], [3.0] * count, block_size=count)
+    assert len(data) < 16 + count // 4 + 100
+
+
+def test_irregular_timestamps_and_values():
+    timestamps = []
+    raw_values = []
+    t = 1400000000.0
+    for n in xrange(2000):
+        # 覆盖差的差的各个编码长度，包括64位的原始值
+        t += [0.001, 0.002, 0.1, 1.0, 30.0, 100000.0][n % 6] + (n % 7) * 1e-6
+        timestamps.append(t)
+        raw_values.append((n * 7919 % 1024) / 3.0)
+    assert_round_trip(timestamps, raw_values, block_size=100)
+
+
+def test_non_finite_values():
+    raw_values = [1.0, float("nan"), float("inf"), float("-inf"), 0.0, -0.0, float("nan"), 2.5, float("-inf")]
+    timestamps = [1000.0 + n for n in xrange(len(raw_values))]
+    assert_round_trip(timestamps, raw_values)
+
+
+def test_out_of_order_block():
+    # 块的编码本身不要求时间戳递增，负的间隔也能还原
+    timestamps = array("d", [1000.0, 999.0, 1005.25, 1001.0, 1001.0, 2000.0])
+    raw_values = array("d", [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    decoded_timestamps, decoded_raw_values = decode_block(encode_block(timestamps, raw_values, 0, len(timestamps)), len(timestamps))
+    assert list(decoded_timestamps) == list(timestamps)
+    assert list(decoded_raw_values) == list(raw_values)
+
+
+def test_read_range_across_blocks():
+    timestamps = [1000.0 + n for n in xrange(100)]
+    raw_values = [float(n) for n in xrange(100)]
+    data = encode_segment(array("d", timestamps), array("d", raw_values), block_size=16)
+    decoded_timestamps, decoded_raw_values = read_segment_range(data, 1010.0, 1050.0)
+    assert list(decoded_timestamps) == timestamps[10:51]
+    assert list(decoded_raw_values) == raw_values[10:51]
+    assert len(read_segment_range(data, 2000.0, 3000.0)[0]) == 0
+
+
+def test_truncated_segment():
+    data = encode_segment(array("d", [1000.0, 1001.0]), array("d", [1.0, 2.0]))
+    try:
+        read_index(data[:-1])
+    except ValueError:
+        pass
+    else:
+        assert False, "truncated segment was accepted"
@@ -0,0 +1,134 @@
+# -*- coding: utf8 -*-
+
+"""
+pinic.server.history的HistoryStore的写入、排序、压缩和查询测试。
+"""
+
+__author__ = "tgmerge"
+
+
+from pinic.server.history import HistoryStore, quote_id, raw_segment_suffix, compressed_segment_suffix
+from pinic.sensor.sensordata import SensorData, SensorBatch
+from math import isnan
+import os
+
+
+def query_all(store, node_id="node", sensor_id="sensor"):
+    batch = store.query(node_id, sensor_id, 0.0, 1e12)
+    return list(batch.timestamps), list(batch.raw_values)
+
+
+def segment_files(store, node_id="node", sensor_id="sensor"):
+    return sorted(os.listdir(store.get_sensor_dir(node_id, sensor_id)))
+
+
+def test_empty_store(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    assert len(store.query("node", "sensor", 0.0, 1e12)) == 0
+    assert store.get_last_timestamp("node", "sensor") is None
+
+
+def test_single_record(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    store.append("node", SensorData("sensor", "type", 1.5, 1050.0))
+    assert query_all(store) == ([1050.0], [1.5])
+    assert store.query("node", "sensor", 1050.0, 1050.0).timestamps.tolist() == [1050.0]
+    assert len(store.query("node", "sensor", 1050.5, 1e12)) == 0
+
+
+def test_out_of_order_in_open_segment(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    # 警报先于覆盖同一时间段的采样值到达
+    store.append("node", SensorData("sensor", "type", 5.0, 1005.0))
+    batch = SensorBatch()
+    for n in xrange(12):
+        batch.append("sensor", "type", float(n), 1000.0 + n)
+    store.append_batch("node", batch)
+    timestamps, raw_values = query_all(store)
+    assert timestamps == [1000.0 + n for n in xrange(12)]
+    assert raw_values == [float(n) for n in xrange(12)]
+
+    # 重发的数据不会重复写入
+    store.append_batch("node", batch)
+    assert query_all(store)[0] == timestamps
+
+    # 属于已经封闭的段的数据被丢弃
+    store.append("node", SensorData("sensor", "type", 0.0, 1100.0))
+    dropped = store.dropped
+    store.append("node", SensorData("sensor", "type", 0.0, 1099.0))
+    assert store.dropped == dropped + 1
+    assert 1099.0 not in query_all(store)[0]
+
+
+def test_unsorted_segment_sorted_on_reopen(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    for t in (1010.0, 1003.0, 1007.0):
+        store.append("node", SensorData("sensor", "type", t, t))
+    store.close()
+
+    reopened = HistoryStore(str(tmpdir), 100)
+    assert reopened.get_last_timestamp("node", "sensor") == 1010.0
+    assert query_all(reopened)[0] == [1003.0, 1007.0, 1010.0]
+
+
+def test_non_finite_values(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    values = [float("nan"), float("inf"), float("-inf"), 1.0]
+    for n, value in enumerate(values):
+        store.append("node", SensorData("sensor", "type", value, 1000.0 + n))
+    store.append("node", SensorData("sensor", "type", 2.0, 1200.0))
+    assert store.compact_sealed() == 1
+    raw_values = query_all(store)[1]
+    assert isnan(raw_values[0])
+    assert raw_values[1:] == [float("inf"), float("-inf"), 1.0, 2.0]
+
+
+def test_compact_and_query_across_boundary(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    for n in xrange(300):
+        store.append("node", SensorData("sensor", "type", n * 0.5, 1000.0 + n))
+    # 1000和1100两个段已经封闭，1200所在的段仍在写入
+    assert store.compact_sealed() == 2
+    files = segment_files(store)
+    assert "1000_100" + compressed_segment_suffix in files
+    assert "1100_100" + compressed_segment_suffix in files
+    assert "1200_100" + raw_segment_suffix in files
+    assert store.compact_sealed() == 0
+
+    # 跨越压缩段和原始段的边界查询
+    batch = store.query("node", "sensor", 1090.0, 1210.0)
+    assert list(batch.timestamps) == [1000.0 + n for n in xrange(90, 211)]
+    assert list(batch.raw_values) == [n * 0.5 for n in xrange(90, 211)]
+    assert query_all(store)[0] == [1000.0 + n for n in xrange(300)]
+
+    # 重新打开后，最后的时间戳从段文件中读取
+    store.close()
+    reopened = HistoryStore(str(tmpdir), 100)
+    assert reopened.get_last_timestamp("node", "sensor") == 1299.0
+    assert len(reopened.query("node", "sensor", 1099.0, 1100.0)) == 2
+
+
+def test_segment_duration_change(tmpdir):
+    store = HistoryStore(str(tmpdir), 100)
+    for n in xrange(150):
+        store.append("node", SensorData("sensor", "type", float(n), 1000.0 + n))
+    store.close()
+
+    # 修改窗口长度后，已有的段仍按原来的窗口查询
+    store = HistoryStore(str(tmpdir), 300)
+    for n in xrange(150, 400):
+        store.append("node", SensorData("sensor", "type", float(n), 1000.0 + n))
+    store.compact_sealed()
+    assert query_all(store)[0] == [1000.0 + n for n in xrange(400)]
+
+
+def test_quote_id():
+    assert quote_id("a/b") == "a%2Fb"
+    assert quote_id(".") != "."
+    assert quote_id("..") != ".."
+    try:
+        quote_id("")
+    except ValueError:
+        pass
+    else:
+        assert False, "empty id was accepted"
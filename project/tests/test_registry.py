@@ -0,0 +1,64 @@
+# -*- coding: utf8 -*-
+
+"""
+pinic.registry的ExpiryRegistry的超时清理测试。
+"""
+
+__author__ = "tgmerge"
+
+
+from pinic.registry import ExpiryRegistry
+
+
+class Item(object):
+    def __init__(self, item_id, last_active_time):
+        self.id = item_id
+        self.last_active_time = last_active_time
+
+
+def expired_ids(registry, max_live_interval, now):
+    return sorted(item.id for item in registry.pop_expired(max_live_interval, now))
+
+
+def test_pop_expired():
+    registry = ExpiryRegistry()
+    registry.add(Item("a", 100.0))
+    registry.add(Item("b", 105.0))
+    assert expired_ids(registry, 10.0, 110.0) == []
+    assert expired_ids(registry, 10.0, 110.5) == ["a"]
+    assert "a" not in registry
+    assert expired_ids(registry, 10.0, 120.0) == ["b"]
+    assert len(registry) == 0
+
+
+def test_pop_expired_after_refresh():
+    registry = ExpiryRegistry()
+    registry.add(Item("a", 100.0))
+    registry.add(Item("b", 100.0))
+    assert registry.refresh("a", 108.0)
+    # "a"在堆中的旧条目已经到期，但它已被刷新，不应被删除
+    assert expired_ids(registry, 10.0, 115.0) == ["b"]
+    assert "a" in registry
+    assert expired_ids(registry, 10.0, 118.5) == ["a"]
+    assert not registry.refresh("a", 120.0)
+
+
+def test_pop_expired_after_readd():
+    registry = ExpiryRegistry()
+    registry.add(Item("a", 100.0))
+    registry.remove("a")
+    registry.add(Item("a", 200.0))
+    assert expired_ids(registry, 10.0, 150.0) == []
+    assert registry.get("a").last_active_time == 200.0
+
+
+def test_heap_compaction():
+    registry = ExpiryRegistry()
+    registry.add(Item("a", 0.0))
+    registry.add(Item("b", 0.0))
+    for n in xrange(1, 1000):
+        registry.refresh("a", float(n))
+    # 失效的条目被定期清理，堆不会无限增长
+    assert len(registry.heap) <= 2 * len(registry) + ExpiryRegistry.compact_threshold + 1
+    assert expired_ids(registry, 10.0, 500.0) == ["b"]
+    assert expired_ids(registry, 10.0, 1009.5) == ["a"]
@@ -0,0 +1,95 @@
+# -*- coding: utf8 -*-
+
+"""
+pinic.sensor.sensordata的Json和二进制格式的往返测试。
+"""
+
+__author__ = "tgmerge"
+
+
+from pinic.sensor.sensordata import SensorData, SensorBatch, parse_from_string, parse_from_binary, \
+    encode_batch, decode_batch, accepts_binary, binary_content_type, json_content_type, binary_header_format
+from json import loads
+from math import isnan
+import struct
+
+
+def make_batch():
+    batch = SensorBatch()
+    batch.append(u"s1", u"adc", 1.5, 1000.25)
+    batch.append(u"传感器", u"温度", -2.0, 1000.5)
+    batch.append(u"s1", u"adc", float("nan"), 1001.0)
+    batch.append(u"s1", u"adc", float("inf"), 1001.5)
+    batch.append(u"s1", u"adc", float("-inf"), 1002.0)
+    return batch
+
+
+def test_binary_round_trip():
+    batch = make_batch()
+    decoded = SensorBatch.from_binary(batch.to_binary())
+    assert decoded.id_table == batch.id_table
+    assert list(decoded.id_indexes) == list(batch.id_indexes)
+    assert list(decoded.timestamps) == list(batch.timestamps)
+    assert decoded.raw_values[:2].tolist() == [1.5, -2.0]
+    assert isnan(decoded.raw_values[2])
+    assert decoded.raw_values[3:].tolist() == [float("inf"), float("-inf")]
+
+
+def test_binary_header():
+    data = make_batch().to_binary()
+    magic, version, _, id_count, count = struct.unpack_from(binary_header_format, data, 0)
+    assert (magic, version, id_count, count) == ("PSDB", 1, 2, 5)
+
+
+def test_binary_empty_and_single():
+    assert len(SensorBatch.from_binary(SensorBatch().to_binary())) == 0
+    data = SensorData(u"s1", u"adc", 3.0, 1000.0)
+    decoded = parse_from_binary(data.get_binary_dumps())
+    assert (decoded.sensor_id, decoded.sensor_type, decoded.raw_value, decoded.timestamp) == (u"s1", u"adc", 3.0, 1000.0)
+
+
+def test_binary_malformed():
+    data = make_batch().to_binary()
+    for bad_data in (data[:-1], data + "\0", "XXXX" + data[4:], ""):
+        try:
+            SensorBatch.from_binary(bad_data)
+        except ValueError:
+            pass
+        else:
+            assert False, "malformed data was accepted"
+
+
+def test_json_round_trip():
+    batch = make_batch()
+    data_json = batch.to_json()
+    items = loads(data_json)
+    assert [x["raw_value"] for x in items] == [1.5, -2.0, None, None, None]
+    decoded = SensorBatch.from_json(data_json)
+    assert list(decoded.timestamps) == list(batch.timestamps)
+    assert decoded.raw_values[:2].tolist() == [1.5, -2.0]
+    assert all(isnan(x) for x in decoded.raw_values[2:])
+
+
+def test_sensor_data_json():
+    assert loads(SensorData(u"s1", u"adc", float("inf"), 1000.0).get_json_dumps())["raw_value"] is None
+    assert isnan(parse_from_string(SensorData(u"s1", u"adc", float("nan"), 1000.0).get_json_dumps()).raw_value)
+    assert parse_from_string(SensorData(u"s1", u"adc", 0.1, 1000.0).get_json_dumps()).raw_value == 0.1
+
+
+def test_encode_decode_by_accept():
+    batch = make_batch()
+    body, content_type = encode_batch(batch, binary_content_type)
+    assert content_type == binary_content_type
+    assert len(decode_batch(body, content_type)) == len(batch)
+    body, content_type = encode_batch(batch, None)
+    assert content_type == json_content_type
+    assert len(decode_batch(body, content_type)) == len(batch)
+
+
+def test_accepts_binary():
+    assert accepts_binary(binary_content_type)
+    assert accepts_binary("application/json;q=0.5, %s" % binary_content_type)
+    assert not accepts_binary(None)
+    assert not accepts_binary("*/*")
+    assert not accepts_binary("%s;q=0" % binary_content_type)
+    assert not accepts_binary("application/json, %s;q=0.5" % binary_content_type)